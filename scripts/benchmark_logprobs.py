@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from contextlib import contextmanager
+from collections.abc import Iterator
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from src.training.logprobs import masked_sequence_logprobs
+
+
+@contextmanager
+def _track_saved_tensor_bytes(totals: dict[str, int]) -> Iterator[None]:
+    seen: set[int] = set()
+
+    def pack(tensor: torch.Tensor) -> torch.Tensor:
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in seen:
+            seen.add(storage.data_ptr())
+            totals["saved_bytes"] += storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        yield
+
+
+def _run_mode(
+    *,
+    model: torch.nn.Module,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    target_mask: torch.Tensor,
+    target_only: bool,
+    chunk_size: int,
+) -> dict[str, float | str]:
+    model.zero_grad(set_to_none=True)
+    totals = {"saved_bytes": 0}
+    if input_ids.device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    started_at = time.perf_counter()
+    with _track_saved_tensor_bytes(totals):
+        logprobs = masked_sequence_logprobs(
+            model=model,
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            target_mask=target_mask,
+            target_only=target_only,
+            chunk_size=chunk_size,
+        )
+    logprobs.sum().backward()
+    if input_ids.device.type == "cuda":
+        torch.cuda.synchronize()
+    result: dict[str, float | str] = {
+        "mode": "target_only" if target_only else "full_logits",
+        "seconds": time.perf_counter() - started_at,
+        "saved_activation_mb": totals["saved_bytes"] / 2**20,
+    }
+    if input_ids.device.type == "cuda":
+        result["cuda_peak_memory_mb"] = torch.cuda.max_memory_allocated() / 2**20
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare full-vocab and target-only log-prob scoring memory.")
+    parser.add_argument("--vocab-size", type=int, default=32000)
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--sequence-length", type=int, default=512)
+    parser.add_argument("--target-length", type=int, default=64)
+    parser.add_argument("--chunk-size", type=int, default=256)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=args.vocab_size,
+        n_positions=args.sequence_length,
+        n_embd=args.hidden_size,
+        n_layer=2,
+        n_head=2,
+    )
+    model = GPT2LMHeadModel(config).to(device)
+    input_ids = torch.randint(0, args.vocab_size, (args.batch_size, args.sequence_length), device=device)
+    attention_mask = torch.ones_like(input_ids)
+    target_mask = torch.zeros_like(input_ids)
+    target_mask[:, -args.target_length :] = 1
+
+    results = [
+        _run_mode(
+            model=model,
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            target_mask=target_mask,
+            target_only=target_only,
+            chunk_size=args.chunk_size,
+        )
+        for target_only in (False, True)
+    ]
+    for result in results:
+        print(json.dumps(result))
+    memory_key = "cuda_peak_memory_mb" if device.type == "cuda" else "saved_activation_mb"
+    reduction = 1.0 - float(results[1][memory_key]) / max(float(results[0][memory_key]), 1e-9)
+    print(json.dumps({"metric": memory_key, "reduction": reduction}))
+
+
+if __name__ == "__main__":
+    main()
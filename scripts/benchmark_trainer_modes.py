@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import argparse
+from dataclasses import replace
+import json
+from pathlib import Path
+import statistics
+import time
+from typing import Any
+
+import torch
+import yaml
+
+from src.training.config import MRVFConfig
+from src.training.data import build_prompt
+from src.training.mrvf_trainer import MRVFTrainer
+
+MODES: dict[str, dict[str, Any]] = {
+    "eager": {},
+    "autocast_bf16": {"autocast_bf16": True},
+    "compile": {"compile_scoring": True},
+    "compile_autocast_bf16": {"compile_scoring": True, "autocast_bf16": True},
+}
+
+KEYWORDS = ["cats", "dentists", "mondays", "owls", "taxes", "coffee", "printers", "penguins"]
+
+
+def _load_config(path: Path) -> MRVFConfig:
+    raw = yaml.safe_load(path.read_text(encoding="utf-8"))
+    return MRVFConfig(**raw)
+
+
+def _build_rows(count: int) -> list[dict[str, Any]]:
+    rows = []
+    for index in range(count):
+        keyword = KEYWORDS[index % len(KEYWORDS)]
+        rows.append(
+            {
+                "prompt": build_prompt([keyword]),
+                "references": [f"A short joke about {keyword}.", f"Another {keyword} joke, slightly longer."],
+            }
+        )
+    return rows
+
+
+def _run_mode(
+    *,
+    name: str,
+    cfg: MRVFConfig,
+    rows: list[dict[str, Any]],
+    warmup_steps: int,
+    steps: int,
+) -> dict[str, float | str]:
+    torch.manual_seed(cfg.seed)
+    trainer = MRVFTrainer(cfg)
+    batch_size = max(1, cfg.per_device_train_batch_size)
+    durations: list[float] = []
+    for step in range(warmup_steps + steps):
+        batch = rows[(step * batch_size) % len(rows) :][:batch_size]
+        started_at = time.perf_counter()
+        with trainer._autocast():
+            loss, _, _ = trainer._compute_losses_for_batch(batch)
+        if loss.requires_grad:
+            loss.backward()
+        trainer.optimizer.step()
+        trainer.optimizer.zero_grad(set_to_none=True)
+        if trainer.device.type == "cuda":
+            torch.cuda.synchronize(trainer.device)
+        durations.append(time.perf_counter() - started_at)
+    timed = durations[warmup_steps:] or durations
+    return {
+        "mode": name,
+        "first_step_seconds": durations[0],
+        "step_seconds_mean": statistics.fmean(timed),
+        "step_seconds_min": min(timed),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare MRVF training step time across execution modes.")
+    parser.add_argument("--config", default="configs/models/tiny-cpu.yaml")
+    parser.add_argument("--modes", nargs="+", choices=sorted(MODES), default=list(MODES))
+    parser.add_argument("--warmup-steps", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--pad-to-multiple-of", type=int, default=32)
+    args = parser.parse_args()
+
+    base_cfg = _load_config(Path(args.config))
+    rows = _build_rows(max(8, base_cfg.per_device_train_batch_size * (args.warmup_steps + args.steps)))
+    results = []
+    for name in args.modes:
+        overrides = dict(MODES[name])
+        if overrides.get("compile_scoring"):
+            overrides["pad_to_multiple_of"] = args.pad_to_multiple_of
+        result = _run_mode(
+            name=name,
+            cfg=replace(base_cfg, report_to_wandb=False, **overrides),
+            rows=rows,
+            warmup_steps=args.warmup_steps,
+            steps=args.steps,
+        )
+        results.append(result)
+        print(json.dumps(result), flush=True)
+
+    baseline = next((result for result in results if result["mode"] == "eager"), None)
+    if baseline is not None:
+        speedups = {
+            str(result["mode"]): float(baseline["step_seconds_mean"]) / max(float(result["step_seconds_mean"]), 1e-9)
+            for result in results
+        }
+        print(json.dumps({"metric": "speedup_vs_eager", **speedups}))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ import yaml
 
 from src.training.config import MRVFConfig
 from src.training.data import load_reference_splits
+from src.training.distributed import shutdown_distributed
 from src.training.mrvf_trainer import MRVFTrainer
 
 
@@ -30,8 +31,11 @@ def main() -> None:
         train_split=cfg.train_split,
         eval_split=cfg.eval_split,
     )
-    metrics = MRVFTrainer(cfg).train(raw_train_dataset=train_dataset, raw_eval_dataset=eval_dataset)
-    print(yaml.safe_dump({"config": asdict(cfg), "result": metrics}, sort_keys=False))
+    trainer = MRVFTrainer(cfg)
+    metrics = trainer.train(raw_train_dataset=train_dataset, raw_eval_dataset=eval_dataset)
+    if trainer.dist.is_main_process:
+        print(yaml.safe_dump({"config": asdict(cfg), "result": metrics}, sort_keys=False))
+    shutdown_distributed(trainer.dist)
 
 
 if __name__ == "__main__":
@@ -29,6 +29,8 @@ class EmbeddingsConfig(BaseModel):
     batch_size: int = Field(gt=0)
     shard_size: int = Field(gt=0)
     max_parallel_requests: int = Field(gt=0)
+    requests_per_minute: int | None = Field(default=None, gt=0)
+    tokens_per_minute: int | None = Field(default=None, gt=0)
     timeout: int = Field(gt=0)
     max_retries: int = Field(gt=0)
 
@@ -49,6 +51,8 @@ class KeywordsConfig(BaseModel):
     batch_size: int = Field(default=64, gt=0)
     shard_size: int = Field(gt=0)
     max_parallel_requests: int = Field(gt=0)
+    requests_per_minute: int | None = Field(default=None, gt=0)
+    tokens_per_minute: int | None = Field(default=None, gt=0)
     timeout: int = Field(default=60, gt=0)
     max_retries: int = Field(default=5, gt=0)
 
@@ -70,6 +74,8 @@ class ReferencesConfig(BaseModel):
     output_batch_size: int = Field(default=128, gt=0)
     shard_size: int = Field(default=10000, gt=0)
     max_parallel_requests: int = Field(default=5, gt=0)
+    requests_per_minute: int | None = Field(default=None, gt=0)
+    tokens_per_minute: int | None = Field(default=None, gt=0)
     timeout: int = Field(default=60, gt=0)
     max_retries: int = Field(default=5, gt=0)
     faiss_nlist: int = Field(default=4096, gt=0)
@@ -89,10 +95,13 @@ class CandidatesConfig(BaseModel):
     model: str
     shard_size: int = Field(default=5000, gt=0)
     max_parallel_requests: int = Field(default=16, gt=0)
+    requests_per_minute: int | None = Field(default=None, gt=0)
+    tokens_per_minute: int | None = Field(default=None, gt=0)
     timeout: int = Field(default=60, gt=0)
     max_retries: int = Field(default=3, gt=0)
     temperature: float = Field(default=1.0, ge=0.0, le=2.0)
     max_completion_tokens: int = Field(default=128, gt=0)
+    seed: int | None = None
 
 
 class EvaluationConfig(BaseModel):
@@ -103,6 +112,8 @@ class EvaluationConfig(BaseModel):
     input_batch_size: int = Field(default=128, gt=0)
     shard_size: int = Field(default=5000, gt=0)
     max_parallel_requests: int = Field(default=16, gt=0)
+    requests_per_minute: int | None = Field(default=None, gt=0)
+    tokens_per_minute: int | None = Field(default=None, gt=0)
     timeout: int = Field(default=60, gt=0)
     max_retries: int = Field(default=3, gt=0)
     judge_temperature: float = Field(default=0.0, ge=0.0, le=1.0)
@@ -111,6 +122,21 @@ class EvaluationConfig(BaseModel):
     random_seed: int = 42
 
 
+class ApiCacheConfig(BaseModel):
+    enabled: bool = True
+    path: str = "cache/api.sqlite"
+    max_size_mb: int = Field(default=4096, ge=0)
+
+
+class ConcurrencyConfig(BaseModel):
+    min_parallel_requests: int = Field(default=1, gt=0)
+    max_parallel_requests: int = Field(default=256, gt=0)
+    decrease_factor: float = Field(default=0.5, gt=0.0, lt=1.0)
+    latency_tolerance: float = Field(default=2.0, ge=1.0)
+    max_backoff: float = Field(default=60.0, gt=0.0)
+    log_interval: float = Field(default=30.0, gt=0.0)
+
+
 class Config(BaseModel):
     jokes: JokesConfig
     keywords: KeywordsConfig
@@ -118,6 +144,8 @@ class Config(BaseModel):
     references: ReferencesConfig
     candidates: CandidatesConfig
     evaluation: EvaluationConfig
+    api_cache: ApiCacheConfig = Field(default_factory=ApiCacheConfig)
+    concurrency: ConcurrencyConfig = Field(default_factory=ConcurrencyConfig)
 
 
 config_path = CONFIGS_DIR / settings.CONFIG_FILENAME
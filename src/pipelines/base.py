@@ -1,20 +1,323 @@
 import asyncio
 import inspect
-import re
+import math
+import random
+import time
 from abc import ABC
+from collections.abc import Awaitable, Callable
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import Generic, ParamSpec, TypeVar
+from types import TracebackType
+from typing import Any, Generic, ParamSpec, TypeVar
 
 import numpy as np
+import numpy.typing as npt
 import pyarrow as pa
-import pyarrow.dataset as ds
-import pyarrow.parquet as pq
+import pyarrow.compute as pc
 from datasets import Dataset
-from openai import AsyncOpenAI
+from openai import APITimeoutError, AsyncOpenAI
 from pydantic import BaseModel
 
+from src.config import ConcurrencyConfig
+from src.logging import get_logger
+from src.pipelines.cache import ApiCache, api_cache_key, decode_embedding, encode_embedding
+from src.pipelines.manifest import PartManifest
+from src.pipelines.writer import ArrowWriteBuffer, ParquetShardWriter
+
+logger = get_logger(__name__)
+
 T = TypeVar("T", bound=BaseModel)
 P = ParamSpec("P")
+R = TypeVar("R")
+
+_CHARS_PER_TOKEN = 4
+
+
+def _is_overload_error(error: BaseException) -> bool:
+    if isinstance(error, (TimeoutError, APITimeoutError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return isinstance(status_code, int) and (status_code == 429 or status_code >= 500)
+
+
+def _retry_after_seconds(error: BaseException) -> float | None:
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is None:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000.0)
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(UTC)).total_seconds())
+
+
+class ConcurrencyController:
+    def __init__(
+        self,
+        initial_limit: int,
+        min_limit: int = 1,
+        max_limit: int = 256,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 2.0,
+        max_backoff: float = 60.0,
+        log_interval: float = 30.0,
+        name: str = "api",
+    ) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.max_backoff = max_backoff
+        self.log_interval = log_interval
+        self.name = name
+
+        self._limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self._in_flight = 0
+        self._condition: asyncio.Condition | None = None
+        self._condition_loop: asyncio.AbstractEventLoop | None = None
+        self._blocked_until = 0.0
+        self._min_latency: float | None = None
+        self._latency: float | None = None
+        self._last_decrease = 0.0
+
+        self._request_count = 0
+        self._error_count = 0
+        self._started_at = time.monotonic()
+        self._window_started_at = self._started_at
+        self._window_request_count = 0
+        self._window_error_count = 0
+
+    @classmethod
+    def from_config(
+        cls,
+        initial_limit: int,
+        concurrency_config: ConcurrencyConfig,
+        name: str,
+    ) -> "ConcurrencyController":
+        return cls(
+            initial_limit=initial_limit,
+            min_limit=concurrency_config.min_parallel_requests,
+            max_limit=concurrency_config.max_parallel_requests,
+            decrease_factor=concurrency_config.decrease_factor,
+            latency_tolerance=concurrency_config.latency_tolerance,
+            max_backoff=concurrency_config.max_backoff,
+            log_interval=concurrency_config.log_interval,
+            name=name,
+        )
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _get_condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._condition_loop is not loop:
+            self._condition = asyncio.Condition()
+            self._condition_loop = loop
+        return self._condition
+
+    async def __aenter__(self) -> None:
+        condition = self._get_condition()
+        while True:
+            delay = self._blocked_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            async with condition:
+                if self._blocked_until <= time.monotonic() and self._in_flight < self.limit:
+                    self._in_flight += 1
+                    return
+                await condition.wait()
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        condition = self._get_condition()
+        async with condition:
+            self._in_flight -= 1
+            condition.notify_all()
+
+    async def request(self, create: Callable[[], Awaitable[R]]) -> R:
+        async with self:
+            started_at = time.monotonic()
+            try:
+                response = await create()
+            except Exception as error:
+                self.record_failure(error)
+                raise
+            self.record_success(time.monotonic() - started_at)
+            return response
+
+    def record_success(self, latency: float) -> None:
+        self._request_count += 1
+        self._window_request_count += 1
+        self._min_latency = latency if self._min_latency is None else min(self._min_latency, latency)
+        self._latency = latency if self._latency is None else 0.9 * self._latency + 0.1 * latency
+        if latency <= self._min_latency * self.latency_tolerance:
+            self._limit = min(float(self.max_limit), self._limit + 1.0 / self._limit)
+        self._maybe_log()
+
+    def record_failure(self, error: BaseException) -> None:
+        self._error_count += 1
+        self._window_error_count += 1
+        if _is_overload_error(error):
+            now = time.monotonic()
+            if now - self._last_decrease >= (self._latency or 0.0):
+                self._limit = max(float(self.min_limit), self._limit * self.decrease_factor)
+                self._last_decrease = now
+            retry_after = _retry_after_seconds(error)
+            if retry_after is not None:
+                self._blocked_until = max(self._blocked_until, now + min(retry_after, self.max_backoff))
+        self._maybe_log()
+
+    async def backoff(self, attempt: int, error: BaseException) -> None:
+        delay = _retry_after_seconds(error)
+        if delay is None:
+            ceiling = min(self.max_backoff, 2.0 ** (attempt - 1))
+            delay = ceiling / 2 + random.uniform(0.0, ceiling / 2)
+        await asyncio.sleep(min(delay, self.max_backoff))
+
+    def stats(self) -> dict[str, Any]:
+        elapsed = max(time.monotonic() - self._started_at, 1e-9)
+        return {
+            "concurrency_limit": self.limit,
+            "request_count": self._request_count,
+            "error_count": self._error_count,
+            "throughput_rps": round(self._request_count / elapsed, 3),
+        }
+
+    def _maybe_log(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._window_started_at
+        if elapsed < self.log_interval:
+            return
+        logger.info(
+            "concurrency.stats",
+            name=self.name,
+            concurrency_limit=self.limit,
+            in_flight=self._in_flight,
+            throughput_rps=round(self._window_request_count / elapsed, 3),
+            error_count=self._window_error_count,
+            latency_seconds=round(self._latency or 0.0, 3),
+        )
+        self._window_started_at = now
+        self._window_request_count = 0
+        self._window_error_count = 0
+
+
+def estimate_tokens(texts: list[str]) -> int:
+    return sum(max(1, math.ceil(len(text) / _CHARS_PER_TOKEN)) for text in texts)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: int | None = None, tokens_per_minute: int | None = None) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._request_budget = float(requests_per_minute or 0)
+        self._token_budget = float(tokens_per_minute or 0)
+        self._updated_at = time.monotonic()
+        self._lock: asyncio.Lock | None = None
+        self._lock_loop: asyncio.AbstractEventLoop | None = None
+
+    def tighten(self, requests_per_minute: int | None, tokens_per_minute: int | None) -> None:
+        if requests_per_minute is not None and (
+            self.requests_per_minute is None or requests_per_minute < self.requests_per_minute
+        ):
+            self._request_budget = (
+                float(requests_per_minute)
+                if self.requests_per_minute is None
+                else min(self._request_budget, float(requests_per_minute))
+            )
+            self.requests_per_minute = requests_per_minute
+        if tokens_per_minute is not None and (
+            self.tokens_per_minute is None or tokens_per_minute < self.tokens_per_minute
+        ):
+            self._token_budget = (
+                float(tokens_per_minute)
+                if self.tokens_per_minute is None
+                else min(self._token_budget, float(tokens_per_minute))
+            )
+            self.tokens_per_minute = tokens_per_minute
+
+    def _get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        if self.requests_per_minute is not None:
+            refilled = self._request_budget + elapsed * self.requests_per_minute / 60.0
+            self._request_budget = min(float(self.requests_per_minute), refilled)
+        if self.tokens_per_minute is not None:
+            refilled = self._token_budget + elapsed * self.tokens_per_minute / 60.0
+            self._token_budget = min(float(self.tokens_per_minute), refilled)
+
+    def _wait_seconds(self, tokens: int) -> float:
+        wait = 0.0
+        if self.requests_per_minute is not None:
+            wait = max(wait, (1.0 - self._request_budget) * 60.0 / self.requests_per_minute)
+        if self.tokens_per_minute is not None:
+            wait = max(wait, (tokens - self._token_budget) * 60.0 / self.tokens_per_minute)
+        return wait
+
+    async def acquire(self, tokens: int) -> None:
+        if self.requests_per_minute is None and self.tokens_per_minute is None:
+            return
+        if self.tokens_per_minute is not None:
+            tokens = min(tokens, self.tokens_per_minute)
+
+        async with self._get_lock():
+            while True:
+                self._refill()
+                delay = self._wait_seconds(tokens)
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            if self.requests_per_minute is not None:
+                self._request_budget -= 1.0
+            if self.tokens_per_minute is not None:
+                self._token_budget -= tokens
+
+
+_rate_limiters: dict[str, RateLimiter] = {}
+
+
+def get_rate_limiter(model: str, requests_per_minute: int | None, tokens_per_minute: int | None) -> RateLimiter:
+    limiter = _rate_limiters.get(model)
+    if limiter is None:
+        limiter = RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+        _rate_limiters[model] = limiter
+    else:
+        limiter.tighten(requests_per_minute, tokens_per_minute)
+    return limiter
 
 
 class BasePipeline(ABC, Generic[P, T]):
@@ -23,67 +326,111 @@ class BasePipeline(ABC, Generic[P, T]):
         pipeline_config: T,
         output_dir: Path,
         client: AsyncOpenAI,
+        cache: ApiCache | None = None,
     ) -> None:
         self.config = pipeline_config
         self.output_dir = output_dir
         self.client = client
+        self.cache = cache
+        self.concurrency = ConcurrencyController(initial_limit=1)
+        self.writer = ParquetShardWriter()
+        self.manifest = PartManifest(output_dir)
         self.next_part_index = 0
 
     def _get_next_part_index(self) -> int:
-        pattern = re.compile(r"part-(\d+)\.parquet")
-        indices = []
-        for file in self.output_dir.iterdir():
-            match = pattern.search(file.name)
-            if match:
-                indices.append(int(match.group(1)))
+        self.manifest = PartManifest(self.output_dir)
+        self.manifest.load()
+        return self.manifest.next_part_index()
 
-        return max(indices) + 1 if indices else 0
-
-    def _get_seen_ids(self) -> set[int]:
-        dataset = ds.dataset(self.output_dir, format="parquet")
-        if not dataset.files:
-            return set()
-
-        array = np.asarray(dataset.to_table(columns=["id"]).column("id").to_numpy(), dtype=np.int64)
-        seen_ids = np.unique(array).tolist()
-        return {int(item) for item in seen_ids}
+    def _get_seen_ids(self) -> pa.Array:
+        return self.manifest.seen_ids()
 
     def _check_progress(self, dataset: Dataset, resume: bool) -> Dataset:
         if resume:
             seen_ids = self._get_seen_ids()
-            dataset = dataset.filter(lambda item: item["id"] not in seen_ids)
+            if len(seen_ids):
+                ids = dataset.with_format("arrow")["id"]
+                keep = np.flatnonzero(pc.invert(pc.is_in(ids, value_set=seen_ids)).to_numpy(zero_copy_only=False))
+                if len(keep) != len(dataset):
+                    dataset = dataset.select(keep)
         elif self.next_part_index > 0:
             for file in self.output_dir.glob("part-*.parquet"):
                 file.unlink()
+            self.manifest.clear()
 
         return dataset
 
-    def _get_table(self, write_buffer: list[T]) -> pa.Table:
+    def _append_outputs(self, write_buffer: ArrowWriteBuffer, outputs: Any) -> None:
         raise NotImplementedError
 
     def _flush_buffer(
         self,
-        write_buffer: list[T],
+        write_buffer: ArrowWriteBuffer,
     ) -> None:
-        if not write_buffer:
+        if not len(write_buffer):
             return
 
-        table = self._get_table(write_buffer)
         path = self.output_dir / f"part-{self.next_part_index:04d}.parquet"
-        pq.write_table(
-            table,
-            where=str(path),
-            compression="zstd",
-            use_content_defined_chunking=True,
-            write_page_index=True,
-        )
+        self.writer.submit(write_buffer.to_table(), path, self.manifest)
         self.next_part_index += 1
 
         write_buffer.clear()
 
-    def _check_buffer_size(self, write_buffer: list[T]) -> bool:
+    def _check_buffer_size(self, write_buffer: ArrowWriteBuffer) -> bool:
         raise NotImplementedError
 
+    async def _create_embeddings(self, texts: list[str], model: str, dimensions: int) -> npt.NDArray[np.float32]:
+        keys = [api_cache_key("embeddings", model=model, dimensions=dimensions, input=text) for text in texts]
+        embeddings: dict[str, npt.NDArray[np.float32]] = {}
+        if self.cache is not None:
+            embeddings = {key: decode_embedding(value) for key, value in self.cache.get_many(keys).items()}
+
+        texts_by_key = dict(zip(keys, texts, strict=True))
+        missing_keys = [key for key in texts_by_key if key not in embeddings]
+        if missing_keys:
+            response = await self._request(
+                model,
+                estimate_tokens([texts_by_key[key] for key in missing_keys]),
+                lambda: self.client.embeddings.create(
+                    model=model,
+                    input=[texts_by_key[key] for key in missing_keys],
+                    dimensions=dimensions,
+                )
+            )
+            fetched = {
+                key: np.asarray(item.embedding, dtype=np.float32)
+                for key, item in zip(missing_keys, response.data, strict=True)
+            }
+            if self.cache is not None:
+                self.cache.put_many({key: encode_embedding(embedding) for key, embedding in fetched.items()})
+            embeddings.update(fetched)
+
+        if not keys:
+            return np.empty((0, dimensions), dtype=np.float32)
+        return np.stack([embeddings[key] for key in keys])
+
+    async def _wait_for_rate_limit(self, model: str, tokens: int) -> None:
+        limiter = get_rate_limiter(
+            model,
+            requests_per_minute=getattr(self.config, "requests_per_minute", None),
+            tokens_per_minute=getattr(self.config, "tokens_per_minute", None),
+        )
+        await limiter.acquire(tokens)
+
+    async def _request(self, model: str, tokens: int, create: Callable[[], Awaitable[R]]) -> R:
+        await self._wait_for_rate_limit(model, tokens)
+        return await self.concurrency.request(create)
+
+    def _run_stats(self) -> dict[str, Any]:
+        stats = self.concurrency.stats()
+        if self.cache is not None:
+            stats.update(self.cache.stats())
+        return stats
+
+    def _close_cache(self) -> None:
+        if self.cache is not None:
+            self.cache.close()
+
     async def _close_client(self) -> None:
         if not getattr(self, "_owns_client", False):
             return
@@ -99,7 +446,7 @@ class BasePipeline(ABC, Generic[P, T]):
     async def _wait_one(
         self,
         pending_tasks: set[asyncio.Task[T | None]],
-        write_buffer: list[T],
+        write_buffer: ArrowWriteBuffer,
     ) -> None:
         done, _ = await asyncio.wait(pending_tasks, return_when=asyncio.FIRST_COMPLETED)
         for task in done:
@@ -107,7 +454,7 @@ class BasePipeline(ABC, Generic[P, T]):
             outputs = task.result()
             if outputs is None:
                 continue
-            write_buffer.append(outputs)
+            self._append_outputs(write_buffer, outputs)
             if self._check_buffer_size(write_buffer):
                 self._flush_buffer(write_buffer)
 
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+from src.config import ApiCacheConfig
+from src.paths import DATA_DIR
+
+
+def api_cache_key(kind: str, **payload: Any) -> str:
+    data = json.dumps({"kind": kind, **payload}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def is_cacheable_sampling(temperature: float, seed: int | None) -> bool:
+    return temperature == 0.0 or seed is not None
+
+
+def encode_embedding(embedding: npt.ArrayLike) -> bytes:
+    return np.asarray(embedding, dtype=np.float32).tobytes()
+
+
+def decode_embedding(value: bytes) -> npt.NDArray[np.float32]:
+    return np.frombuffer(value, dtype=np.float32)
+
+
+class ApiCache:
+    def __init__(self, path: Path, max_size_bytes: int = 0) -> None:
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._connection: sqlite3.Connection | None = None
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+        self._size_bytes = self.size_bytes()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(str(self.path), timeout=60.0)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        return self._connection
+
+    @classmethod
+    def from_config(cls, cache_config: ApiCacheConfig) -> "ApiCache | None":
+        if not cache_config.enabled:
+            return None
+        return cls(DATA_DIR / cache_config.path, max_size_bytes=cache_config.max_size_mb * 1024 * 1024)
+
+    def get_many(self, keys: list[str]) -> dict[str, bytes]:
+        connection = self._connect()
+        unique_keys = list(dict.fromkeys(keys))
+        found: dict[str, bytes] = {}
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = connection.execute(
+                f"SELECT key, value FROM entries WHERE key IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            found.update({key: bytes(value) for key, value in rows})
+        if found:
+            now = time.time()
+            with connection:
+                connection.executemany(
+                    "UPDATE entries SET accessed_at = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def get(self, key: str) -> bytes | None:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items: dict[str, bytes]) -> None:
+        if not items:
+            return
+        now = time.time()
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, size, accessed_at) VALUES (?, ?, ?, ?)",
+                [(key, value, len(value), now) for key, value in items.items()],
+            )
+        self._size_bytes += sum(len(value) for value in items.values())
+        self._evict()
+
+    def put(self, key: str, value: bytes) -> None:
+        self.put_many({key: value})
+
+    def size_bytes(self) -> int:
+        row = self._connect().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return int(row[0])
+
+    def _evict(self) -> None:
+        if self.max_size_bytes <= 0 or self._size_bytes <= self.max_size_bytes:
+            return
+        self._size_bytes = self.size_bytes()
+        excess = self._size_bytes - self.max_size_bytes
+        if excess <= 0:
+            return
+        connection = self._connect()
+        keys: list[str] = []
+        for key, size in connection.execute("SELECT key, size FROM entries ORDER BY accessed_at"):
+            keys.append(key)
+            excess -= size
+            self._size_bytes -= size
+            if excess <= 0:
+                break
+        with connection:
+            connection.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in keys])
+        self.evictions += len(keys)
+
+    def stats(self) -> dict[str, int]:
+        return {"cache_hits": self.hits, "cache_misses": self.misses, "cache_evictions": self.evictions}
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
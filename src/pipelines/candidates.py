@@ -1,6 +1,5 @@
 import argparse
 import asyncio
-from collections import defaultdict
 from pathlib import Path
 from typing import Any, cast
 
@@ -14,7 +13,10 @@ from src.config import CandidatesConfig, config
 from src.logging import get_logger
 from src.models import CandidateOutput
 from src.paths import DATA_DIR
-from src.pipelines.base import BasePipeline
+from src.pipelines.base import BasePipeline, ConcurrencyController, estimate_tokens
+from src.pipelines.cache import ApiCache, api_cache_key, is_cacheable_sampling
+from src.pipelines.manifest import PartManifest
+from src.pipelines.writer import ArrowWriteBuffer, ParquetShardWriter
 from src.pipelines.references import ReferencesPipeline
 from src.settings import settings
 from src.templates import environment
@@ -30,6 +32,7 @@ class CandidatesPipeline(BasePipeline):
         client: AsyncOpenAI | None = None,
         base_url: str | None = None,
         api_key: str | None = None,
+        cache: ApiCache | None = None,
     ) -> None:
         self.config = pipeline_config or config.candidates
         self.root_dir = output_dir or DATA_DIR / self.config.hf_config_name
@@ -39,6 +42,14 @@ class CandidatesPipeline(BasePipeline):
             api_key=api_key or settings.OPENAI_API_KEY,
             timeout=self.config.timeout,
         )
+        self.cache = cache or (ApiCache.from_config(config.api_cache) if client is None else None)
+        self.concurrency = ConcurrencyController.from_config(
+            self.config.max_parallel_requests,
+            config.concurrency,
+            name=self.config.hf_config_name,
+        )
+        self.writer = ParquetShardWriter()
+        self.manifest = PartManifest(self.output_dir)
         self.next_part_index = 0
         self.prompt_template = environment.get_template("reference_prompt.j2")
         self.schema = pa.schema(
@@ -50,14 +61,10 @@ class CandidatesPipeline(BasePipeline):
             ]
         )
 
-    def _get_table(self, write_buffer: list[CandidateOutput]) -> pa.Table:
-        output = defaultdict(list)
-        for row in write_buffer:
-            for key, value in row.model_dump().items():
-                output[key].append(value)
-        return pa.Table.from_pydict(output, schema=self.schema)
+    def _append_outputs(self, write_buffer: ArrowWriteBuffer, outputs: CandidateOutput) -> None:
+        write_buffer.append_row(dict(outputs))
 
-    def _check_buffer_size(self, write_buffer: list[CandidateOutput]) -> bool:
+    def _check_buffer_size(self, write_buffer: ArrowWriteBuffer) -> bool:
         return len(write_buffer) >= self.config.shard_size
 
     async def _generate_candidate(
@@ -65,30 +72,44 @@ class CandidatesPipeline(BasePipeline):
         row_id: int,
         keywords: list[str],
         model: str,
-        semaphore: asyncio.Semaphore,
     ) -> CandidateOutput:
         prompt = self.prompt_template.render(keywords=keywords).strip()
-        async with semaphore:
-            for attempt in range(1, self.config.max_retries + 1):
-                try:
-                    completion = await self.client.chat.completions.create(
-                        model=model,
-                        temperature=self.config.temperature,
-                        max_completion_tokens=self.config.max_completion_tokens,
-                        messages=[{"role": "user", "content": prompt}],
-                    )
-                    message = completion.choices[0].message
-                    text = message.content or ""
-                    return CandidateOutput(
-                        id=row_id,
-                        keywords=keywords,
-                        model=model,
-                        text=text,
-                    )
-                except Exception:
-                    if attempt >= self.config.max_retries:
-                        raise
-                    await asyncio.sleep(2 ** (attempt - 1))
+        params: dict[str, Any] = {
+            "model": model,
+            "temperature": self.config.temperature,
+            "max_completion_tokens": self.config.max_completion_tokens,
+            "messages": [{"role": "user", "content": prompt}],
+        }
+        if self.config.seed is not None:
+            params["seed"] = self.config.seed
+        cache = self.cache if is_cacheable_sampling(self.config.temperature, self.config.seed) else None
+        cache_key = api_cache_key("chat.completions", **params)
+        cached = cache.get(cache_key) if cache is not None else None
+        if cached is not None:
+            return CandidateOutput(id=row_id, keywords=keywords, model=model, text=cached.decode("utf-8"))
+
+        request_tokens = estimate_tokens([prompt]) + self.config.max_completion_tokens
+        for attempt in range(1, self.config.max_retries + 1):
+            try:
+                completion = await self._request(
+                    model,
+                    request_tokens,
+                    lambda: self.client.chat.completions.create(**params),
+                )
+                message = completion.choices[0].message
+                text = message.content or ""
+                if cache is not None:
+                    cache.put(cache_key, text.encode("utf-8"))
+                return CandidateOutput(
+                    id=row_id,
+                    keywords=keywords,
+                    model=model,
+                    text=text,
+                )
+            except Exception as error:
+                if attempt >= self.config.max_retries:
+                    raise
+                await self.concurrency.backoff(attempt, error)
 
         msg = "Unexpected generation retry error."
         raise RuntimeError(msg)
@@ -100,45 +121,48 @@ class CandidatesPipeline(BasePipeline):
         resume: bool = False,
     ) -> None:
         self.output_dir.mkdir(parents=True, exist_ok=True)
-        self.next_part_index = self._get_next_part_index()
-
-        dataset = self._check_progress(references, resume)
-
-        write_buffer: list[CandidateOutput] = []
-        semaphore = asyncio.Semaphore(self.config.max_parallel_requests)
-        pending_tasks: set[asyncio.Task[CandidateOutput]] = set()
-
-        for row in tqdm(dataset, desc="Generate candidates"):
-            row = cast("dict[str, Any]", row)
-            pending_tasks.add(
-                asyncio.create_task(
-                    self._generate_candidate(
-                        row_id=cast("int", row["id"]),
-                        keywords=cast("list[str]", row["keywords"]),
-                        model=model,
-                        semaphore=semaphore,
+        try:
+            self.next_part_index = self._get_next_part_index()
+
+            dataset = self._check_progress(references, resume)
+
+            write_buffer = ArrowWriteBuffer(self.schema)
+            pending_tasks: set[asyncio.Task[CandidateOutput]] = set()
+
+            for row in tqdm(dataset, desc="Generate candidates"):
+                row = cast("dict[str, Any]", row)
+                pending_tasks.add(
+                    asyncio.create_task(
+                        self._generate_candidate(
+                            row_id=cast("int", row["id"]),
+                            keywords=cast("list[str]", row["keywords"]),
+                            model=model,
+                        )
                     )
                 )
-            )
-            if len(pending_tasks) >= self.config.max_parallel_requests:
+                if len(pending_tasks) >= self.concurrency.limit:
+                    await self._wait_one(
+                        pending_tasks=cast("set[asyncio.Task[CandidateOutput | None]]", pending_tasks),
+                        write_buffer=write_buffer,
+                    )
+
+            while pending_tasks:
                 await self._wait_one(
                     pending_tasks=cast("set[asyncio.Task[CandidateOutput | None]]", pending_tasks),
-                    write_buffer=cast("list[CandidateOutput]", write_buffer),
+                    write_buffer=write_buffer,
                 )
 
-        while pending_tasks:
-            await self._wait_one(
-                pending_tasks=cast("set[asyncio.Task[CandidateOutput | None]]", pending_tasks),
-                write_buffer=cast("list[CandidateOutput]", write_buffer),
-            )
+            self._flush_buffer(write_buffer)
 
-        self._flush_buffer(write_buffer)
-
-        logger.info(
-            "run.done",
-            output_dir=str(self.output_dir),
-            model=model,
-        )
+            logger.info(
+                "run.done",
+                output_dir=str(self.output_dir),
+                model=model,
+                **self._run_stats(),
+            )
+        finally:
+            self._close_cache()
+            self.writer.close()
 
     def build(
         self,
@@ -1,5 +1,4 @@
 import asyncio
-from collections import defaultdict
 from pathlib import Path
 from typing import Any, cast
 
@@ -12,9 +11,12 @@ from tqdm.auto import tqdm
 
 from src.config import EmbeddingsConfig, config
 from src.logging import get_logger
-from src.models import EmbeddingsInputs, EmbeddingsOutputs
+from src.models import EmbeddingsInputs
 from src.paths import DATA_DIR
-from src.pipelines.base import BasePipeline
+from src.pipelines.base import BasePipeline, ConcurrencyController
+from src.pipelines.cache import ApiCache
+from src.pipelines.manifest import PartManifest
+from src.pipelines.writer import ArrowWriteBuffer, ParquetShardWriter
 from src.pipelines.jokes import JokesPipeline
 from src.settings import settings
 
@@ -29,6 +31,7 @@ class EmbeddingsPipeline(BasePipeline):
         pipeline_config: EmbeddingsConfig | None = None,
         output_dir: Path | None = None,
         client: AsyncOpenAI | None = None,
+        cache: ApiCache | None = None,
     ) -> None:
         self.config = pipeline_config or config.embeddings
         self.output_dir = output_dir or DATA_DIR / self.config.hf_config_name
@@ -38,6 +41,14 @@ class EmbeddingsPipeline(BasePipeline):
             api_key=settings.OPENAI_API_KEY,
             timeout=self.config.timeout,
         )
+        self.cache = cache or (ApiCache.from_config(config.api_cache) if client is None else None)
+        self.concurrency = ConcurrencyController.from_config(
+            self.config.max_parallel_requests,
+            config.concurrency,
+            name=self.config.hf_config_name,
+        )
+        self.writer = ParquetShardWriter()
+        self.manifest = PartManifest(self.output_dir)
         self.next_part_index = 0
 
         self.schema = pa.schema(
@@ -50,56 +61,47 @@ class EmbeddingsPipeline(BasePipeline):
     async def _embed_jokes(
         self,
         batch: EmbeddingsInputs,
-        semaphore: asyncio.Semaphore,
-    ) -> EmbeddingsOutputs | None:
-        async with semaphore:
-            filtered_pairs = [
-                (item_id, text.strip()) for item_id, text in zip(batch.id, batch.text, strict=True) if text.strip()
-            ]
-            if not filtered_pairs:
-                return None
-            filtered_ids = [item_id for item_id, _ in filtered_pairs]
-            filtered_texts = [text for _, text in filtered_pairs]
-
-            for attempt in range(1, self.config.max_retries + 1):
-                try:
-                    response = await self.client.embeddings.create(
-                        model=self.config.model,
-                        input=filtered_texts,
-                        dimensions=self.config.dimensions,
-                    )
-
-                    embeddings = []
-                    for item in response.data:
-                        embedding = np.asarray(item.embedding, dtype=np.float32)
-                        np.nan_to_num(embedding, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
-                        np.clip(embedding, -_EMBEDDING_VALUE_LIMIT, _EMBEDDING_VALUE_LIMIT, out=embedding)
-                        embeddings.append(embedding.tolist())
-
-                    outputs = EmbeddingsOutputs(
-                        id=filtered_ids,
-                        embedding=embeddings,
-                    )
-                except Exception:
-                    if attempt >= self.config.max_retries:
-                        raise
-                    await asyncio.sleep(2 ** (attempt - 1))
-                else:
-                    return outputs
+    ) -> pa.RecordBatch | None:
+        filtered_pairs = [
+            (item_id, text.strip()) for item_id, text in zip(batch.id, batch.text, strict=True) if text.strip()
+        ]
+        if not filtered_pairs:
+            return None
+        filtered_ids = [item_id for item_id, _ in filtered_pairs]
+        filtered_texts = [text for _, text in filtered_pairs]
+
+        for attempt in range(1, self.config.max_retries + 1):
+            try:
+                embeddings = await self._create_embeddings(
+                    filtered_texts,
+                    model=self.config.model,
+                    dimensions=self.config.dimensions,
+                )
+                np.nan_to_num(embeddings, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+                np.clip(embeddings, -_EMBEDDING_VALUE_LIMIT, _EMBEDDING_VALUE_LIMIT, out=embeddings)
+
+                outputs = pa.RecordBatch.from_arrays(
+                    [
+                        pa.array(filtered_ids, type=pa.int64()),
+                        pa.FixedSizeListArray.from_arrays(embeddings.reshape(-1), self.config.dimensions),
+                    ],
+                    schema=self.schema,
+                )
+            except Exception as error:
+                if attempt >= self.config.max_retries:
+                    raise
+                await self.concurrency.backoff(attempt, error)
+            else:
+                return outputs
 
         msg = "Unexpected retry error"
         raise RuntimeError(msg)
 
-    def _get_table(self, write_buffer: list[EmbeddingsOutputs]) -> pa.Table:
-        outputs = defaultdict(list)
-        for batch in write_buffer:
-            for key, value in batch.model_dump().items():
-                outputs[key].extend(value)
-
-        return pa.Table.from_pydict(outputs, schema=self.schema)
+    def _append_outputs(self, write_buffer: ArrowWriteBuffer, outputs: pa.RecordBatch) -> None:
+        write_buffer.append_batch(outputs)
 
-    def _check_buffer_size(self, write_buffer: list[EmbeddingsOutputs]) -> bool:
-        return sum(len(batch.id) for batch in write_buffer) >= self.config.shard_size
+    def _check_buffer_size(self, write_buffer: ArrowWriteBuffer) -> bool:
+        return len(write_buffer) >= self.config.shard_size
 
     async def run(
         self,
@@ -114,18 +116,17 @@ class EmbeddingsPipeline(BasePipeline):
 
             dataset = dataset.batch(self.config.batch_size)
 
-            write_buffer: list[EmbeddingsOutputs] = []
-            semaphore = asyncio.Semaphore(self.config.max_parallel_requests)
-            pending_tasks: set[asyncio.Task[EmbeddingsOutputs | None]] = set()
+            write_buffer = ArrowWriteBuffer(self.schema)
+            pending_tasks: set[asyncio.Task[pa.RecordBatch | None]] = set()
 
             for batch in tqdm(dataset):
                 batch = cast("dict[str, list[Any]]", batch)
                 inputs = EmbeddingsInputs(id=batch["id"], text=batch["text"])
 
-                task = asyncio.create_task(self._embed_jokes(inputs, semaphore))
+                task = asyncio.create_task(self._embed_jokes(inputs))
                 pending_tasks.add(task)
 
-                if len(pending_tasks) >= self.config.max_parallel_requests:
+                if len(pending_tasks) >= self.concurrency.limit:
                     await self._wait_one(
                         pending_tasks=pending_tasks,
                         write_buffer=write_buffer,
@@ -143,9 +144,12 @@ class EmbeddingsPipeline(BasePipeline):
                 "run.done",
                 model=self.config.model,
                 output_dir=str(self.output_dir),
+                **self._run_stats(),
             )
         finally:
             await self._close_client()
+            self._close_cache()
+            self.writer.close()
 
     def build(
         self,
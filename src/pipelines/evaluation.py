@@ -16,7 +16,10 @@ from src.config import EvaluationConfig, config
 from src.logging import get_logger
 from src.models import EvaluationCandidate, EvaluationJudgeDecision, EvaluationOutputs, EvaluationPair
 from src.paths import DATA_DIR
-from src.pipelines.base import BasePipeline
+from src.pipelines.base import BasePipeline, ConcurrencyController, estimate_tokens
+from src.pipelines.cache import ApiCache, api_cache_key, is_cacheable_sampling
+from src.pipelines.manifest import PartManifest
+from src.pipelines.writer import ArrowWriteBuffer, ParquetShardWriter, write_parquet_atomic
 from src.settings import settings
 from src.templates import environment
 
@@ -30,6 +33,7 @@ class EvaluationPipeline(BasePipeline):
         output_dir: Path | None = None,
         client: AsyncOpenAI | None = None,
         leaderboard_dir: Path | None = None,
+        cache: ApiCache | None = None,
     ) -> None:
         self.config = pipeline_config or config.evaluation
         base_output_dir = output_dir or DATA_DIR
@@ -40,6 +44,14 @@ class EvaluationPipeline(BasePipeline):
             api_key=settings.OPENAI_API_KEY,
             timeout=self.config.timeout,
         )
+        self.cache = cache or (ApiCache.from_config(config.api_cache) if client is None else None)
+        self.concurrency = ConcurrencyController.from_config(
+            self.config.max_parallel_requests,
+            config.concurrency,
+            name=self.config.hf_config_name,
+        )
+        self.writer = ParquetShardWriter()
+        self.manifest = PartManifest(self.output_dir)
         self.next_part_index = 0
 
         self.prompt_template = environment.get_template("reference_prompt.j2")
@@ -119,15 +131,11 @@ class EvaluationPipeline(BasePipeline):
 
         return {model: float(np.log(strengths[index[model]])) for model in models}
 
-    def _get_table(self, write_buffer: list[EvaluationOutputs]) -> pa.Table:
-        output = defaultdict(list)
-        for batch in write_buffer:
-            for key, value in batch.model_dump().items():
-                output[key].extend(value)
-        return pa.Table.from_pydict(output, schema=self.schema)
+    def _append_outputs(self, write_buffer: ArrowWriteBuffer, outputs: EvaluationOutputs) -> None:
+        write_buffer.append_columns(dict(outputs))
 
-    def _check_buffer_size(self, write_buffer: list[EvaluationOutputs]) -> bool:
-        return sum(len(batch.id) for batch in write_buffer) >= self.config.shard_size
+    def _check_buffer_size(self, write_buffer: ArrowWriteBuffer) -> bool:
+        return len(write_buffer) >= self.config.shard_size
 
     def _collect_candidates_per_reference(
         self,
@@ -249,13 +257,8 @@ class EvaluationPipeline(BasePipeline):
             chunk = rows[start : start + self.config.shard_size]
             table = pa.Table.from_pylist(chunk, schema=self.schema)
             path = self.output_dir / f"part-{self.next_part_index:04d}.parquet"
-            pq.write_table(
-                table,
-                where=str(path),
-                compression="zstd",
-                use_content_defined_chunking=True,
-                write_page_index=True,
-            )
+            write_parquet_atomic(table, path)
+            self.manifest.record(path, table)
             self.next_part_index += 1
 
     def _to_existing_rows_frame(self, rows: list[dict[str, Any]]) -> pl.DataFrame:
@@ -304,49 +307,70 @@ class EvaluationPipeline(BasePipeline):
         retained_rows = valid_rows.sort("id").to_dicts()
         return cast("list[dict[str, Any]]", retained_rows)
 
-    async def _judge_pair(self, pair: EvaluationPair, semaphore: asyncio.Semaphore) -> EvaluationOutputs:
+    async def _judge_pair(self, pair: EvaluationPair) -> EvaluationOutputs:
         system_prompt = self.system_template.render().strip()
         user_prompt = self.user_template.render(
             prompt=pair.prompt,
             left_text=pair.left_text,
             right_text=pair.right_text,
         ).strip()
-
-        async with semaphore:
-            for attempt in range(1, self.config.max_retries + 1):
-                try:
-                    completion = await self.client.chat.completions.parse(
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ]
+        cache = self.cache if is_cacheable_sampling(self.config.judge_temperature, None) else None
+        cache_key = api_cache_key(
+            "chat.completions.parse",
+            model=self.config.model,
+            temperature=self.config.judge_temperature,
+            messages=messages,
+            response_format=EvaluationJudgeDecision.model_json_schema(),
+        )
+        cached = cache.get(cache_key) if cache is not None else None
+        if cached is not None:
+            return self._judge_outputs(pair, EvaluationJudgeDecision.model_validate_json(cached))
+
+        for attempt in range(1, self.config.max_retries + 1):
+            try:
+                completion = await self._request(
+                    self.config.model,
+                    estimate_tokens([system_prompt, user_prompt]),
+                    lambda: self.client.chat.completions.parse(
                         model=self.config.model,
                         temperature=self.config.judge_temperature,
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": user_prompt},
-                        ],
+                        messages=messages,
                         response_format=EvaluationJudgeDecision,
                     )
-                    message = completion.choices[0].message
-                    parsed = message.parsed
-                    if parsed is None:
-                        msg = "No parsed response in completion message."
-                        raise ValueError(msg)
-                    return EvaluationOutputs(
-                        id=[pair.id],
-                        reference_id=[pair.reference_id],
-                        prompt=[pair.prompt],
-                        left_model=[pair.left_model],
-                        right_model=[pair.right_model],
-                        left_text=[pair.left_text],
-                        right_text=[pair.right_text],
-                        winner=[parsed.winner],
-                    )
-                except Exception:
-                    if attempt >= self.config.max_retries:
-                        raise
-                    await asyncio.sleep(2 ** (attempt - 1))
+                )
+                message = completion.choices[0].message
+                parsed = message.parsed
+                if parsed is None:
+                    msg = "No parsed response in completion message."
+                    raise ValueError(msg)
+                if cache is not None:
+                    cache.put(cache_key, parsed.model_dump_json().encode("utf-8"))
+                return self._judge_outputs(pair, parsed)
+            except Exception as error:
+                if attempt >= self.config.max_retries:
+                    raise
+                await self.concurrency.backoff(attempt, error)
 
         msg = "Unexpected judge retry branch."
         raise RuntimeError(msg)
 
+    @staticmethod
+    def _judge_outputs(pair: EvaluationPair, parsed: EvaluationJudgeDecision) -> EvaluationOutputs:
+        return EvaluationOutputs(
+            id=[pair.id],
+            reference_id=[pair.reference_id],
+            prompt=[pair.prompt],
+            left_model=[pair.left_model],
+            right_model=[pair.right_model],
+            left_text=[pair.left_text],
+            right_text=[pair.right_text],
+            winner=[parsed.winner],
+        )
+
     def calculate_leaderboard(self, rows: list[dict[str, Any]]) -> None:
         self.leaderboard_dir.mkdir(parents=True, exist_ok=True)
 
@@ -408,51 +432,57 @@ class EvaluationPipeline(BasePipeline):
 
     async def run(self, candidates: Dataset, resume: bool = False) -> None:
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            candidates_per_reference = self._collect_candidates_per_reference(candidates)
+            pairs = self._build_pairs(candidates_per_reference)
+            existing_rows = self._read_evaluation_rows() if resume else []
+            retained_rows = self._filter_rows_for_resume(existing_rows=existing_rows, pairs=pairs) if resume else []
+
+            if not resume:
+                self._unlink_parts(self.output_dir)
+                self.manifest.clear()
+                self.next_part_index = 0
+            elif len(existing_rows) != len(retained_rows):
+                self._unlink_parts(self.output_dir)
+                self.manifest.clear()
+                self.next_part_index = 0
+                self._write_rows_to_evaluation_parts(retained_rows)
+            else:
+                self.next_part_index = self._get_next_part_index()
+
+            seen_ids = {cast("int", row["id"]) for row in retained_rows}
+            write_buffer = ArrowWriteBuffer(self.schema)
+            pending_tasks: set[asyncio.Task[EvaluationOutputs]] = set()
+
+            for pair in tqdm(pairs, desc="Evaluate pairs"):
+                if pair.id in seen_ids:
+                    continue
+                pending_tasks.add(asyncio.create_task(self._judge_pair(pair=pair)))
+                if len(pending_tasks) >= self.concurrency.limit:
+                    await self._wait_one(
+                        pending_tasks=cast("set[asyncio.Task[EvaluationOutputs | None]]", pending_tasks),
+                        write_buffer=write_buffer,
+                    )
 
-        candidates_per_reference = self._collect_candidates_per_reference(candidates)
-        pairs = self._build_pairs(candidates_per_reference)
-        existing_rows = self._read_evaluation_rows() if resume else []
-        retained_rows = self._filter_rows_for_resume(existing_rows=existing_rows, pairs=pairs) if resume else []
-
-        if not resume:
-            self._unlink_parts(self.output_dir)
-            self.next_part_index = 0
-        elif len(existing_rows) != len(retained_rows):
-            self._unlink_parts(self.output_dir)
-            self.next_part_index = 0
-            self._write_rows_to_evaluation_parts(retained_rows)
-        else:
-            self.next_part_index = self._get_next_part_index()
-
-        seen_ids = {cast("int", row["id"]) for row in retained_rows}
-        write_buffer: list[EvaluationOutputs] = []
-        semaphore = asyncio.Semaphore(self.config.max_parallel_requests)
-        pending_tasks: set[asyncio.Task[EvaluationOutputs]] = set()
-
-        for pair in tqdm(pairs, desc="Evaluate pairs"):
-            if pair.id in seen_ids:
-                continue
-            pending_tasks.add(asyncio.create_task(self._judge_pair(pair=pair, semaphore=semaphore)))
-            if len(pending_tasks) >= self.config.max_parallel_requests:
+            while pending_tasks:
                 await self._wait_one(
                     pending_tasks=cast("set[asyncio.Task[EvaluationOutputs | None]]", pending_tasks),
                     write_buffer=write_buffer,
                 )
 
-        while pending_tasks:
-            await self._wait_one(
-                pending_tasks=cast("set[asyncio.Task[EvaluationOutputs | None]]", pending_tasks),
-                write_buffer=write_buffer,
+            self._flush_buffer(write_buffer)
+            self.writer.close()
+            all_rows = self._read_evaluation_rows()
+            self.calculate_leaderboard(rows=all_rows)
+            logger.info(
+                "run.done",
+                output_dir=str(self.output_dir),
+                pair_count=len(all_rows),
+                **self._run_stats(),
             )
-
-        self._flush_buffer(write_buffer)
-        all_rows = self._read_evaluation_rows()
-        self.calculate_leaderboard(rows=all_rows)
-        logger.info(
-            "run.done",
-            output_dir=str(self.output_dir),
-            pair_count=len(all_rows),
-        )
+        finally:
+            self._close_cache()
+            self.writer.close()
 
     def build(
         self,
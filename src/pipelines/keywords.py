@@ -17,7 +17,10 @@ from src.config import KeywordsConfig, config
 from src.logging import get_logger
 from src.models import KeywordsInputs, KeywordsOutputs
 from src.paths import DATA_DIR
-from src.pipelines.base import BasePipeline
+from src.pipelines.base import BasePipeline, ConcurrencyController
+from src.pipelines.cache import ApiCache
+from src.pipelines.manifest import PartManifest
+from src.pipelines.writer import ArrowWriteBuffer, ParquetShardWriter
 from src.pipelines.embeddings import EmbeddingsPipeline
 from src.pipelines.jokes import JokesPipeline
 from src.settings import settings
@@ -101,6 +104,7 @@ class KeywordsPipeline(BasePipeline):
         pipeline_config: KeywordsConfig | None = None,
         output_dir: Path | None = None,
         client: AsyncOpenAI | None = None,
+        cache: ApiCache | None = None,
     ) -> None:
         self.config = pipeline_config or config.keywords
         self.output_dir = output_dir or DATA_DIR / self.config.hf_config_name
@@ -110,6 +114,14 @@ class KeywordsPipeline(BasePipeline):
             api_key=settings.OPENAI_API_KEY,
             timeout=self.config.timeout,
         )
+        self.cache = cache or (ApiCache.from_config(config.api_cache) if client is None else None)
+        self.concurrency = ConcurrencyController.from_config(
+            self.config.max_parallel_requests,
+            config.concurrency,
+            name=self.config.hf_config_name,
+        )
+        self.writer = ParquetShardWriter()
+        self.manifest = PartManifest(self.output_dir)
         self.next_part_index = 0
         self.query_template = environment.get_template("keyword_query.j2")
 
@@ -139,73 +151,71 @@ class KeywordsPipeline(BasePipeline):
 
         return [candidate for candidate, _ in candidate_counts.most_common(self.config.max_candidates) if candidate]
 
-    async def _embed_batch(self, batch: list[str]) -> list[list[float]]:
+    async def _embed_batch(self, batch: list[str]) -> npt.NDArray[np.float32]:
         queries = [self.query_template.render(keyword=text).strip() for text in batch]
         for attempt in range(1, self.config.max_retries + 1):
             try:
-                response = await self.client.embeddings.create(
+                embeddings = await self._create_embeddings(
+                    queries,
                     model=self.config.model,
-                    input=queries,
                     dimensions=self.config.dimensions,
                 )
-                embeddings = [item.embedding for item in response.data]
-            except Exception:
+            except Exception as error:
                 if attempt >= self.config.max_retries:
                     raise
-                await asyncio.sleep(2 ** (attempt - 1))
+                await self.concurrency.backoff(attempt, error)
             else:
                 return embeddings
 
         msg = "Unexpected retry error."
         raise RuntimeError(msg)
 
-    async def _embed_texts(self, texts: list[str]) -> list[list[float]]:
-        embeddings: list[list[float]] = []
-        for batch in batched(texts, self.config.batch_size, strict=False):
-            embeddings.extend(await self._embed_batch(list(batch)))
-        return embeddings
+    async def _embed_texts(self, texts: list[str]) -> npt.NDArray[np.float32]:
+        embeddings = [
+            await self._embed_batch(list(batch)) for batch in batched(texts, self.config.batch_size, strict=False)
+        ]
+        if not embeddings:
+            return np.empty((0, self.config.dimensions), dtype=np.float32)
+        return np.concatenate(embeddings)
 
     async def _extract_keywords(
         self,
         inputs: KeywordsInputs,
-        semaphore: asyncio.Semaphore,
     ) -> KeywordsOutputs | None:
-        async with semaphore:
-            candidates = self._extract_candidates(inputs.text)
-            if not candidates:
-                return None
+        candidates = self._extract_candidates(inputs.text)
+        if not candidates:
+            return None
 
-            candidate_embeddings = await self._embed_texts(candidates)
+        candidate_embeddings = await self._embed_texts(candidates)
 
-            candidate_embeddings = _sanitize_embedding_array(candidate_embeddings)
-            joke_embedding = _sanitize_embedding_array(inputs.embedding)
+        candidate_embeddings = _sanitize_embedding_array(candidate_embeddings)
+        joke_embedding = _sanitize_embedding_array(inputs.embedding)
 
-            relevance_scores = _cosine_relevance_scores(
-                joke_embedding=joke_embedding,
-                candidate_embeddings=candidate_embeddings,
-            )
-            selected_indices = _select_top_indices_with_mmr(
-                candidate_embeddings=candidate_embeddings,
-                relevance_scores=relevance_scores,
-                top_n=self.config.top_n,
-                diversity=self.config.mmr_diversity,
-            )
+        relevance_scores = _cosine_relevance_scores(
+            joke_embedding=joke_embedding,
+            candidate_embeddings=candidate_embeddings,
+        )
+        selected_indices = _select_top_indices_with_mmr(
+            candidate_embeddings=candidate_embeddings,
+            relevance_scores=relevance_scores,
+            top_n=self.config.top_n,
+            diversity=self.config.mmr_diversity,
+        )
 
-            keywords = []
-            scores = []
-            for index in selected_indices.tolist():
-                keywords.append(candidates[index])
-                scores.append(relevance_scores[index])
+        keywords = []
+        scores = []
+        for index in selected_indices.tolist():
+            keywords.append(candidates[index])
+            scores.append(relevance_scores[index])
 
-            if not keywords:
-                return None
-            return KeywordsOutputs(id=inputs.id, keywords=keywords, scores=scores)
+        if not keywords:
+            return None
+        return KeywordsOutputs(id=inputs.id, keywords=keywords, scores=scores)
 
-    def _get_table(self, write_buffer: list[KeywordsOutputs]) -> pa.Table:
-        outputs = [item.model_dump() for item in write_buffer]
-        return pa.Table.from_pylist(outputs, schema=self.schema)
+    def _append_outputs(self, write_buffer: ArrowWriteBuffer, outputs: KeywordsOutputs) -> None:
+        write_buffer.append_row(dict(outputs))
 
-    def _check_buffer_size(self, write_buffer: list[KeywordsOutputs]) -> bool:
+    def _check_buffer_size(self, write_buffer: ArrowWriteBuffer) -> bool:
         return len(write_buffer) >= self.config.shard_size
 
     async def run(
@@ -225,8 +235,7 @@ class KeywordsPipeline(BasePipeline):
 
             dataset = self._check_progress(dataset, resume)
 
-            write_buffer: list[KeywordsOutputs] = []
-            semaphore = asyncio.Semaphore(self.config.max_parallel_requests)
+            write_buffer = ArrowWriteBuffer(self.schema)
             pending_tasks: set[asyncio.Task[KeywordsOutputs | None]] = set()
 
             for item in tqdm(dataset):
@@ -237,10 +246,10 @@ class KeywordsPipeline(BasePipeline):
                     embedding=item["embedding"],
                 )
 
-                task = asyncio.create_task(self._extract_keywords(inputs=inputs, semaphore=semaphore))
+                task = asyncio.create_task(self._extract_keywords(inputs=inputs))
                 pending_tasks.add(task)
 
-                if len(pending_tasks) >= self.config.max_parallel_requests:
+                if len(pending_tasks) >= self.concurrency.limit:
                     await self._wait_one(
                         pending_tasks=pending_tasks,
                         write_buffer=write_buffer,
@@ -260,9 +269,12 @@ class KeywordsPipeline(BasePipeline):
                 "run.done",
                 model=self.config.model,
                 output_dir=str(self.output_dir),
+                **self._run_stats(),
             )
         finally:
             await self._close_client()
+            self._close_cache()
+            self.writer.close()
 
     def build(
         self,
@@ -0,0 +1,87 @@
+import base64
+import json
+import os
+import re
+import threading
+import zlib
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MANIFEST_NAME = ".manifest.json"
+PART_PATTERN = re.compile(r"^part-(\d+)\.parquet$")
+
+
+def encode_id_bitmap(ids: npt.NDArray[np.int64]) -> dict[str, Any]:
+    if not len(ids):
+        return {"num_rows": 0, "min_id": None, "max_id": None, "bitmap": ""}
+    min_id = int(ids.min())
+    max_id = int(ids.max())
+    bits = np.zeros(max_id - min_id + 1, dtype=np.bool_)
+    bits[ids - min_id] = True
+    bitmap = base64.b64encode(zlib.compress(np.packbits(bits).tobytes())).decode("ascii")
+    return {"num_rows": len(ids), "min_id": min_id, "max_id": max_id, "bitmap": bitmap}
+
+
+def decode_id_bitmap(entry: dict[str, Any]) -> npt.NDArray[np.int64]:
+    if entry["min_id"] is None:
+        return np.empty(0, dtype=np.int64)
+    span = entry["max_id"] - entry["min_id"] + 1
+    packed = np.frombuffer(zlib.decompress(base64.b64decode(entry["bitmap"])), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(packed, count=span)).astype(np.int64) + entry["min_id"]
+
+
+class PartManifest:
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self.path = directory / MANIFEST_NAME
+        self.parts: dict[str, dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        with self._lock:
+            self.parts = json.loads(self.path.read_text(encoding="utf-8"))["parts"] if self.path.exists() else {}
+            on_disk = {path.name for path in self.directory.glob("part-*.parquet") if PART_PATTERN.match(path.name)}
+            stale = [name for name in self.parts if name not in on_disk]
+            unlisted = sorted(on_disk - self.parts.keys())
+            for name in stale:
+                del self.parts[name]
+            for name in unlisted:
+                ids = pq.read_table(self.directory / name, columns=["id"]).column("id").to_numpy()
+                self.parts[name] = encode_id_bitmap(np.asarray(ids, dtype=np.int64))
+            if stale or unlisted:
+                self._save()
+
+    def record(self, path: Path, table: pa.Table) -> None:
+        ids = np.asarray(table.column("id").to_numpy(), dtype=np.int64)
+        entry = encode_id_bitmap(ids)
+        with self._lock:
+            self.parts[path.name] = entry
+            self._save()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.parts = {}
+            self.path.unlink(missing_ok=True)
+
+    def next_part_index(self) -> int:
+        indices = [int(match.group(1)) for name in self.parts if (match := PART_PATTERN.match(name))]
+        return max(indices) + 1 if indices else 0
+
+    def seen_ids(self) -> pa.Array:
+        arrays = [decode_id_bitmap(entry) for entry in self.parts.values()]
+        if not arrays:
+            return pa.array([], type=pa.int64())
+        return pa.array(np.unique(np.concatenate(arrays)))
+
+    def _save(self) -> None:
+        staging_path = self.path.with_name(f"{self.path.name}.tmp")
+        try:
+            staging_path.write_text(json.dumps({"parts": self.parts}), encoding="utf-8")
+            os.replace(staging_path, self.path)
+        finally:
+            staging_path.unlink(missing_ok=True)
@@ -1,7 +1,6 @@
 import asyncio
 import json
 import math
-from collections import defaultdict
 from itertools import batched, combinations
 from pathlib import Path
 from typing import Any, cast
@@ -11,7 +10,6 @@ import numpy as np
 import numpy.typing as npt
 import polars as pl
 import pyarrow as pa
-import pyarrow.parquet as pq
 from datasets import Dataset, load_dataset
 from huggingface_hub import HfApi
 from openai import AsyncOpenAI
@@ -21,7 +19,10 @@ from src.config import ReferencesConfig, config
 from src.logging import get_logger
 from src.models import ReferencesInputs, ReferencesOutputs
 from src.paths import DATA_DIR
-from src.pipelines.base import BasePipeline
+from src.pipelines.base import BasePipeline, ConcurrencyController
+from src.pipelines.cache import ApiCache
+from src.pipelines.manifest import PartManifest
+from src.pipelines.writer import ArrowWriteBuffer, ParquetShardWriter, write_parquet_atomic
 from src.pipelines.embeddings import EmbeddingsPipeline
 from src.pipelines.jokes import JokesPipeline
 from src.pipelines.keywords import KeywordsPipeline
@@ -41,6 +42,7 @@ class ReferencesPipeline(BasePipeline):
         pipeline_config: ReferencesConfig | None = None,
         output_dir: Path | None = None,
         client: AsyncOpenAI | None = None,
+        cache: ApiCache | None = None,
     ) -> None:
         self.config = pipeline_config or config.references
         if self.config.min_keywords > self.config.max_keywords:
@@ -56,6 +58,14 @@ class ReferencesPipeline(BasePipeline):
             api_key=settings.OPENAI_API_KEY,
             timeout=self.config.timeout,
         )
+        self.cache = cache or (ApiCache.from_config(config.api_cache) if client is None else None)
+        self.concurrency = ConcurrencyController.from_config(
+            self.config.max_parallel_requests,
+            config.concurrency,
+            name=self.config.hf_config_name,
+        )
+        self.writer = ParquetShardWriter()
+        self.manifest = PartManifest(self.output_dir)
         self.next_part_index = 0
 
         self.index_dir = DATA_DIR / self.config.index_dirname
@@ -85,15 +95,11 @@ class ReferencesPipeline(BasePipeline):
         valid_mask = np.isfinite(norms) & (norms > 0)
         vectors[valid_mask] = vectors[valid_mask] / norms[valid_mask, np.newaxis]
 
-    def _get_table(self, write_buffer: list[ReferencesOutputs]) -> pa.Table:
-        outputs = defaultdict(list)
-        for batch in write_buffer:
-            for key, value in batch.model_dump().items():
-                outputs[key].extend(value)
-        return pa.Table.from_pydict(outputs, schema=self.schema)
+    def _append_outputs(self, write_buffer: ArrowWriteBuffer, outputs: ReferencesOutputs) -> None:
+        write_buffer.append_columns(dict(outputs))
 
-    def _check_buffer_size(self, write_buffer: list[ReferencesOutputs]) -> bool:
-        return sum(len(batch.id) for batch in write_buffer) >= self.config.shard_size
+    def _check_buffer_size(self, write_buffer: ArrowWriteBuffer) -> bool:
+        return len(write_buffer) >= self.config.shard_size
 
     def _build_keyword_groups(self, keywords: list[str]) -> list[list[str]]:
         cleaned_keywords = []
@@ -120,25 +126,26 @@ class ReferencesPipeline(BasePipeline):
         if not prompts:
             return np.empty((0, self.config.dimensions), dtype=np.float32)
 
-        embeddings: list[list[float]] = []
+        embeddings: list[npt.NDArray[np.float32]] = []
         for prompt_batch in batched(prompts, self.config.output_batch_size, strict=False):
             formatted_queries = [self.query_template.render(prompt=prompt).strip() for prompt in prompt_batch]
             for attempt in range(1, self.config.max_retries + 1):
                 try:
-                    response = await self.client.embeddings.create(
-                        model=self.config.model,
-                        input=formatted_queries,
-                        dimensions=self.config.dimensions,
+                    embeddings.append(
+                        await self._create_embeddings(
+                            formatted_queries,
+                            model=self.config.model,
+                            dimensions=self.config.dimensions,
+                        )
                     )
-                    embeddings.extend([item.embedding for item in response.data])
-                except Exception:
+                except Exception as error:
                     if attempt >= self.config.max_retries:
                         raise
-                    await asyncio.sleep(2 ** (attempt - 1))
+                    await self.concurrency.backoff(attempt, error)
                 else:
                     break
 
-        return np.asarray(embeddings, dtype=np.float32)
+        return np.concatenate(embeddings)
 
     def _sample_training_vectors(self, embeddings: Dataset, sample_size: int) -> np.ndarray:
         reservoir = np.empty((sample_size, self.config.dimensions), dtype=np.float32)
@@ -323,69 +330,67 @@ class ReferencesPipeline(BasePipeline):
     async def _retrieve_references(
         self,
         inputs: ReferencesInputs,
-        semaphore: asyncio.Semaphore,
         faiss_index: faiss.IndexIVFFlat,
         jokes_mapping: dict[int, str],
     ) -> ReferencesOutputs | None:
-        async with semaphore:
-            expanded_ids: list[int] = []
-            expanded_keywords: list[list[str]] = []
-            expanded_prompts: list[str] = []
-
-            for row_id, keywords in zip(inputs.id, inputs.keywords, strict=True):
-                keyword_groups = self._build_keyword_groups(keywords)
-                for group in keyword_groups:
-                    prompt = self.prompt_template.render(keywords=group).strip()
-                    expanded_ids.append(row_id)
-                    expanded_keywords.append(group)
-                    expanded_prompts.append(prompt)
-
-            if not expanded_prompts:
-                return None
-
-            query_vectors = await self._embed_batch(expanded_prompts)
-            self._normalize_vectors(query_vectors)
-
-            candidate_ids_batch, candidate_scores_batch, candidate_mask_batch = self._search_batch(
-                query_vectors=query_vectors,
-                faiss_index=faiss_index,
-            )
+        expanded_ids: list[int] = []
+        expanded_keywords: list[list[str]] = []
+        expanded_prompts: list[str] = []
+
+        for row_id, keywords in zip(inputs.id, inputs.keywords, strict=True):
+            keyword_groups = self._build_keyword_groups(keywords)
+            for group in keyword_groups:
+                prompt = self.prompt_template.render(keywords=group).strip()
+                expanded_ids.append(row_id)
+                expanded_keywords.append(group)
+                expanded_prompts.append(prompt)
+
+        if not expanded_prompts:
+            return None
 
-            output_ids: list[int] = []
-            output_keywords: list[list[str]] = []
-            output_references: list[list[str]] = []
-            output_scores: list[list[float]] = []
-
-            for source_id, keyword_group, candidate_ids, candidate_scores, candidate_mask in zip(
-                expanded_ids,
-                expanded_keywords,
-                candidate_ids_batch,
-                candidate_scores_batch,
-                candidate_mask_batch,
-                strict=True,
-            ):
-                references: list[str] = []
-                scores: list[float] = []
-                masked_ids = cast("list[int]", candidate_ids[candidate_mask].tolist())
-                masked_scores = cast("list[float]", candidate_scores[candidate_mask].tolist())
-
-                for candidate_id, candidate_score in zip(masked_ids, masked_scores, strict=True):
-                    if candidate_id not in jokes_mapping:
-                        continue
-                    references.append(jokes_mapping[candidate_id])
-                    scores.append(candidate_score)
-
-                output_ids.append(source_id)
-                output_keywords.append(keyword_group)
-                output_references.append(references)
-                output_scores.append(scores)
-
-            return ReferencesOutputs(
-                id=output_ids,
-                keywords=output_keywords,
-                references=output_references,
-                scores=output_scores,
-            )
+        query_vectors = await self._embed_batch(expanded_prompts)
+        self._normalize_vectors(query_vectors)
+
+        candidate_ids_batch, candidate_scores_batch, candidate_mask_batch = self._search_batch(
+            query_vectors=query_vectors,
+            faiss_index=faiss_index,
+        )
+
+        output_ids: list[int] = []
+        output_keywords: list[list[str]] = []
+        output_references: list[list[str]] = []
+        output_scores: list[list[float]] = []
+
+        for source_id, keyword_group, candidate_ids, candidate_scores, candidate_mask in zip(
+            expanded_ids,
+            expanded_keywords,
+            candidate_ids_batch,
+            candidate_scores_batch,
+            candidate_mask_batch,
+            strict=True,
+        ):
+            references: list[str] = []
+            scores: list[float] = []
+            masked_ids = cast("list[int]", candidate_ids[candidate_mask].tolist())
+            masked_scores = cast("list[float]", candidate_scores[candidate_mask].tolist())
+
+            for candidate_id, candidate_score in zip(masked_ids, masked_scores, strict=True):
+                if candidate_id not in jokes_mapping:
+                    continue
+                references.append(jokes_mapping[candidate_id])
+                scores.append(candidate_score)
+
+            output_ids.append(source_id)
+            output_keywords.append(keyword_group)
+            output_references.append(references)
+            output_scores.append(scores)
+
+        return ReferencesOutputs(
+            id=output_ids,
+            keywords=output_keywords,
+            references=output_references,
+            scores=output_scores,
+        )
 
     def _deduplicate_dataset(self, dataset: Dataset) -> Dataset:
         if len(dataset) == 0:
@@ -433,13 +438,7 @@ class ReferencesPipeline(BasePipeline):
         for shard_index in range(n_shards):
             shard = dataset.shard(num_shards=n_shards, index=shard_index, contiguous=True)
             table = pa.Table.from_pydict(shard[:], schema=self.schema)
-            pq.write_table(
-                table,
-                split_dir / f"part-{shard_index:04d}.parquet",
-                compression="zstd",
-                use_content_defined_chunking=True,
-                write_page_index=True,
-            )
+            write_parquet_atomic(table, split_dir / f"part-{shard_index:04d}.parquet")
 
     def train_test_split(self) -> None:
         dataset = load_dataset(
@@ -477,8 +476,7 @@ class ReferencesPipeline(BasePipeline):
             faiss_index = self._build_faiss_index(embeddings)
             jokes_mapping = self._build_jokes_lookup(jokes)
 
-            write_buffer: list[ReferencesOutputs] = []
-            semaphore = asyncio.Semaphore(self.config.max_parallel_requests)
+            write_buffer = ArrowWriteBuffer(self.schema)
             pending_tasks: set[asyncio.Task[ReferencesOutputs | None]] = set()
 
             for batch in tqdm(dataset):
@@ -491,14 +489,13 @@ class ReferencesPipeline(BasePipeline):
                 task = asyncio.create_task(
                     self._retrieve_references(
                         inputs=inputs,
-                        semaphore=semaphore,
                         faiss_index=faiss_index,
                         jokes_mapping=jokes_mapping,
                     )
                 )
                 pending_tasks.add(task)
 
-                if len(pending_tasks) >= self.config.max_parallel_requests:
+                if len(pending_tasks) >= self.concurrency.limit:
                     await self._wait_one(
                         pending_tasks=pending_tasks,
                         write_buffer=write_buffer,
@@ -517,9 +514,12 @@ class ReferencesPipeline(BasePipeline):
                 model=self.config.model,
                 output_dir=str(self.output_dir),
                 top_k=self.config.top_k,
+                **self._run_stats(),
             )
         finally:
             await self._close_client()
+            self._close_cache()
+            self.writer.close()
 
     def build(
         self,
@@ -0,0 +1,120 @@
+import os
+import queue
+import threading
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+from typing import Any
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.pipelines.manifest import PartManifest
+
+
+def write_parquet_atomic(table: pa.Table, path: Path) -> None:
+    staging_path = path.with_name(f".{path.name}.tmp")
+    try:
+        pq.write_table(
+            table,
+            where=str(staging_path),
+            compression="zstd",
+            use_content_defined_chunking=True,
+            write_page_index=True,
+        )
+        os.replace(staging_path, path)
+    finally:
+        staging_path.unlink(missing_ok=True)
+
+
+class ArrowWriteBuffer:
+    def __init__(self, schema: pa.Schema) -> None:
+        self.schema = schema
+        self._columns: dict[str, list[Any]] = {name: [] for name in schema.names}
+        self._pending_rows = 0
+        self._batches: list[pa.RecordBatch] = []
+        self._num_rows = 0
+
+    def __len__(self) -> int:
+        return self._num_rows
+
+    def append_row(self, row: Mapping[str, Any]) -> None:
+        for name, column in self._columns.items():
+            column.append(row[name])
+        self._pending_rows += 1
+        self._num_rows += 1
+
+    def append_columns(self, columns: Mapping[str, Sequence[Any]]) -> None:
+        num_rows = len(columns[self.schema.names[0]])
+        for name, column in self._columns.items():
+            column.extend(columns[name])
+        self._pending_rows += num_rows
+        self._num_rows += num_rows
+
+    def append_batch(self, batch: pa.RecordBatch) -> None:
+        self._seal()
+        self._batches.append(batch)
+        self._num_rows += batch.num_rows
+
+    def to_table(self) -> pa.Table:
+        self._seal()
+        return pa.Table.from_batches(self._batches, schema=self.schema)
+
+    def clear(self) -> None:
+        for column in self._columns.values():
+            column.clear()
+        self._pending_rows = 0
+        self._batches = []
+        self._num_rows = 0
+
+    def _seal(self) -> None:
+        if not self._pending_rows:
+            return
+        self._batches.append(pa.RecordBatch.from_pydict(self._columns, schema=self.schema))
+        self._columns = {name: [] for name in self.schema.names}
+        self._pending_rows = 0
+
+
+class ParquetShardWriter:
+    def __init__(self, max_pending: int = 2) -> None:
+        self.max_pending = max_pending
+        self._queue: queue.Queue[tuple[pa.Table, Path, PartManifest | None] | None] | None = None
+        self._thread: threading.Thread | None = None
+        self._error: BaseException | None = None
+
+    def submit(self, table: pa.Table, path: Path, manifest: PartManifest | None = None) -> None:
+        self._raise_error()
+        if self._thread is None or self._queue is None:
+            self._queue = queue.Queue(maxsize=self.max_pending)
+            self._thread = threading.Thread(target=self._run, args=(self._queue,), name="parquet-writer", daemon=True)
+            self._thread.start()
+        self._queue.put((table, path, manifest))
+
+    def close(self) -> None:
+        if self._thread is not None and self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+        self._queue = None
+        self._raise_error()
+
+    def _run(self, items: "queue.Queue[tuple[pa.Table, Path, PartManifest | None] | None]") -> None:
+        while True:
+            item = items.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            table, path, manifest = item
+            try:
+                write_parquet_atomic(table, path)
+                if manifest is not None:
+                    manifest.record(path, table)
+            except BaseException as error:
+                self._error = error
+
+    def _raise_error(self) -> None:
+        error = self._error
+        if error is None:
+            return
+        self._error = None
+        raise error
@@ -17,3 +17,27 @@ def grpo_zscore_advantages(rewards: Any, num_generations: int, eps: float = 1e-4
     means = grouped.mean(dim=1, keepdim=True)
     std = grouped.std(dim=1, keepdim=True).clamp_min(eps)
     return ((grouped - means) / std).reshape(-1)
+
+
+def active_group_mask(advantages: Any, num_generations: int, threshold: float) -> Any:
+    grouped = advantages.view(-1, num_generations)
+    return (grouped.abs() > threshold).any(dim=1)
+
+
+def ppo_clipped_loss(
+    logprobs: Any,
+    old_logprobs: Any,
+    advantages: Any,
+    clip_epsilon: float,
+    lengths: Any | None = None,
+) -> tuple[Any, Any]:
+    if lengths is None:
+        lengths = advantages.new_ones(())
+    ratio = ((logprobs - old_logprobs) / lengths).exp()
+    unclipped = ratio * advantages
+    clipped = ratio.clamp(1.0 - clip_epsilon, 1.0 + clip_epsilon) * advantages
+    return -(unclipped.minimum(clipped) * lengths).mean(), ratio.detach()
+
+
+def ppo_clip_mask(ratio: Any, advantages: Any, clip_epsilon: float) -> Any:
+    return ((advantages > 0) & (ratio > 1.0 + clip_epsilon)) | ((advantages < 0) & (ratio < 1.0 - clip_epsilon))
@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import torch
+
+from src.training.rollout import clone_inference_policy, load_trainable_state
+
+
+class AsyncEvaluator:
+    def __init__(
+        self,
+        *,
+        policy_model: torch.nn.Module,
+        evaluate_fn: Callable[[torch.nn.Module, int], object],
+    ) -> None:
+        # Not shared with the rollout worker: its clone is reloaded by publish_weights while an eval may still be
+        # running. Frozen base parameters are shared; only trainable parameters are copied.
+        self.model, self._trainable_names = clone_inference_policy(policy_model)
+        self._evaluate_fn = evaluate_fn
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mrvf-eval")
+        self._pending: Future[object] | None = None
+
+    def submit(self, policy_model: torch.nn.Module, step: int) -> None:
+        self.wait()
+        state = {name: param.detach() for name, param in policy_model.named_parameters() if param.requires_grad}
+        load_trainable_state(self.model, self._trainable_names, state)
+        self._pending = self._executor.submit(self._evaluate_fn, self.model, step)
+
+    def wait(self) -> None:
+        pending = self._pending
+        self._pending = None
+        if pending is not None:
+            pending.result()
+
+    def close(self) -> None:
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+import re
+import shutil
+from typing import Any
+
+import torch
+
+TRAINER_STATE_NAME = "trainer_state.pt"
+_STEP_DIR_PATTERN = re.compile(r"^step-(\d+)$")
+
+
+def cpu_snapshot(value: Any) -> Any:
+    if isinstance(value, torch.Tensor):
+        return value.detach().to("cpu", copy=True)
+    if isinstance(value, dict):
+        return {key: cpu_snapshot(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [cpu_snapshot(item) for item in value]
+    if isinstance(value, tuple):
+        return tuple(cpu_snapshot(item) for item in value)
+    return value
+
+
+def list_checkpoints(output_dir: str | Path) -> list[Path]:
+    root = Path(output_dir)
+    if not root.is_dir():
+        return []
+    checkpoints: list[tuple[int, Path]] = []
+    for path in root.iterdir():
+        match = _STEP_DIR_PATTERN.match(path.name)
+        if match is not None and (path / TRAINER_STATE_NAME).is_file():
+            checkpoints.append((int(match.group(1)), path))
+    return [path for _, path in sorted(checkpoints)]
+
+
+def resolve_resume_checkpoint(output_dir: str | Path, resume_from_checkpoint: str | None) -> Path | None:
+    if resume_from_checkpoint is None:
+        return None
+    if resume_from_checkpoint == "latest":
+        checkpoints = list_checkpoints(output_dir)
+        return checkpoints[-1] if checkpoints else None
+    path = Path(resume_from_checkpoint)
+    if not (path / TRAINER_STATE_NAME).is_file():
+        msg = f"Checkpoint `{path}` does not contain `{TRAINER_STATE_NAME}`."
+        raise RuntimeError(msg)
+    return path
+
+
+def prune_checkpoints(output_dir: str | Path, save_total_limit: int) -> None:
+    if save_total_limit <= 0:
+        return
+    for path in list_checkpoints(output_dir)[:-save_total_limit]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def load_model_weights(checkpoint_dir: str | Path) -> dict[str, torch.Tensor]:
+    from safetensors.torch import load_file
+
+    weights: dict[str, torch.Tensor] = {}
+    for path in sorted(Path(checkpoint_dir).glob("*.safetensors")):
+        weights.update(load_file(str(path)))
+    if not weights:
+        msg = f"Checkpoint `{checkpoint_dir}` does not contain safetensors weights."
+        raise RuntimeError(msg)
+    return weights
+
+
+class CheckpointWriter:
+    def __init__(self, *, background: bool) -> None:
+        self.background = background
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending: Future[None] | None = None
+
+    def submit(self, write_fn: Callable[[], None]) -> None:
+        self.wait()
+        if not self.background:
+            write_fn()
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mrvf-checkpoint")
+        self._pending = self._executor.submit(write_fn)
+
+    def wait(self) -> None:
+        pending = self._pending
+        self._pending = None
+        if pending is not None:
+            pending.result()
+
+    def close(self) -> None:
+        try:
+            self.wait()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
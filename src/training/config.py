@@ -10,6 +10,8 @@ class MRVFConfig:
     dataset_config_name: str = "references"
     train_split: str = "train"
     eval_split: str = "validation"
+    pretokenize_dataset: bool = False
+    dataset_cache_dir: str = "data/cache/mrvf"
     max_steps: int = 100
     learning_rate: float = 1e-5
     per_device_train_batch_size: int = 1
@@ -25,8 +27,19 @@ class MRVFConfig:
     objective_mode: Literal["exact_scaled", "log_mass_surrogate", "mrvf_lite"] = "log_mass_surrogate"
     reward_transform: Literal["log_mass", "centered_prob_mass"] = "log_mass"
     reward_baseline_mode: Literal["none", "prompt_relative"] = "none"
+    prompt_baseline_source: Literal["policy", "frozen_base"] = "policy"
     advantage_mode: Literal["loo", "grpo_zscore"] = "loo"
+    skip_zero_advantage_groups: bool = False
+    zero_advantage_threshold: float = 1e-6
     reference_length_normalization: Literal["none", "token_mean", "sqrt"] = "token_mean"
+    single_pass_reference_scoring: bool = False
+    fuse_trace_logprobs: bool = False
+    share_reference_prefix: bool = False
+    target_only_logits: bool = False
+    logprob_chunk_size: int = 1024
+    reference_max_tokens_per_forward: int = 0
+    ppo_epochs: int = 1
+    ppo_clip_epsilon: float = 0.2
     trace_loss_coef: float = 1.0
     reference_loss_coef: float = 0.5
     use_kl: bool = False
@@ -41,6 +54,17 @@ class MRVFConfig:
     )
     trace_prompt_template: str = "training_trace_prompt.j2"
     force_close_thinking: bool = False
+    stop_at_think_close: bool = True
+    prefill_prompts_once: bool = False
+    rollout_backend: Literal["transformers", "vllm"] = "transformers"
+    vllm_sync_every_steps: int = 1
+    vllm_gpu_memory_utilization: float = 0.3
+    vllm_max_model_len: int | None = None
+    vllm_adapter_dir: str | None = None
+    async_rollout: bool = False
+    rollout_queue_size: int = 1
+    rollout_sync_every_steps: int = 1
+    max_policy_lag: int = 2
     forced_thinking_suffix: str = (
         "\n\nConsidering the limited time, I will now answer from this reasoning.\n</think>\n\n"
     )
@@ -62,14 +86,26 @@ class MRVFConfig:
         "down_proj",
     )
     torch_dtype: Literal["auto", "float16", "bfloat16", "float32"] = "auto"
+    autocast_bf16: bool = False
+    compile_scoring: bool = False
+    compile_mode: Literal["default", "reduce-overhead", "max-autotune"] = "default"
+    pad_to_multiple_of: int = 0
+    distributed_backend: Literal["nccl", "gloo"] | None = None
     gradient_checkpointing: bool = False
     eval_every_steps: int = 0
     eval_sample_size: int = 16
+    async_eval: bool = False
     trace_format: Literal["plain", "qwen_chat_thinking"] = "plain"
     logging_steps: int = 10
     save_steps: int = 100
+    save_total_limit: int = 0
+    async_checkpoint: bool = False
+    resume_from_checkpoint: str | None = None
     metrics_log_path: str = "data/logs/mrvf_metrics.jsonl"
     sample_log_path: str = "data/logs/mrvf_samples.jsonl"
+    profile_start_step: int = 0
+    profile_end_step: int = 0
+    profile_phase_sync: bool = False
     report_to_wandb: bool = False
     wandb_project: str = "humor-generation"
     wandb_run_name: str | None = None
@@ -92,6 +128,9 @@ class MRVFConfig:
         if self.objective_mode == "exact_scaled" and self.reference_length_normalization != "none":
             msg = "`objective_mode=exact_scaled` requires `reference_length_normalization=none`."
             raise ValueError(msg)
+        if self.prompt_baseline_source == "frozen_base" and not self.use_peft:
+            msg = "`prompt_baseline_source=frozen_base` requires `use_peft=True`."
+            raise ValueError(msg)
         if self.reward_baseline_mode == "prompt_relative" and self.reward_transform != "log_mass":
             msg = "`reward_baseline_mode=prompt_relative` currently requires `reward_transform=log_mass`."
             raise ValueError(msg)
@@ -107,6 +146,61 @@ class MRVFConfig:
         if not self.trace_prompt_template.strip():
             msg = "`trace_prompt_template` must not be empty."
             raise ValueError(msg)
+        if self.logprob_chunk_size <= 0:
+            msg = "`logprob_chunk_size` must be positive."
+            raise ValueError(msg)
+        if self.zero_advantage_threshold < 0:
+            msg = "`zero_advantage_threshold` must be non-negative."
+            raise ValueError(msg)
+        if self.rollout_queue_size <= 0 or self.rollout_sync_every_steps <= 0:
+            msg = "`rollout_queue_size` and `rollout_sync_every_steps` must be positive."
+            raise ValueError(msg)
+        if self.max_policy_lag < 0:
+            msg = "`max_policy_lag` must be non-negative."
+            raise ValueError(msg)
+        if self.rollout_backend == "vllm":
+            if not self.use_peft:
+                msg = "`rollout_backend=vllm` requires `use_peft=True`."
+                raise ValueError(msg)
+            if self.async_rollout:
+                msg = "`rollout_backend=vllm` is incompatible with `async_rollout=True`."
+                raise ValueError(msg)
+            if self.vllm_sync_every_steps <= 0:
+                msg = "`vllm_sync_every_steps` must be positive."
+                raise ValueError(msg)
+            if not 0 < self.vllm_gpu_memory_utilization <= 1:
+                msg = "`vllm_gpu_memory_utilization` must be in (0, 1]."
+                raise ValueError(msg)
+        if self.ppo_epochs <= 0:
+            msg = "`ppo_epochs` must be positive."
+            raise ValueError(msg)
+        if self.ppo_epochs > 1 and self.async_rollout:
+            msg = "`ppo_epochs > 1` is incompatible with `async_rollout=True`."
+            raise ValueError(msg)
+        if self.ppo_clip_epsilon <= 0:
+            msg = "`ppo_clip_epsilon` must be positive."
+            raise ValueError(msg)
+        if self.fuse_trace_logprobs and self.skip_zero_advantage_groups:
+            msg = "`fuse_trace_logprobs=True` is incompatible with `skip_zero_advantage_groups=True`."
+            raise ValueError(msg)
+        if self.pad_to_multiple_of < 0:
+            msg = "`pad_to_multiple_of` must be non-negative."
+            raise ValueError(msg)
+        if self.save_total_limit < 0:
+            msg = "`save_total_limit` must be non-negative."
+            raise ValueError(msg)
+        if self.profile_start_step < 0 or self.profile_end_step < 0:
+            msg = "`profile_start_step` and `profile_end_step` must be non-negative."
+            raise ValueError(msg)
+        if self.profile_start_step > 0 and self.profile_end_step < self.profile_start_step:
+            msg = "`profile_end_step` must be >= `profile_start_step` when profiling is enabled."
+            raise ValueError(msg)
+        if self.reference_max_tokens_per_forward < 0:
+            msg = "`reference_max_tokens_per_forward` must be non-negative."
+            raise ValueError(msg)
+        if self.share_reference_prefix and self.gradient_checkpointing:
+            msg = "`share_reference_prefix=True` requires `gradient_checkpointing=False`."
+            raise ValueError(msg)
         if self.force_close_thinking and not self.forced_thinking_suffix.strip():
             msg = "`forced_thinking_suffix` must not be empty when `force_close_thinking=True`."
             raise ValueError(msg)
@@ -1,10 +1,34 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+import hashlib
+import json
+from pathlib import Path
 from typing import Any
 
-from datasets import Dataset, load_dataset
+from datasets import Dataset, Features, List, Value, load_dataset, load_from_disk
+import polars as pl
 from src.templates import environment
+from src.training.config import MRVFConfig
+from src.training.prompt_format import build_trace_prompt_text
+
+TOKENIZED_CONFIG_FIELDS = (
+    "trace_prompt_template",
+    "trace_format",
+    "use_thinking",
+    "answer_prefix",
+    "max_reference_length",
+    "num_reference_samples",
+)
+PREPARED_FEATURES = Features(
+    {
+        "id": Value("int64"),
+        "keywords": List(Value("string")),
+        "prompt": Value("string"),
+        "references": List(Value("string")),
+        "scores": List(Value("float64")),
+    }
+)
 
 
 @dataclass
@@ -66,22 +90,146 @@ def normalize_row(row: dict[str, Any], max_reference_samples: int) -> MRVFRow |
     )
 
 
-def prepare_mrvf_dataset(dataset: Dataset, max_reference_samples: int) -> Dataset:
-    rows: list[dict[str, Any]] = []
-    for row in dataset:
-        normalized = normalize_row(dict(row), max_reference_samples=max_reference_samples)
-        if normalized is None:
-            continue
-        rows.append(
-            {
-                "id": normalized.id,
-                "keywords": normalized.keywords,
-                "prompt": normalized.prompt,
-                "references": normalized.references,
-                "scores": normalized.scores,
-            }
+def _prompt_template_parts() -> tuple[str, str, str] | None:
+    first, second = "\x00first\x00", "\x00second\x00"
+    rendered = build_prompt([first, second])
+    prefix, found, remainder = rendered.partition(first)
+    separator, found_second, suffix = remainder.partition(second)
+    if not found or not found_second or first in suffix or second in suffix:
+        return None
+    return prefix, separator, suffix
+
+
+def _prompt_expression() -> pl.Expr:
+    parts = _prompt_template_parts()
+    if parts is None:
+        return pl.col("keywords").map_elements(lambda keywords: build_prompt(list(keywords)), return_dtype=pl.String)
+    prefix, separator, suffix = parts
+    return pl.concat_str(
+        [pl.lit(prefix), pl.col("keywords").list.join(separator), pl.lit(suffix)]
+    ).str.strip_chars()
+
+
+def _prepare_mrvf_frame(frame: pl.DataFrame, max_reference_samples: int) -> pl.DataFrame:
+    if "scores" not in frame.columns:
+        frame = frame.with_columns(pl.lit(None, dtype=pl.List(pl.Float64)).alias("scores"))
+    rows = (
+        frame.select(
+            pl.col("id").cast(pl.Int64),
+            pl.col("keywords")
+            .list.eval(pl.element().str.strip_chars())
+            .list.eval(pl.element().filter(pl.element().is_not_null() & (pl.element() != ""))),
+            pl.col("references").cast(pl.List(pl.String)),
+            pl.col("scores").cast(pl.List(pl.Float64)),
+        )
+        .with_row_index("row_index")
+        .filter(pl.col("keywords").list.len() > 0)
+    )
+    references = (
+        rows.select(
+            "row_index",
+            "references",
+            "scores",
+            pl.int_ranges(0, pl.col("references").list.len()).alias("position"),
+        )
+        .explode(["references", "position"])
+        .select(
+            "row_index",
+            pl.col("references").str.strip_chars().alias("reference"),
+            pl.col("scores").list.get(pl.col("position"), null_on_oob=True).fill_null(0.0).alias("score"),
         )
-    return Dataset.from_list(rows)
+        .filter(pl.col("reference").is_not_null() & (pl.col("reference") != ""))
+        .unique(subset=["row_index", "reference"], keep="first", maintain_order=True)
+    )
+    if max_reference_samples > 0:
+        references = references.filter(pl.int_range(pl.len()).over("row_index") < max_reference_samples)
+    grouped = references.group_by("row_index", maintain_order=True).agg(
+        pl.col("reference").alias("references"),
+        pl.col("score").alias("scores"),
+    )
+    return (
+        rows.drop("references", "scores")
+        .join(grouped, on="row_index", how="inner", maintain_order="left")
+        .select("id", "keywords", _prompt_expression().alias("prompt"), "references", "scores")
+    )
+
+
+def _prepared_cache_key(dataset: Dataset, max_reference_samples: int) -> str:
+    template_source, _, _ = environment.loader.get_source(environment, "reference_prompt.j2")
+    payload = {
+        "max_reference_samples": max_reference_samples,
+        "template": template_source,
+        "dataset": dataset._fingerprint,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def prepare_mrvf_dataset(dataset: Dataset, max_reference_samples: int, cache_dir: Path | None = None) -> Dataset:
+    def prepare() -> Dataset:
+        frame = _prepare_mrvf_frame(dataset.to_polars(), max_reference_samples)
+        return Dataset.from_polars(frame, features=PREPARED_FEATURES)
+
+    if cache_dir is None:
+        return prepare()
+    path = cache_dir / "prepared" / _prepared_cache_key(dataset, max_reference_samples)
+    if path.exists():
+        return load_from_disk(str(path))
+    prepared = prepare()
+    staging_path = path.with_name(f"{path.name}.tmp")
+    prepared.save_to_disk(str(staging_path))
+    staging_path.rename(path)
+    return load_from_disk(str(path))
+
+
+def _tokenized_cache_key(dataset: Dataset, tokenizer: Any, cfg: MRVFConfig) -> str:
+    template_source, _, _ = environment.loader.get_source(environment, cfg.trace_prompt_template)
+    payload = {
+        "tokenizer": tokenizer.name_or_path,
+        "config": {field: getattr(cfg, field) for field in TOKENIZED_CONFIG_FIELDS},
+        "template": template_source,
+        "dataset": dataset._fingerprint,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def tokenize_mrvf_dataset(
+    dataset: Dataset,
+    *,
+    tokenizer: Any,
+    cfg: MRVFConfig,
+    cache_dir: Path | None = None,
+) -> Dataset:
+    answer_prefix_ids = tokenizer(cfg.answer_prefix, add_special_tokens=False)["input_ids"]
+
+    def tokenize_batch(batch: dict[str, list[Any]]) -> dict[str, list[Any]]:
+        trace_prompts = [build_trace_prompt_text(tokenizer, cfg, prompt) for prompt in batch["prompt"]]
+        trace_prompt_ids = tokenizer(trace_prompts, add_special_tokens=False)["input_ids"] if trace_prompts else []
+        reference_ids: list[list[list[int]]] = []
+        for references in batch["references"]:
+            encoded = tokenizer(
+                list(references),
+                add_special_tokens=False,
+                truncation=True,
+                max_length=cfg.max_reference_length,
+            )["input_ids"] if references else []
+            reference_ids.append([ids for ids in encoded if ids])
+        return {
+            "trace_prompt": trace_prompts,
+            "trace_prompt_ids": trace_prompt_ids,
+            "reference_ids": reference_ids,
+            "answer_prefix_ids": [answer_prefix_ids] * len(trace_prompts),
+        }
+
+    if cache_dir is None:
+        return dataset.map(tokenize_batch, batched=True)
+    path = cache_dir / _tokenized_cache_key(dataset, tokenizer, cfg)
+    if path.exists():
+        return load_from_disk(str(path))
+    tokenized = dataset.map(tokenize_batch, batched=True)
+    staging_path = path.with_name(f"{path.name}.tmp")
+    tokenized.save_to_disk(str(staging_path))
+    staging_path.rename(path)
+    return load_from_disk(str(path))
 
 
 def load_reference_splits(dataset_name: str, dataset_config_name: str, train_split: str, eval_split: str) -> tuple[Dataset, Dataset]:
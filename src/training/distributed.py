@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+import os
+from typing import Any, TypeVar
+
+import torch
+import torch.distributed as dist
+
+T = TypeVar("T")
+
+GRADIENT_BUCKET_BYTES = 25 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class DistributedContext:
+    rank: int = 0
+    world_size: int = 1
+    local_rank: int = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.world_size > 1
+
+    @property
+    def is_main_process(self) -> bool:
+        return self.rank == 0
+
+
+def init_distributed(backend: str | None = None) -> DistributedContext:
+    world_size = int(os.environ.get("WORLD_SIZE", "1"))
+    if world_size <= 1:
+        return DistributedContext()
+    rank = int(os.environ["RANK"])
+    local_rank = int(os.environ.get("LOCAL_RANK", "0"))
+    if not dist.is_initialized():
+        if backend is None:
+            backend = "nccl" if torch.cuda.is_available() else "gloo"
+        if backend == "nccl":
+            torch.cuda.set_device(local_rank)
+        dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+    return DistributedContext(rank=rank, world_size=world_size, local_rank=local_rank)
+
+
+def shard_rows(rows: list[T], context: DistributedContext) -> list[T]:
+    return rows[context.rank :: context.world_size]
+
+
+class GradientReducer:
+    def __init__(
+        self,
+        parameters: Any,
+        context: DistributedContext,
+        bucket_size_bytes: int = GRADIENT_BUCKET_BYTES,
+        *,
+        overlap: bool = True,
+    ) -> None:
+        self.context = context
+        self.require_sync = True
+        self.buckets: list[list[Any]] = []
+        bucket_bytes = bucket_size_bytes
+        for param in reversed([param for param in parameters if param.requires_grad]):
+            if bucket_bytes >= bucket_size_bytes:
+                self.buckets.append([])
+                bucket_bytes = 0
+            self.buckets[-1].append(param)
+            bucket_bytes += param.numel() * 4
+        self._bucket_index = {id(param): index for index, bucket in enumerate(self.buckets) for param in bucket}
+        self._ready: list[set[int]] = [set() for _ in self.buckets]
+        self._next_bucket = 0
+        self._launched: list[tuple[Any, torch.Tensor, list[Any]]] = []
+        self._hooks: list[Any] = []
+        if context.enabled and overlap:
+            self._hooks = [
+                param.register_post_accumulate_grad_hook(self._on_gradient)
+                for bucket in self.buckets
+                for param in bucket
+            ]
+
+    def _on_gradient(self, param: Any) -> None:
+        if not self.require_sync:
+            return
+        index = self._bucket_index[id(param)]
+        self._ready[index].add(id(param))
+        while self._next_bucket < len(self.buckets) and self._bucket_ready(self._next_bucket):
+            self._launch_next()
+
+    def _bucket_ready(self, index: int) -> bool:
+        return len(self._ready[index]) == len(self.buckets[index])
+
+    def _launch_next(self) -> None:
+        params = self.buckets[self._next_bucket]
+        grads = [param.grad if param.grad is not None else torch.zeros_like(param) for param in params]
+        flat = torch.cat([grad.reshape(-1).float() for grad in grads])
+        self._launched.append((dist.all_reduce(flat, op=dist.ReduceOp.SUM, async_op=True), flat, params))
+        self._next_bucket += 1
+
+    def finish(self) -> None:
+        if not self.context.enabled:
+            return
+        # Buckets launch in a fixed order on every rank; ones whose parameters got no gradient in this
+        # backward are reduced here so collectives still line up across ranks.
+        while self._next_bucket < len(self.buckets):
+            self._launch_next()
+        for handle, flat, params in self._launched:
+            handle.wait()
+            flat /= self.context.world_size
+            offset = 0
+            for param in params:
+                numel = param.numel()
+                reduced = flat[offset : offset + numel].view_as(param)
+                if param.grad is None:
+                    param.grad = reduced.to(param.dtype, copy=True)
+                else:
+                    param.grad.copy_(reduced)
+                offset += numel
+        self._launched = []
+        self._ready = [set() for _ in self.buckets]
+        self._next_bucket = 0
+
+    def close(self) -> None:
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+
+def all_reduce_gradients(
+    parameters: Any,
+    context: DistributedContext,
+    bucket_size_bytes: int = GRADIENT_BUCKET_BYTES,
+) -> None:
+    if not context.enabled:
+        return
+    GradientReducer(parameters, context, bucket_size_bytes, overlap=False).finish()
+
+
+def all_gather_objects(value: T, context: DistributedContext) -> list[T]:
+    if not context.enabled:
+        return [value]
+    gathered: list[Any] = [None] * context.world_size
+    dist.all_gather_object(gathered, value)
+    return gathered
+
+
+def all_reduce_metrics(
+    metrics: dict[str, float],
+    context: DistributedContext,
+    device: torch.device,
+) -> dict[str, float]:
+    if not context.enabled:
+        return metrics
+    keys = sorted(metrics)
+    values = torch.tensor([float(metrics[key]) for key in keys], dtype=torch.float64, device=device)
+    dist.all_reduce(values, op=dist.ReduceOp.SUM)
+    values /= context.world_size
+    return dict(zip(keys, values.tolist(), strict=True))
+
+
+def barrier(context: DistributedContext) -> None:
+    if context.enabled:
+        dist.barrier()
+
+
+def shutdown_distributed(context: DistributedContext) -> None:
+    if context.enabled and dist.is_initialized():
+        dist.destroy_process_group()
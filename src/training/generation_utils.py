@@ -1,6 +1,29 @@
 from __future__ import annotations
 
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import torch
+
 
 def extract_completion_ids(row_ids: list[int], *, input_width: int, pad_token_id: int) -> list[int]:
     completion = row_ids[input_width:]
     return [token for token in completion if token != pad_token_id]
+
+
+def extract_completion_ids_batch(
+    generated: "torch.Tensor",
+    *,
+    input_width: int,
+    pad_token_id: int,
+) -> list[list[int]]:
+    completion = generated[:, input_width:].cpu()
+    keep = completion != pad_token_id
+    lengths = keep.sum(dim=1).tolist()
+    tokens = completion[keep].tolist()
+    rows: list[list[int]] = []
+    offset = 0
+    for length in lengths:
+        rows.append(tokens[offset : offset + length])
+        offset += length
+    return rows
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    import torch
+
+PLAIN_LM_HEAD_MODEL_TYPES = frozenset(
+    {"gpt2", "llama", "mistral", "mixtral", "phi3", "qwen2", "qwen2_moe", "qwen3", "qwen3_moe"}
+)
+
+
+@dataclass
+class ScoringStates:
+    values: "torch.Tensor"
+    head: "torch.nn.Module | None"
+    past_key_values: Any = None
+
+
+def _resolve_backbone_and_head(model: "torch.nn.Module") -> tuple["torch.nn.Module", "torch.nn.Module"] | None:
+    base = model.get_base_model() if hasattr(model, "get_base_model") else model
+    config = getattr(base, "config", None)
+    if getattr(config, "model_type", None) not in PLAIN_LM_HEAD_MODEL_TYPES:
+        return None
+    backbone = getattr(base, "base_model", None)
+    get_head = getattr(base, "get_output_embeddings", None)
+    if backbone is None or backbone is base or get_head is None:
+        return None
+    head = get_head()
+    if head is None:
+        return None
+    return backbone, head
+
+
+def forward_scoring_states(model: "torch.nn.Module", *, target_only: bool, **forward_kwargs: Any) -> ScoringStates:
+    resolved = _resolve_backbone_and_head(model) if target_only else None
+    if resolved is None:
+        outputs = model(**forward_kwargs)
+        past_key_values = getattr(outputs, "past_key_values", None)
+        return ScoringStates(values=outputs.logits, head=None, past_key_values=past_key_values)
+    backbone, head = resolved
+    outputs = backbone(**forward_kwargs)
+    return ScoringStates(values=outputs.last_hidden_state, head=head, past_key_values=outputs.past_key_values)
+
+
+def _chunk_logprobs(rows: "torch.Tensor", labels: "torch.Tensor", head: "torch.nn.Module | None") -> "torch.Tensor":
+    import torch
+
+    logits = rows if head is None else head(rows)
+    return -torch.nn.functional.cross_entropy(logits.float(), labels, reduction="none")
+
+
+def _logprob_dtype(values: "torch.Tensor") -> "torch.dtype":
+    import torch
+
+    return torch.float32 if torch.is_autocast_enabled(values.device.type) else values.dtype
+
+
+def token_logprobs(
+    rows: "torch.Tensor",
+    labels: "torch.Tensor",
+    head: "torch.nn.Module | None",
+    chunk_size: int,
+) -> "torch.Tensor":
+    import torch
+    from torch.utils.checkpoint import checkpoint
+
+    dtype = _logprob_dtype(rows)
+    if head is None or chunk_size <= 0 or rows.shape[0] <= chunk_size:
+        return _chunk_logprobs(rows, labels, head).to(dtype)
+    chunks = []
+    for start in range(0, rows.shape[0], chunk_size):
+        row_chunk = rows[start : start + chunk_size]
+        label_chunk = labels[start : start + chunk_size]
+        if torch.is_grad_enabled():
+            chunks.append(checkpoint(_chunk_logprobs, row_chunk, label_chunk, head, use_reentrant=False))
+        else:
+            chunks.append(_chunk_logprobs(row_chunk, label_chunk, head))
+    return torch.cat(chunks, dim=0).to(dtype)
+
+
+def sum_selected_logprobs_by_mask(
+    values: "torch.Tensor",
+    labels: "torch.Tensor",
+    target_masks: list["torch.Tensor"],
+    head: "torch.nn.Module | None",
+    chunk_size: int,
+) -> list["torch.Tensor"]:
+    import torch
+
+    masks = [target_mask.bool() for target_mask in target_masks]
+    selected = torch.stack(masks, dim=0).any(dim=0)
+    results = [torch.zeros(values.shape[0], dtype=_logprob_dtype(values), device=values.device) for _ in masks]
+    if not selected.any():
+        return results
+    selected_logprobs = token_logprobs(values[selected], labels[selected], head, chunk_size)
+    row_ids = torch.arange(values.shape[0], device=values.device).unsqueeze(1).expand_as(selected)[selected]
+    for result, mask in zip(results, masks, strict=True):
+        keep = mask[selected]
+        result.scatter_add_(0, row_ids[keep], selected_logprobs[keep])
+    return results
+
+
+def sum_selected_logprobs(
+    values: "torch.Tensor",
+    labels: "torch.Tensor",
+    target_mask: "torch.Tensor",
+    head: "torch.nn.Module | None",
+    chunk_size: int,
+) -> "torch.Tensor":
+    return sum_selected_logprobs_by_mask(values, labels, [target_mask], head, chunk_size)[0]
+
+
+def masked_sequence_logprobs_by_mask(
+    *,
+    model: "torch.nn.Module",
+    input_ids: "torch.Tensor",
+    attention_mask: "torch.Tensor",
+    target_masks: list["torch.Tensor"],
+    target_only: bool = False,
+    chunk_size: int = 1024,
+) -> list["torch.Tensor"]:
+    states = forward_scoring_states(model, target_only=target_only, input_ids=input_ids, attention_mask=attention_mask)
+    values = states.values[:, :-1, :]
+    labels = input_ids[:, 1:]
+    effective_masks = [target_mask[:, 1:] * attention_mask[:, 1:] for target_mask in target_masks]
+    return sum_selected_logprobs_by_mask(values, labels, effective_masks, states.head, chunk_size)
+
+
+def masked_sequence_logprobs(
+    *,
+    model: "torch.nn.Module",
+    input_ids: "torch.Tensor",
+    attention_mask: "torch.Tensor",
+    target_mask: "torch.Tensor",
+    target_only: bool = False,
+    chunk_size: int = 1024,
+) -> "torch.Tensor":
+    return masked_sequence_logprobs_by_mask(
+        model=model,
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        target_masks=[target_mask],
+        target_only=target_only,
+        chunk_size=chunk_size,
+    )[0]
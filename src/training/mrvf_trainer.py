@@ -1,7 +1,13 @@
 from __future__ import annotations
 
+from collections import deque
+from collections.abc import Callable
+from contextlib import AbstractContextManager
+import copy
 import random
-from dataclasses import asdict, dataclass
+import shutil
+import threading
+from dataclasses import asdict, dataclass, field, replace
 import json
 from pathlib import Path
 import time
@@ -10,14 +16,69 @@ from typing import Any
 import torch
 from datasets import Dataset
 from torch.optim import AdamW
-from transformers import AutoModelForCausalLM, AutoTokenizer, get_cosine_schedule_with_warmup
-
-from src.templates import environment
-from src.training.advantages import grpo_zscore_advantages, loo_advantages
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    LogitsProcessor,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+    get_cosine_schedule_with_warmup,
+)
+
+from src.training.advantages import (
+    active_group_mask,
+    grpo_zscore_advantages,
+    loo_advantages,
+    ppo_clip_mask,
+    ppo_clipped_loss,
+)
+from src.training.async_eval import AsyncEvaluator
+from src.training.checkpointing import (
+    TRAINER_STATE_NAME,
+    CheckpointWriter,
+    cpu_snapshot,
+    load_model_weights,
+    prune_checkpoints,
+    resolve_resume_checkpoint,
+)
 from src.training.config import MRVFConfig
-from src.training.data import prepare_mrvf_dataset
-from src.training.generation_utils import extract_completion_ids
-from src.training.reference_likelihood import teacher_forced_reference_logps_from_ids
+from src.training.data import prepare_mrvf_dataset, tokenize_mrvf_dataset
+from src.training.distributed import (
+    GradientReducer,
+    all_gather_objects,
+    all_reduce_metrics,
+    barrier,
+    init_distributed,
+    shard_rows,
+)
+from src.training.generation_utils import extract_completion_ids_batch
+from src.training.logprobs import masked_sequence_logprobs_by_mask
+from src.training.prompt_baseline import PromptBaselineCache, prompt_baseline_cache_path, prompt_baseline_key
+from src.training.profiling import StepProfiler, timed_phase, zero_phase_stats
+from src.training.prompt_format import build_trace_prompt_text
+from src.training.reference_likelihood import (
+    ReferenceLikelihoodOutput,
+    padded_width,
+    teacher_forced_reference_logps_from_ids,
+)
+from src.training.rollout import AsyncRolloutWorker
+from src.training.vllm_rollout import VLLMRolloutEngine
+
+
+COMPUTE_PHASES = (
+    "prompt_build",
+    "tokenize",
+    "generate",
+    "trace_logprob",
+    "reward_pass",
+    "reference_pass",
+    "prompt_baseline_pass",
+)
+STEP_PHASES = ("backward", "optimizer_step", "checkpoint_save")
 
 
 def _resolve_dtype(name: str) -> torch.dtype | None:
@@ -40,6 +101,31 @@ class TraceBatch:
     forced_think_close: list[bool]
     reference_prefix_lengths: list[int]
     references: list[list[str]]
+    reference_ids: list[list[list[int]]] | None = None
+    decode_steps: int = 0
+
+
+@dataclass
+class ReplayBatch:
+    batch_rows: list[dict[str, Any]]
+    trace_batch: TraceBatch
+    rewards: torch.Tensor
+    advantages: torch.Tensor
+    old_trace_logprob: torch.Tensor
+    prompt_baseline_scores: torch.Tensor | None = None
+    epoch: int = 1
+    policy_version: int = 0
+
+
+@dataclass
+class DataStreamState:
+    order: list[int] = field(default_factory=list)
+    rank_order: list[int] = field(default_factory=list)
+    cursor: int = 0
+    pending_batches: deque[list[int]] = field(default_factory=deque)
+    in_flight: deque[list[int]] = field(default_factory=deque)
+    replay_queue: deque[ReplayBatch] = field(default_factory=deque)
+    rollout_generator: torch.Tensor | None = None
 
 
 @dataclass
@@ -69,8 +155,10 @@ def _build_sequence_logprob_inputs(
     tokenizer: Any,
     prefix_ids: list[list[int]],
     completion_ids: list[list[int]],
+    pad_to_multiple_of: int = 0,
 ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     max_len = max(len(prefix) + len(completion) for prefix, completion in zip(prefix_ids, completion_ids, strict=True))
+    max_len = padded_width(max_len, pad_to_multiple_of)
     input_rows: list[list[int]] = []
     attn_rows: list[list[int]] = []
     target_rows: list[list[int]] = []
@@ -98,28 +186,40 @@ def _sequence_logprobs_from_ids(
     input_ids: torch.Tensor,
     attention_mask: torch.Tensor,
     target_mask: torch.Tensor,
+    target_only: bool = False,
+    chunk_size: int = 1024,
+    sequence_logprobs_fn: Callable[..., list[torch.Tensor]] = masked_sequence_logprobs_by_mask,
 ) -> torch.Tensor:
-    logits = model(input_ids=input_ids, attention_mask=attention_mask).logits[:, :-1, :]
-    labels = input_ids[:, 1:]
-    shifted_target_mask = target_mask[:, 1:].to(logits.dtype)
-    shifted_attn_mask = attention_mask[:, 1:].to(logits.dtype)
-    effective_mask = shifted_target_mask * shifted_attn_mask
-
-    selected = effective_mask.bool()
-    result = torch.zeros(logits.shape[0], dtype=logits.dtype, device=logits.device)
-    if not selected.any():
-        return result
-
-    selected_logits = logits[selected]
-    selected_labels = labels[selected]
-    selected_logprobs = -torch.nn.functional.cross_entropy(
-        selected_logits.float(),
-        selected_labels,
-        reduction="none",
-    ).to(logits.dtype)
-    row_ids = torch.arange(logits.shape[0], device=logits.device).unsqueeze(1).expand_as(selected)[selected]
-    result.scatter_add_(0, row_ids, selected_logprobs)
-    return result
+    return sequence_logprobs_fn(
+        model=model,
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        target_masks=[target_mask],
+        target_only=target_only,
+        chunk_size=chunk_size,
+    )[0]
+
+
+def _left_pad_ids(rows: list[list[int]], pad_token_id: int) -> tuple[torch.Tensor, torch.Tensor]:
+    max_len = max(len(row) for row in rows)
+    input_rows = [[pad_token_id] * (max_len - len(row)) + list(row) for row in rows]
+    attn_rows = [[0] * (max_len - len(row)) + [1] * len(row) for row in rows]
+    return torch.tensor(input_rows, dtype=torch.long), torch.tensor(attn_rows, dtype=torch.long)
+
+
+def _dataset_rows(dataset: Dataset, indices: list[int]) -> list[dict[str, Any]]:
+    columns = dataset[indices]
+    return [dict(zip(columns, values, strict=True)) for values in zip(*columns.values(), strict=True)]
+
+
+def _replay_state(item: ReplayBatch) -> dict[str, Any]:
+    return {key: value.cpu() if isinstance(value, torch.Tensor) else value for key, value in asdict(item).items()}
+
+
+def _restore_replay(state: dict[str, Any], device: torch.device) -> ReplayBatch:
+    values = {key: value.to(device) if isinstance(value, torch.Tensor) else value for key, value in state.items()}
+    values["trace_batch"] = TraceBatch(**values["trace_batch"])
+    return ReplayBatch(**values)
 
 
 def _find_subsequence_end(ids: list[int], pattern: list[int]) -> int | None:
@@ -132,12 +232,37 @@ def _find_subsequence_end(ids: list[int], pattern: list[int]) -> int | None:
     return None
 
 
+class _SubsequenceStoppingCriteria(StoppingCriteria):
+    def __init__(self, pattern: list[int], input_width: int) -> None:
+        self.pattern = torch.tensor(pattern, dtype=torch.long)
+        self.input_width = input_width
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs: Any) -> torch.BoolTensor:
+        del scores, kwargs
+        pattern = self.pattern.to(input_ids.device)
+        if pattern.numel() == 0 or input_ids.shape[1] - self.input_width < pattern.numel():
+            return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        return (input_ids[:, -pattern.numel() :] == pattern).all(dim=1)
+
+
+class _GumbelSamplingProcessor(LogitsProcessor):
+    def __init__(self, generator: torch.Generator) -> None:
+        self.generator = generator
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        del input_ids
+        noise = torch.rand(scores.shape, generator=self.generator, device=scores.device, dtype=torch.float32)
+        return scores.float() - torch.log(-torch.log(noise.clamp_min(1e-20)))
+
+
 class MRVFTrainer:
     def __init__(self, cfg: MRVFConfig) -> None:
         cfg.validate()
         self.cfg = cfg
         self.random = random.Random(cfg.seed)
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.dist = init_distributed(cfg.distributed_backend)
+        self._validate_distributed()
+        self.device = torch.device("cuda", self.dist.local_rank) if torch.cuda.is_available() else torch.device("cpu")
 
         dtype = _resolve_dtype(cfg.torch_dtype)
         model_kwargs: dict[str, Any] = {}
@@ -148,6 +273,23 @@ class MRVFTrainer:
         if self.tokenizer.pad_token_id is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
         self.tokenizer.padding_side = "left"
+        self._static_text_ids: dict[str, list[int]] = {}
+        self._reference_token_budget = cfg.reference_max_tokens_per_forward
+        self._vllm_engine: VLLMRolloutEngine | None = None
+        self._replay_buffer: list[ReplayBatch] = []
+        self._data_stream = DataStreamState()
+        self._checkpoint_writer = CheckpointWriter(background=cfg.async_checkpoint)
+        self._log_lock = threading.Lock()
+        self._prompt_baseline_cache: PromptBaselineCache | None = None
+        self._sequence_logprobs_fn: Callable[..., list[torch.Tensor]] = masked_sequence_logprobs_by_mask
+        if cfg.compile_scoring:
+            self._sequence_logprobs_fn = torch.compile(
+                masked_sequence_logprobs_by_mask,
+                mode=cfg.compile_mode,
+                dynamic=True,
+            )
+        if cfg.prompt_baseline_source == "frozen_base":
+            self._prompt_baseline_cache = PromptBaselineCache(prompt_baseline_cache_path(cfg))
 
         self.model = AutoModelForCausalLM.from_pretrained(cfg.model_name_or_path, **model_kwargs).to(self.device)
         self.model.train()
@@ -160,17 +302,25 @@ class MRVFTrainer:
 
         trainable_params = (param for param in self.model.parameters() if param.requires_grad)
         self.optimizer = AdamW(trainable_params, lr=cfg.learning_rate, weight_decay=cfg.weight_decay)
-        warmup_steps = int(cfg.max_steps * cfg.warmup_ratio)
+        total_steps = cfg.max_steps * cfg.ppo_epochs
         self.scheduler = get_cosine_schedule_with_warmup(
             self.optimizer,
-            num_warmup_steps=warmup_steps,
-            num_training_steps=cfg.max_steps,
+            num_warmup_steps=int(total_steps * cfg.warmup_ratio),
+            num_training_steps=total_steps,
         )
+        if cfg.rollout_backend == "vllm":
+            self._vllm_engine = VLLMRolloutEngine.from_config(cfg)
         self._current_step = 0
+        self._rollout_step = 0
         self._wandb_run: Any | None = None
-        if cfg.report_to_wandb:
+        if cfg.report_to_wandb and self.dist.is_main_process:
             self._init_wandb()
 
+    def _validate_distributed(self) -> None:
+        if self.cfg.rollout_backend == "vllm" and self.dist.enabled:
+            msg = "`rollout_backend=vllm` does not support distributed training."
+            raise ValueError(msg)
+
     def _init_wandb(self) -> None:
         try:
             import wandb
@@ -185,11 +335,14 @@ class MRVFTrainer:
             tags=list(self.cfg.wandb_tags),
             config=asdict(self.cfg),
         )
+        self._wandb_run.define_metric("eval/step")
+        self._wandb_run.define_metric("eval/*", step_metric="eval/step")
 
-    def _wandb_log(self, payload: dict[str, Any], step: int) -> None:
+    def _wandb_log(self, payload: dict[str, Any], step: int | None) -> None:
         if self._wandb_run is None:
             return
-        self._wandb_run.log(payload, step=step)
+        with self._log_lock:
+            self._wandb_run.log(payload, step=step)
 
     def _enable_lora(self) -> None:
         try:
@@ -208,82 +361,79 @@ class MRVFTrainer:
         )
         self.model = get_peft_model(self.model, peft_config)
 
+    def _autocast(self) -> AbstractContextManager[None]:
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.cfg.autocast_bf16)
+
     def _build_trace_prompt_text(self, prompt: str) -> str:
-        trace_prompt = environment.get_template(self.cfg.trace_prompt_template).render(prompt=prompt).strip()
-        if self.cfg.trace_format == "qwen_chat_thinking":
-            messages = [{"role": "user", "content": trace_prompt}]
-            try:
-                return self.tokenizer.apply_chat_template(
-                    messages,
-                    tokenize=False,
-                    add_generation_prompt=True,
-                    enable_thinking=True,
-                )
-            except TypeError:
-                return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        if not self.cfg.use_thinking:
-            return trace_prompt
-        return f"{trace_prompt}\nThink inside <think>...</think> before the final joke."
-
-    def _generate_trace_batch(self, prompts: list[str], references: list[list[str]]) -> TraceBatch:
-        grouped_prompt_texts: list[str] = []
-        grouped_references: list[list[str]] = []
-        for prompt, refs in zip(prompts, references, strict=True):
-            prompt_text = self._build_trace_prompt_text(prompt)
-            for _ in range(self.cfg.num_generations):
-                grouped_prompt_texts.append(prompt_text)
-                grouped_references.append(refs)
-
-        encoded = self.tokenizer(grouped_prompt_texts, padding=True, add_special_tokens=False, return_tensors="pt")
-        input_ids = encoded["input_ids"].to(self.device)
-        attention_mask = encoded["attention_mask"].to(self.device)
-        input_width = input_ids.shape[1]
-        grouped_prompt_ids = []
-        for row_ids, row_mask in zip(input_ids.tolist(), attention_mask.tolist(), strict=True):
-            grouped_prompt_ids.append([token for token, mask in zip(row_ids, row_mask, strict=True) if mask == 1])
+        return build_trace_prompt_text(self.tokenizer, self.cfg, prompt)
 
-        was_training = self.model.training
-        if self.cfg.gradient_checkpointing and hasattr(self.model, "gradient_checkpointing_disable"):
-            self.model.gradient_checkpointing_disable()
-        self.model.eval()
-        try:
-            with torch.no_grad():
-                generation_kwargs: dict[str, Any] = {
-                    "input_ids": input_ids,
-                    "attention_mask": attention_mask,
-                    "do_sample": True,
-                    "max_new_tokens": self.cfg.max_trace_length,
-                    "temperature": self.cfg.temperature,
-                    "top_p": self.cfg.top_p,
-                    "repetition_penalty": self.cfg.repetition_penalty,
-                    "pad_token_id": self.tokenizer.pad_token_id,
-                }
-                if self.cfg.top_k is not None:
-                    generation_kwargs["top_k"] = self.cfg.top_k
-                generated = self.model.generate(
-                    **generation_kwargs,
+    def _encode_static_text(self, text: str) -> list[int]:
+        if text not in self._static_text_ids:
+            self._static_text_ids[text] = self.tokenizer(text, add_special_tokens=False)["input_ids"]
+        return self._static_text_ids[text]
+
+    def _generate_trace_batch(
+        self,
+        prompts: list[str],
+        references: list[list[str]],
+        *,
+        prompt_texts: list[str] | None = None,
+        prompt_ids: list[list[int]] | None = None,
+        reference_ids: list[list[list[int]]] | None = None,
+        model: torch.nn.Module | None = None,
+        tokenizer: Any | None = None,
+        generator: torch.Generator | None = None,
+        phase_stats: dict[str, float] | None = None,
+    ) -> TraceBatch:
+        model = self.model if model is None else model
+        tokenizer = self.tokenizer if tokenizer is None else tokenizer
+        if prompt_texts is None:
+            with self._timed_phase("prompt_build", phase_stats):
+                prompt_texts = [build_trace_prompt_text(tokenizer, self.cfg, prompt) for prompt in prompts]
+        if prompt_ids is None:
+            with self._timed_phase("tokenize", phase_stats):
+                prompt_ids = tokenizer(prompt_texts, add_special_tokens=False)["input_ids"]
+        num_generations = self.cfg.num_generations
+        grouped_prompt_texts = [text for text in prompt_texts for _ in range(num_generations)]
+        grouped_prompt_ids = [list(ids) for ids in prompt_ids for _ in range(num_generations)]
+        grouped_references = [refs for refs in references for _ in range(num_generations)]
+        grouped_reference_ids = (
+            None if reference_ids is None else [ids for ids in reference_ids for _ in range(num_generations)]
+        )
+
+        think_close_ids = self._encode_static_text("</think>")
+        with self._timed_phase("generate", phase_stats):
+            if self._vllm_engine is not None:
+                stop_token_ids: list[int] = []
+                stop: list[str] = []
+                if self.cfg.stop_at_think_close:
+                    if len(think_close_ids) == 1:
+                        stop_token_ids = think_close_ids
+                    else:
+                        stop = ["</think>"]
+                completions = self._vllm_engine.generate(
+                    [list(ids) for ids in prompt_ids],
+                    stop_token_ids=stop_token_ids,
+                    stop=stop,
+                )
+                decode_steps = max((len(completion) for completion in completions), default=0)
+            else:
+                completions, decode_steps = self._sample_completions(
+                    model,
+                    tokenizer,
+                    [list(ids) for ids in prompt_ids],
+                    grouped_prompt_ids,
+                    generator=generator,
                 )
-        finally:
-            if self.cfg.gradient_checkpointing and hasattr(self.model, "gradient_checkpointing_enable"):
-                self.model.gradient_checkpointing_enable()
-            if was_training:
-                self.model.train()
 
-        think_close_ids = self.tokenizer("</think>", add_special_tokens=False)["input_ids"]
-        forced_suffix_ids = self.tokenizer(self.cfg.forced_thinking_suffix, add_special_tokens=False)["input_ids"]
-        answer_prefix_ids = self.tokenizer(self.cfg.answer_prefix, add_special_tokens=False)["input_ids"]
+        forced_suffix_ids = self._encode_static_text(self.cfg.forced_thinking_suffix)
+        answer_prefix_ids = self._encode_static_text(self.cfg.answer_prefix)
         trace_ids: list[list[int]] = []
         trace_texts: list[str] = []
         reference_prefix_ids: list[list[int]] = []
         forced_think_close: list[bool] = []
         reference_prefix_lengths: list[int] = []
-        for idx in range(generated.shape[0]):
-            row = generated[idx].tolist()
-            completion = extract_completion_ids(
-                row,
-                input_width=input_width,
-                pad_token_id=self.tokenizer.pad_token_id,
-            )
+        for idx, completion in enumerate(completions):
             close_end = _find_subsequence_end(completion, think_close_ids)
             if close_end is not None:
                 sampled_trace = completion[:close_end]
@@ -294,7 +444,7 @@ class MRVFTrainer:
             suffix_ids = forced_suffix_ids if close_was_forced else []
             ref_prefix = grouped_prompt_ids[idx] + sampled_trace + suffix_ids + answer_prefix_ids
             trace_ids.append(sampled_trace)
-            trace_texts.append(self.tokenizer.decode(sampled_trace, skip_special_tokens=True))
+            trace_texts.append(tokenizer.decode(sampled_trace, skip_special_tokens=True))
             reference_prefix_ids.append(ref_prefix)
             forced_think_close.append(close_was_forced)
             reference_prefix_lengths.append(len(ref_prefix))
@@ -308,21 +458,191 @@ class MRVFTrainer:
             forced_think_close=forced_think_close,
             reference_prefix_lengths=reference_prefix_lengths,
             references=grouped_references,
+            reference_ids=grouped_reference_ids,
+            decode_steps=decode_steps,
+        )
+
+    def _sample_completions(
+        self,
+        model: torch.nn.Module,
+        tokenizer: Any,
+        prompt_ids: list[list[int]],
+        grouped_prompt_ids: list[list[int]],
+        generator: torch.Generator | None = None,
+    ) -> tuple[list[list[int]], int]:
+        rows_to_encode = prompt_ids if self.cfg.prefill_prompts_once else grouped_prompt_ids
+        input_ids, attention_mask = _left_pad_ids(rows_to_encode, tokenizer.pad_token_id)
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        input_width = input_ids.shape[1]
+
+        think_close_ids = self._encode_static_text("</think>")
+        was_training = model.training
+        if self.cfg.gradient_checkpointing and hasattr(model, "gradient_checkpointing_disable"):
+            model.gradient_checkpointing_disable()
+        model.eval()
+        try:
+            with torch.no_grad():
+                generation_kwargs: dict[str, Any] = {
+                    "input_ids": input_ids,
+                    "attention_mask": attention_mask,
+                    "max_new_tokens": self.cfg.max_trace_length,
+                    "repetition_penalty": self.cfg.repetition_penalty,
+                    "pad_token_id": tokenizer.pad_token_id,
+                }
+                if generator is None:
+                    generation_kwargs.update(do_sample=True, temperature=self.cfg.temperature, top_p=self.cfg.top_p)
+                    if self.cfg.top_k is not None:
+                        generation_kwargs["top_k"] = self.cfg.top_k
+                else:
+                    generation_kwargs.update(
+                        do_sample=False,
+                        temperature=None,
+                        top_p=None,
+                        top_k=None,
+                        logits_processor=self._seeded_sampling_processors(generator),
+                    )
+                if self.cfg.prefill_prompts_once:
+                    generation_kwargs["past_key_values"] = self._prefill_prompt_cache(
+                        model,
+                        input_ids,
+                        attention_mask,
+                    )
+                    generation_kwargs["input_ids"] = input_ids.repeat_interleave(self.cfg.num_generations, dim=0)
+                    generation_kwargs["attention_mask"] = attention_mask.repeat_interleave(
+                        self.cfg.num_generations,
+                        dim=0,
+                    )
+                if self.cfg.stop_at_think_close and think_close_ids:
+                    generation_kwargs["stopping_criteria"] = StoppingCriteriaList(
+                        [_SubsequenceStoppingCriteria(think_close_ids, input_width=input_width)]
+                    )
+                generated = model.generate(
+                    **generation_kwargs,
+                )
+        finally:
+            if self.cfg.gradient_checkpointing and hasattr(model, "gradient_checkpointing_enable"):
+                model.gradient_checkpointing_enable()
+            if was_training:
+                model.train()
+
+        completions = extract_completion_ids_batch(
+            generated,
+            input_width=input_width,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+        return completions, generated.shape[1] - input_width
+
+    def _seeded_sampling_processors(self, generator: torch.Generator) -> LogitsProcessorList:
+        # Gumbel-max over the warped scores samples like do_sample=True but draws from `generator`
+        # instead of the global torch RNG the learner uses.
+        processors: list[LogitsProcessor] = [TemperatureLogitsWarper(self.cfg.temperature)]
+        if self.cfg.top_k is not None:
+            processors.append(TopKLogitsWarper(self.cfg.top_k))
+        if self.cfg.top_p < 1.0:
+            processors.append(TopPLogitsWarper(self.cfg.top_p))
+        processors.append(_GumbelSamplingProcessor(generator))
+        return LogitsProcessorList(processors)
+
+    def _prefill_prompt_cache(
+        self,
+        model: torch.nn.Module,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+    ) -> Any | None:
+        if input_ids.shape[1] < 2:
+            return None
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp_min(0)
+        outputs = model(
+            input_ids=input_ids[:, :-1],
+            attention_mask=attention_mask[:, :-1],
+            position_ids=position_ids[:, :-1],
+            use_cache=True,
+            logits_to_keep=1,
         )
+        cache = outputs.past_key_values
+        cache.batch_repeat_interleave(self.cfg.num_generations)
+        return cache
 
-    def _trace_logprobs(self, trace_batch: TraceBatch, model: torch.nn.Module) -> torch.Tensor:
+    def _trace_logprobs(
+        self,
+        trace_batch: TraceBatch,
+        model: torch.nn.Module,
+        rows: list[int] | None = None,
+    ) -> torch.Tensor:
+        if rows is None:
+            rows = list(range(len(trace_batch.trace_ids)))
         input_ids, attention_mask, target_mask = _build_sequence_logprob_inputs(
             tokenizer=self.tokenizer,
-            prefix_ids=trace_batch.prompt_ids,
-            completion_ids=trace_batch.trace_ids,
+            prefix_ids=[trace_batch.prompt_ids[row] for row in rows],
+            completion_ids=[trace_batch.trace_ids[row] for row in rows],
+            pad_to_multiple_of=self.cfg.pad_to_multiple_of,
         )
         return _sequence_logprobs_from_ids(
             model=model,
             input_ids=input_ids.to(self.device),
             attention_mask=attention_mask.to(self.device),
             target_mask=target_mask.to(self.device),
+            target_only=self.cfg.target_only_logits,
+            chunk_size=self.cfg.logprob_chunk_size,
+            sequence_logprobs_fn=self._sequence_logprobs_fn,
+        )
+
+    def _score_references(
+        self,
+        prefix_ids: list[list[int]],
+        references: list[list[str]],
+        reference_ids: list[list[list[int]]] | None = None,
+        *,
+        trace_spans: list[tuple[int, int]] | None = None,
+    ) -> ReferenceLikelihoodOutput:
+        outputs = teacher_forced_reference_logps_from_ids(
+            model=self.model,
+            tokenizer=self.tokenizer,
+            prefix_ids_per_sample=prefix_ids,
+            references=references,
+            reference_ids=reference_ids,
+            max_reference_length=self.cfg.max_reference_length,
+            length_normalization=self.cfg.reference_length_normalization,
+            share_prefix=self.cfg.share_reference_prefix,
+            target_only_logits=self.cfg.target_only_logits,
+            logprob_chunk_size=self.cfg.logprob_chunk_size,
+            max_tokens_per_forward=self._reference_token_budget,
+            trace_spans=trace_spans,
+            sequence_logprobs_fn=self._sequence_logprobs_fn,
+            pad_to_multiple_of=self.cfg.pad_to_multiple_of,
+        )
+        self._reference_token_budget = outputs.max_tokens_per_forward
+        return outputs
+
+    def _score_trace_references(
+        self,
+        trace_batch: TraceBatch,
+        *,
+        include_trace: bool = False,
+    ) -> ReferenceLikelihoodOutput:
+        trace_spans = None
+        if include_trace:
+            trace_spans = [
+                (len(prompt_ids), len(prompt_ids) + len(trace_ids))
+                for prompt_ids, trace_ids in zip(trace_batch.prompt_ids, trace_batch.trace_ids, strict=True)
+            ]
+        return self._score_references(
+            trace_batch.reference_prefix_ids,
+            trace_batch.references,
+            trace_batch.reference_ids,
+            trace_spans=trace_spans,
         )
 
+    def _uses_reference_loss(self) -> bool:
+        return self.cfg.objective_mode != "mrvf_lite" and self.cfg.reference_loss_coef != 0
+
+    def _zero_phase_stats(self, names: tuple[str, ...]) -> dict[str, float]:
+        return zero_phase_stats(names, self.device, track_memory=self.cfg.profile_phase_sync)
+
+    def _timed_phase(self, name: str, phase_stats: dict[str, float] | None) -> AbstractContextManager[None]:
+        return timed_phase(name, phase_stats, self.device, synchronize=self.cfg.profile_phase_sync)
+
     def _compute_kl(self, trace_batch: TraceBatch) -> torch.Tensor:
         del trace_batch
         if self.cfg.use_kl:
@@ -338,6 +658,8 @@ class MRVFTrainer:
     ) -> None:
         if self.cfg.logging_steps <= 0 or step == 0 or step % self.cfg.logging_steps != 0 or sample is None:
             return
+        if not self.dist.is_main_process:
+            return
         payload = {
             "step": step,
             "prompt": sample.prompt,
@@ -352,6 +674,8 @@ class MRVFTrainer:
             handle.write(json.dumps(payload) + "\n")
 
     def _append_metrics_log(self, *, step: int, metrics: dict[str, float], step_seconds: float) -> None:
+        if not self.dist.is_main_process:
+            return
         payload: dict[str, float | int] = {
             "step": step,
             "step_seconds": step_seconds,
@@ -364,7 +688,7 @@ class MRVFTrainer:
 
         path = Path(self.cfg.metrics_log_path)
         path.parent.mkdir(parents=True, exist_ok=True)
-        with path.open("a", encoding="utf-8") as handle:
+        with self._log_lock, path.open("a", encoding="utf-8") as handle:
             handle.write(json.dumps(payload) + "\n")
 
         if self.cfg.logging_steps > 0 and step % self.cfg.logging_steps == 0:
@@ -413,7 +737,7 @@ class MRVFTrainer:
                 for trace in sample.traces
             ],
         )
-        self._wandb_log({"eval/samples": table}, step=step)
+        self._wandb_log({"eval/samples": table, "eval/step": step}, step=None)
 
     def _evaluate_fixed_rows(self, *, rows: list[dict[str, Any]], step: int) -> dict[str, float]:
         if not rows:
@@ -424,11 +748,13 @@ class MRVFTrainer:
         metrics_by_key: dict[str, list[float]] = {}
         last_sample: BatchDebugSample | None = None
         batch_size = max(1, self.cfg.per_device_train_batch_size)
+        eval_phase_stats = self._zero_phase_stats(("eval",))
 
-        with torch.no_grad():
+        with self._timed_phase("eval", eval_phase_stats), torch.no_grad():
             for start in range(0, len(rows), batch_size):
                 batch = rows[start : start + batch_size]
-                _, metrics, sample = self._compute_losses_for_batch(batch)
+                with self._autocast():
+                    _, metrics, sample = self._compute_losses_for_batch(batch)
                 for key, value in metrics.items():
                     metrics_by_key.setdefault(key, []).append(value)
                 last_sample = sample
@@ -442,12 +768,13 @@ class MRVFTrainer:
         }
         if "eval/reward_mean" in eval_metrics:
             eval_metrics["eval/log_mass_mean"] = eval_metrics["eval/reward_mean"]
+        eval_metrics.update({f"eval/{key}": value for key, value in eval_phase_stats.items()})
         eval_payload = {"step": step, **eval_metrics}
         path = Path(self.cfg.metrics_log_path)
         path.parent.mkdir(parents=True, exist_ok=True)
-        with path.open("a", encoding="utf-8") as handle:
+        with self._log_lock, path.open("a", encoding="utf-8") as handle:
             handle.write(json.dumps(eval_payload) + "\n")
-        self._wandb_log(eval_metrics, step=step)
+        self._wandb_log({**eval_metrics, "eval/step": step}, step=None)
         self._log_eval_sample_table(step=step, sample=last_sample)
         print(json.dumps(eval_payload), flush=True)
         return eval_metrics
@@ -455,57 +782,190 @@ class MRVFTrainer:
     def _save_checkpoint(self, step: int) -> None:
         if self.cfg.save_steps <= 0 or step == 0 or step % self.cfg.save_steps != 0:
             return
+        data_streams = all_gather_objects(self._data_stream_snapshot(), self.dist)
+        if not self.dist.is_main_process:
+            return
+        if self._prompt_baseline_cache is not None:
+            self._prompt_baseline_cache.save()
         checkpoint_dir = Path(self.cfg.output_dir) / f"step-{step}"
-        checkpoint_dir.mkdir(parents=True, exist_ok=True)
-        self.model.save_pretrained(checkpoint_dir)
-        self.tokenizer.save_pretrained(checkpoint_dir)
+        staging_dir = checkpoint_dir.with_name(f"{checkpoint_dir.name}.tmp")
+        self._checkpoint_writer.wait()
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        staging_dir.mkdir(parents=True, exist_ok=True)
+        self.tokenizer.save_pretrained(staging_dir)
+        model_state = self._checkpoint_model_state()
+        trainer_state = {
+            "step": step,
+            "rollout_step": self._rollout_step,
+            "optimizer": cpu_snapshot(self.optimizer.state_dict()),
+            "scheduler": self.scheduler.state_dict(),
+            "data_streams": data_streams,
+            "torch_rng": torch.get_rng_state(),
+            "cuda_rng": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        }
 
-    def _compute_losses_for_batch(
+        def write() -> None:
+            self.model.save_pretrained(staging_dir, state_dict=model_state)
+            torch.save(trainer_state, staging_dir / TRAINER_STATE_NAME)
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+            staging_dir.rename(checkpoint_dir)
+            prune_checkpoints(self.cfg.output_dir, self.cfg.save_total_limit)
+
+        self._checkpoint_writer.submit(write)
+
+    def _checkpoint_model_state(self) -> dict[str, torch.Tensor]:
+        state = self.model.state_dict()
+        if self.cfg.use_peft:
+            trainable = {name for name, param in self.model.named_parameters() if param.requires_grad}
+            state = {name: value for name, value in state.items() if name in trainable}
+        return cpu_snapshot(state)
+
+    def _load_checkpoint(self, checkpoint_dir: Path) -> int:
+        weights = load_model_weights(checkpoint_dir)
+        if self.cfg.use_peft:
+            from peft import set_peft_model_state_dict
+
+            set_peft_model_state_dict(self.model, weights)
+        else:
+            self.model.load_state_dict(weights, strict=False)
+        trainer_state = torch.load(checkpoint_dir / TRAINER_STATE_NAME, map_location="cpu")
+        self.optimizer.load_state_dict(trainer_state["optimizer"])
+        self.scheduler.load_state_dict(trainer_state["scheduler"])
+        data_streams = trainer_state["data_streams"]
+        if len(data_streams) != self.dist.world_size:
+            msg = f"Checkpoint `{checkpoint_dir}` was saved with {len(data_streams)} ranks, not {self.dist.world_size}."
+            raise RuntimeError(msg)
+        self._restore_data_stream(data_streams[self.dist.rank])
+        if not self.dist.enabled:
+            torch.set_rng_state(trainer_state["torch_rng"])
+            if torch.cuda.is_available() and trainer_state["cuda_rng"]:
+                torch.cuda.set_rng_state_all(trainer_state["cuda_rng"])
+        self._rollout_step = int(trainer_state["rollout_step"])
+        return int(trainer_state["step"])
+
+    def _data_stream_snapshot(self) -> dict[str, Any]:
+        stream = self._data_stream
+        return {
+            "python_rng": self.random.getstate(),
+            "order": list(stream.order),
+            "cursor": stream.cursor,
+            "pending_batches": [*stream.in_flight, *stream.pending_batches],
+            "replay_queue": [_replay_state(item) for item in stream.replay_queue],
+            "rollout_generator": stream.rollout_generator,
+        }
+
+    def _restore_data_stream(self, state: dict[str, Any]) -> None:
+        self.random.setstate(state["python_rng"])
+        self._data_stream = DataStreamState(
+            order=list(state["order"]),
+            rank_order=shard_rows(list(state["order"]), self.dist),
+            cursor=state["cursor"],
+            pending_batches=deque(state["pending_batches"]),
+            replay_queue=deque(_restore_replay(item, self.device) for item in state["replay_queue"]),
+            rollout_generator=state["rollout_generator"],
+        )
+
+    def _generate_rows_trace_batch(
         self,
         batch_rows: list[dict[str, Any]],
-    ) -> tuple[torch.Tensor, dict[str, float], BatchDebugSample | None]:
-        prompts = [row["prompt"] for row in batch_rows]
+        *,
+        model: torch.nn.Module | None = None,
+        tokenizer: Any | None = None,
+        generator: torch.Generator | None = None,
+        phase_stats: dict[str, float] | None = None,
+    ) -> TraceBatch:
+        pretokenized = all("trace_prompt_ids" in row for row in batch_rows)
+        return self._generate_trace_batch(
+            [row["prompt"] for row in batch_rows],
+            [row["references"][: self.cfg.num_reference_samples] for row in batch_rows],
+            prompt_texts=[row["trace_prompt"] for row in batch_rows] if pretokenized else None,
+            prompt_ids=[row["trace_prompt_ids"] for row in batch_rows] if pretokenized else None,
+            reference_ids=[row["reference_ids"] for row in batch_rows] if pretokenized else None,
+            model=model,
+            tokenizer=tokenizer,
+            generator=generator,
+            phase_stats=phase_stats,
+        )
+
+    def _frozen_prompt_baselines(
+        self,
+        prefix_ids: list[list[int]],
+        references: list[list[str]],
+        reference_ids: list[list[list[int]]] | None,
+        phase_stats: dict[str, float],
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        cache = self._prompt_baseline_cache
+        if cache is None:
+            msg = "Frozen-base prompt baseline cache is not initialized."
+            raise RuntimeError(msg)
+        keys = [
+            prompt_baseline_key(prefix, refs, None if reference_ids is None else reference_ids[index])
+            for index, (prefix, refs) in enumerate(zip(prefix_ids, references, strict=True))
+        ]
+        missing = [index for index, key in enumerate(keys) if cache.get(key) is None]
+        if missing:
+            with self._timed_phase("prompt_baseline_pass", phase_stats), torch.no_grad():
+                with self.model.disable_adapter():
+                    outputs = self._score_references(
+                        [prefix_ids[index] for index in missing],
+                        [references[index] for index in missing],
+                        None if reference_ids is None else [reference_ids[index] for index in missing],
+                    )
+            normalized = outputs.log_mass_normalized.tolist()
+            raw = outputs.log_mass_raw.tolist()
+            for offset, index in enumerate(missing):
+                cache.put(keys[index], normalized[offset], raw[offset])
+        phase_stats["prompt_baseline_cache_hit_rate"] = 1.0 - len(missing) / max(len(keys), 1)
+        values = torch.tensor([cache.get(key) for key in keys], dtype=torch.float32, device=self.device)
+        return values[:, 0], values[:, 1]
+
+    def _compute_rewards(
+        self,
+        batch_rows: list[dict[str, Any]],
+        trace_batch: TraceBatch,
+        phase_stats: dict[str, float],
+    ) -> tuple[ReferenceLikelihoodOutput | None, torch.Tensor, torch.Tensor | None]:
         references = [row["references"][: self.cfg.num_reference_samples] for row in batch_rows]
-        trace_batch = self._generate_trace_batch(prompts, references)
+        pretokenized = all("trace_prompt_ids" in row for row in batch_rows)
+        reference_ids = [row["reference_ids"] for row in batch_rows] if pretokenized else None
         grouped_size = len(batch_rows)
-        answer_prefix_ids = self.tokenizer(self.cfg.answer_prefix, add_special_tokens=False)["input_ids"]
-
-        trace_logprob = self._trace_logprobs(trace_batch, self.model)
-        with torch.no_grad():
-            reward_outputs = teacher_forced_reference_logps_from_ids(
-                model=self.model,
-                tokenizer=self.tokenizer,
-                prefix_ids_per_sample=trace_batch.reference_prefix_ids,
-                references=trace_batch.references,
-                max_reference_length=self.cfg.max_reference_length,
-                length_normalization=self.cfg.reference_length_normalization,
-            )
-            prompt_baseline_scores: torch.Tensor | None = None
-            if self.cfg.reward_baseline_mode == "prompt_relative":
-                prompt_prefix_ids = [
-                    trace_batch.prompt_ids[index * self.cfg.num_generations] + answer_prefix_ids
-                    for index in range(grouped_size)
-                ]
-                prompt_baseline_outputs = teacher_forced_reference_logps_from_ids(
-                    model=self.model,
-                    tokenizer=self.tokenizer,
-                    prefix_ids_per_sample=prompt_prefix_ids,
-                    references=references,
-                    max_reference_length=self.cfg.max_reference_length,
-                    length_normalization=self.cfg.reference_length_normalization,
+        answer_prefix_ids = self._encode_static_text(self.cfg.answer_prefix)
+
+        if self.cfg.single_pass_reference_scoring:
+            with self._timed_phase("reference_pass", phase_stats):
+                needs_grad = self._uses_reference_loss() or self.cfg.fuse_trace_logprobs
+                with torch.set_grad_enabled(torch.is_grad_enabled() and needs_grad):
+                    ref_outputs = self._score_trace_references(
+                        trace_batch,
+                        include_trace=self.cfg.fuse_trace_logprobs,
+                    )
+            reward_outputs = ref_outputs.detach()
+        else:
+            ref_outputs = None
+            with self._timed_phase("reward_pass", phase_stats), torch.no_grad():
+                reward_outputs = self._score_trace_references(trace_batch)
+        prompt_baseline_scores: torch.Tensor | None = None
+        if self.cfg.reward_baseline_mode == "prompt_relative":
+            prompt_prefix_ids = [
+                trace_batch.prompt_ids[index * self.cfg.num_generations] + answer_prefix_ids
+                for index in range(grouped_size)
+            ]
+            if self.cfg.prompt_baseline_source == "frozen_base":
+                baseline_normalized, baseline_raw = self._frozen_prompt_baselines(
+                    prompt_prefix_ids,
+                    references,
+                    reference_ids,
+                    phase_stats,
                 )
-                if self.cfg.objective_mode == "log_mass_surrogate":
-                    prompt_baseline_scores = prompt_baseline_outputs.log_mass_normalized
-                else:
-                    prompt_baseline_scores = prompt_baseline_outputs.log_mass_raw
-        ref_outputs = teacher_forced_reference_logps_from_ids(
-            model=self.model,
-            tokenizer=self.tokenizer,
-            prefix_ids_per_sample=trace_batch.reference_prefix_ids,
-            references=trace_batch.references,
-            max_reference_length=self.cfg.max_reference_length,
-            length_normalization=self.cfg.reference_length_normalization,
-        )
+            else:
+                with self._timed_phase("prompt_baseline_pass", phase_stats), torch.no_grad():
+                    prompt_baseline_outputs = self._score_references(prompt_prefix_ids, references, reference_ids)
+                baseline_normalized = prompt_baseline_outputs.log_mass_normalized
+                baseline_raw = prompt_baseline_outputs.log_mass_raw
+            if self.cfg.objective_mode == "log_mass_surrogate":
+                prompt_baseline_scores = baseline_normalized
+            else:
+                prompt_baseline_scores = baseline_raw
 
         if self.cfg.objective_mode == "log_mass_surrogate":
             grouped_scores_for_reward = reward_outputs.log_mass_normalized.view(grouped_size, self.cfg.num_generations)
@@ -523,14 +983,94 @@ class MRVFTrainer:
             centered = grouped_scores_for_reward - grouped_scores_for_reward.max(dim=1, keepdim=True).values
             rewards = torch.exp(centered).reshape(-1)
 
-        rewards_for_adv = rewards.detach()
-        if self.cfg.advantage_mode == "loo":
-            advantages = loo_advantages(rewards_for_adv, self.cfg.num_generations)
+        return ref_outputs, rewards.detach(), prompt_baseline_scores
+
+    def _compute_losses_for_batch(
+        self,
+        batch_rows: list[dict[str, Any]],
+        trace_batch: TraceBatch | None = None,
+        replay: ReplayBatch | None = None,
+    ) -> tuple[torch.Tensor, dict[str, float], BatchDebugSample | None]:
+        phase_stats = self._zero_phase_stats(COMPUTE_PHASES)
+        if replay is not None:
+            trace_batch = replay.trace_batch
+        elif trace_batch is None:
+            trace_batch = self._generate_rows_trace_batch(batch_rows, phase_stats=phase_stats)
+        grouped_size = len(batch_rows)
+
+        ref_outputs: ReferenceLikelihoodOutput | None = None
+        if replay is None:
+            ref_outputs, rewards_for_adv, prompt_baseline_scores = self._compute_rewards(
+                batch_rows,
+                trace_batch,
+                phase_stats,
+            )
+            if self.cfg.advantage_mode == "loo":
+                advantages = loo_advantages(rewards_for_adv, self.cfg.num_generations)
+            else:
+                advantages = grpo_zscore_advantages(rewards_for_adv, self.cfg.num_generations)
+        else:
+            rewards_for_adv = replay.rewards
+            advantages = replay.advantages
+            prompt_baseline_scores = replay.prompt_baseline_scores
+        if ref_outputs is None:
+            with self._timed_phase("reference_pass", phase_stats):
+                ref_outputs = self._score_trace_references(trace_batch, include_trace=self.cfg.fuse_trace_logprobs)
+
+        trace_rows = list(range(advantages.numel()))
+        if self.cfg.skip_zero_advantage_groups:
+            active_groups = active_group_mask(
+                advantages,
+                self.cfg.num_generations,
+                self.cfg.zero_advantage_threshold,
+            ).tolist()
+            trace_rows = [row for row in trace_rows if active_groups[row // self.cfg.num_generations]]
+        skipped_group_fraction = 1.0 - len(trace_rows) / max(advantages.numel(), 1)
+        if self.cfg.fuse_trace_logprobs:
+            if ref_outputs.trace_logps is None:
+                msg = "Fused trace log-probs were not computed."
+                raise RuntimeError(msg)
+            trace_logprob = ref_outputs.trace_logps
+            kept_logprob = trace_logprob
+        elif trace_rows:
+            with self._timed_phase("trace_logprob", phase_stats):
+                kept_logprob = self._trace_logprobs(trace_batch, self.model, trace_rows)
+            row_index = torch.tensor(trace_rows, dtype=torch.long, device=kept_logprob.device)
+            trace_logprob = torch.zeros_like(advantages, dtype=kept_logprob.dtype)
+            trace_logprob = trace_logprob.index_copy(0, row_index, kept_logprob)
         else:
-            advantages = grpo_zscore_advantages(rewards_for_adv, self.cfg.num_generations)
-        trace_loss = -(advantages * trace_logprob).mean()
+            kept_logprob = torch.zeros(1, dtype=advantages.dtype, device=self.device)
+            trace_logprob = torch.zeros_like(advantages)
+        ppo_ratio: torch.Tensor | None = None
+        if self.cfg.ppo_epochs > 1:
+            old_trace_logprob = trace_logprob.detach() if replay is None else replay.old_trace_logprob
+            trace_lengths = torch.tensor(
+                [max(len(ids), 1) for ids in trace_batch.trace_ids],
+                dtype=trace_logprob.dtype,
+                device=trace_logprob.device,
+            )
+            trace_loss, ppo_ratio = ppo_clipped_loss(
+                trace_logprob,
+                old_trace_logprob,
+                advantages,
+                self.cfg.ppo_clip_epsilon,
+                lengths=trace_lengths,
+            )
+            if replay is None and torch.is_grad_enabled():
+                self._replay_buffer.append(
+                    ReplayBatch(
+                        batch_rows=batch_rows,
+                        trace_batch=trace_batch,
+                        rewards=rewards_for_adv,
+                        advantages=advantages,
+                        old_trace_logprob=old_trace_logprob,
+                        prompt_baseline_scores=prompt_baseline_scores,
+                    )
+                )
+        else:
+            trace_loss = -(advantages * trace_logprob).mean()
 
-        if self.cfg.objective_mode == "mrvf_lite" or self.cfg.reference_loss_coef == 0:
+        if not self._uses_reference_loss():
             reference_loss = torch.zeros((), device=self.device)
         elif self.cfg.objective_mode == "log_mass_surrogate":
             reference_loss = -ref_outputs.log_mass_normalized.mean()
@@ -546,76 +1086,107 @@ class MRVFTrainer:
             + self.cfg.beta * kl_term
         )
         grouped_rewards = rewards_for_adv.view(grouped_size, self.cfg.num_generations)
-        trace_lengths = torch.tensor(
-            [len(trace_ids) for trace_ids in trace_batch.trace_ids],
-            dtype=torch.float32,
-            device=self.device,
-        )
-        if trace_lengths.numel() == 0:
-            trace_lengths = torch.zeros(1, dtype=torch.float32, device=self.device)
-        truncated = torch.tensor(
-            [len(trace_ids) >= self.cfg.max_trace_length for trace_ids in trace_batch.trace_ids],
-            dtype=torch.float32,
-            device=self.device,
-        )
-        closed_think = torch.tensor(
-            ["</think>" in trace_text for trace_text in trace_batch.trace_texts],
-            dtype=torch.float32,
-            device=self.device,
-        )
-        empty_trace = torch.tensor(
-            [len(trace_ids) == 0 for trace_ids in trace_batch.trace_ids],
-            dtype=torch.float32,
-            device=self.device,
-        )
-        forced_close = torch.tensor(trace_batch.forced_think_close, dtype=torch.float32, device=self.device)
-        reference_prefix_lengths = torch.tensor(
-            trace_batch.reference_prefix_lengths,
-            dtype=torch.float32,
-            device=self.device,
-        )
-        if reference_prefix_lengths.numel() == 0:
-            reference_prefix_lengths = torch.zeros(1, dtype=torch.float32, device=self.device)
-        metrics = {
-            "loss": float(loss.detach().item()),
-            "trace_loss": float(trace_loss.detach().item()),
-            "reference_loss": float(reference_loss.detach().item()),
-            "kl": float(kl_term.detach().item()),
-            "reward_mean": float(rewards_for_adv.mean().item()),
-            "reward_std": float(rewards_for_adv.std(unbiased=False).item()),
-            "reward_group_std_mean": float(grouped_rewards.std(dim=1, unbiased=False).mean().item()),
-            "advantage_mean": float(advantages.mean().item()),
-            "advantage_std": float(advantages.std(unbiased=False).item()),
-            "advantage_abs_mean": float(advantages.abs().mean().item()),
-            "trace_logprob_mean": float(trace_logprob.detach().mean().item()),
-            "trace_logprob_std": float(trace_logprob.detach().std(unbiased=False).item()),
-            "trace_token_length_mean": float(trace_lengths.mean().item()),
-            "trace_token_length_max": float(trace_lengths.max().item()),
-            "trace_truncated_fraction": float(truncated.mean().item()) if truncated.numel() else 0.0,
-            "closed_think_fraction": float(closed_think.mean().item()) if closed_think.numel() else 0.0,
-            "empty_trace_fraction": float(empty_trace.mean().item()) if empty_trace.numel() else 0.0,
-            "forced_think_close_fraction": float(forced_close.mean().item()) if forced_close.numel() else 0.0,
-            "effective_reference_prefix_length_mean": float(reference_prefix_lengths.mean().item()),
-            "effective_reference_prefix_length_max": float(reference_prefix_lengths.max().item()),
-        }
+        first_group_end = min(self.cfg.num_generations, len(trace_batch.trace_texts)) if batch_rows else 0
+        device_metrics = [
+            loss,
+            trace_loss,
+            reference_loss,
+            kl_term,
+            rewards_for_adv.mean(),
+            rewards_for_adv.std(unbiased=False),
+            grouped_rewards.std(dim=1, unbiased=False).mean(),
+            advantages.mean(),
+            advantages.std(unbiased=False),
+            advantages.abs().mean(),
+            kept_logprob.mean(),
+            kept_logprob.std(unbiased=False),
+        ]
+        if ppo_ratio is not None:
+            clipped = ppo_clip_mask(ppo_ratio, advantages, self.cfg.ppo_clip_epsilon)
+            device_metrics.extend([ppo_ratio.mean(), ppo_ratio.min(), ppo_ratio.max(), clipped.float().mean()])
         if self.cfg.reward_baseline_mode == "prompt_relative":
             if prompt_baseline_scores is None:
                 msg = "Prompt baseline scores were not computed."
                 raise RuntimeError(msg)
-            metrics["prompt_baseline_reward_mean"] = float(prompt_baseline_scores.detach().mean().item())
-            metrics["relative_reward_mean"] = float(rewards_for_adv.mean().item())
-            metrics["relative_reward_std"] = float(rewards_for_adv.std(unbiased=False).item())
+            device_metrics.append(prompt_baseline_scores.mean())
+        host_values = torch.cat(
+            [
+                torch.stack([value.detach().float().reshape(()) for value in device_metrics]),
+                rewards_for_adv[:first_group_end].detach().float(),
+                advantages[:first_group_end].detach().float(),
+            ]
+        ).tolist()
+        scalar_values = iter(host_values[: len(device_metrics)])
+        sample_rewards = host_values[len(device_metrics) : len(device_metrics) + first_group_end]
+        sample_advantages = host_values[len(device_metrics) + first_group_end :]
+
+        num_traces = len(trace_batch.trace_ids)
+        trace_lengths = [len(trace_ids) for trace_ids in trace_batch.trace_ids]
+        reference_prefix_lengths = trace_batch.reference_prefix_lengths
+        loss_value = next(scalar_values)
+        trace_loss_value = next(scalar_values)
+        reference_loss_value = next(scalar_values)
+        metrics = {
+            "loss": loss_value,
+            "trace_loss": trace_loss_value,
+            "reference_loss": reference_loss_value,
+            "kl": next(scalar_values),
+            "reward_mean": next(scalar_values),
+            "reward_std": next(scalar_values),
+            "reward_group_std_mean": next(scalar_values),
+            "advantage_mean": next(scalar_values),
+            "advantage_std": next(scalar_values),
+            "advantage_abs_mean": next(scalar_values),
+            "trace_logprob_mean": next(scalar_values),
+            "trace_logprob_std": next(scalar_values),
+            "skipped_group_fraction": skipped_group_fraction,
+            "trace_token_length_mean": sum(trace_lengths) / max(num_traces, 1),
+            "trace_token_length_max": float(max(trace_lengths, default=0)),
+            "trace_truncated_fraction": (
+                sum(length >= self.cfg.max_trace_length for length in trace_lengths) / num_traces if num_traces else 0.0
+            ),
+            "closed_think_fraction": (
+                sum("</think>" in trace_text for trace_text in trace_batch.trace_texts) / num_traces
+                if num_traces
+                else 0.0
+            ),
+            "empty_trace_fraction": sum(length == 0 for length in trace_lengths) / num_traces if num_traces else 0.0,
+            "forced_think_close_fraction": sum(trace_batch.forced_think_close) / num_traces if num_traces else 0.0,
+            "effective_reference_prefix_length_mean": (
+                sum(reference_prefix_lengths) / max(len(reference_prefix_lengths), 1)
+            ),
+            "effective_reference_prefix_length_max": float(max(reference_prefix_lengths, default=0)),
+            "trace_decode_steps": float(trace_batch.decode_steps),
+            "trace_decode_tokens_saved": float(
+                len(trace_batch.trace_ids) * max(self.cfg.max_trace_length - trace_batch.decode_steps, 0)
+            ),
+            "reference_forward_passes": float(ref_outputs.forward_passes),
+            "reference_max_tokens_per_forward": float(self._reference_token_budget),
+            "replay_epoch": float(replay.epoch if replay is not None else 1),
+            **phase_stats,
+        }
+        if ppo_ratio is not None:
+            metrics["ppo_ratio_mean"] = next(scalar_values)
+            metrics["ppo_ratio_min"] = next(scalar_values)
+            metrics["ppo_ratio_max"] = next(scalar_values)
+            metrics["ppo_clip_fraction"] = next(scalar_values)
+        if self.cfg.reward_baseline_mode == "prompt_relative":
+            metrics["prompt_baseline_reward_mean"] = next(scalar_values)
+            metrics["prompt_baseline_frozen"] = float(self.cfg.prompt_baseline_source == "frozen_base")
+            if self.cfg.prompt_baseline_source == "frozen_base":
+                metrics.setdefault("prompt_baseline_cache_hit_rate", 1.0)
+            metrics["relative_reward_mean"] = metrics["reward_mean"]
+            metrics["relative_reward_std"] = metrics["reward_std"]
         sample: BatchDebugSample | None = None
         if batch_rows:
-            first_group_end = min(self.cfg.num_generations, len(trace_batch.trace_texts))
             trace_samples = [
                 TraceDebugSample(
                     trace_index=idx,
                     trace=trace_batch.trace_texts[idx],
-                    reward=float(rewards_for_adv[idx].item()),
-                    advantage=float(advantages[idx].item()),
-                    trace_token_length=len(trace_batch.trace_ids[idx]),
-                    is_truncated=len(trace_batch.trace_ids[idx]) >= self.cfg.max_trace_length,
+                    reward=sample_rewards[idx],
+                    advantage=sample_advantages[idx],
+                    trace_token_length=trace_lengths[idx],
+                    is_truncated=trace_lengths[idx] >= self.cfg.max_trace_length,
                     closed_think="</think>" in trace_batch.trace_texts[idx],
                     forced_think_close=trace_batch.forced_think_close[idx],
                     forced_suffix_preview=(
@@ -629,23 +1200,118 @@ class MRVFTrainer:
                 prompt=batch_rows[0]["prompt"],
                 references=trace_batch.references[0] if trace_batch.references else [],
                 traces=trace_samples,
-                trace_loss=float(trace_loss.detach().item()),
-                reference_loss=float(reference_loss.detach().item()),
+                trace_loss=trace_loss_value,
+                reference_loss=reference_loss_value,
             )
         return loss, metrics, sample
 
+    def _tokenize_dataset(self, dataset: Dataset) -> Dataset:
+        return tokenize_mrvf_dataset(
+            dataset,
+            tokenizer=self.tokenizer,
+            cfg=self.cfg,
+            cache_dir=Path(self.cfg.dataset_cache_dir),
+        )
+
+    def _next_batch_indices(self, num_rows: int, batch_size: int) -> list[int]:
+        stream = self._data_stream
+        if stream.pending_batches:
+            return stream.pending_batches.popleft()
+        if stream.cursor >= len(stream.rank_order):
+            if not stream.order:
+                stream.order = list(range(num_rows))
+            self.random.shuffle(stream.order)
+            stream.rank_order = shard_rows(stream.order, self.dist)
+            stream.cursor = 0
+        batch = stream.rank_order[stream.cursor : stream.cursor + batch_size]
+        stream.cursor += batch_size
+        return batch
+
+    def _evaluation_view(self, model: torch.nn.Module, tokenizer: Any) -> MRVFTrainer:
+        view = copy.copy(self)
+        view.model = model
+        view.tokenizer = tokenizer
+        view._static_text_ids = dict(self._static_text_ids)
+        view._vllm_engine = None
+        view._replay_buffer = []
+        view._sequence_logprobs_fn = masked_sequence_logprobs_by_mask
+        return view
+
+    def _start_evaluator(self, eval_rows: list[dict[str, Any]]) -> AsyncEvaluator:
+        eval_tokenizer = copy.deepcopy(self.tokenizer)
+
+        def evaluate(model: torch.nn.Module, step: int) -> dict[str, float]:
+            return self._evaluation_view(model, eval_tokenizer)._evaluate_fixed_rows(rows=eval_rows, step=step)
+
+        return AsyncEvaluator(policy_model=self.model, evaluate_fn=evaluate)
+
+    def _start_rollout_worker(
+        self,
+        train_dataset: Dataset,
+        policy_version: int,
+        generator_state: torch.Tensor | None,
+    ) -> AsyncRolloutWorker:
+        for text in ("</think>", self.cfg.forced_thinking_suffix, self.cfg.answer_prefix):
+            self._encode_static_text(text)
+        rollout_tokenizer = copy.deepcopy(self.tokenizer)
+
+        def generate(
+            model: torch.nn.Module,
+            indices: list[int],
+            generator: torch.Generator,
+        ) -> tuple[list[dict[str, Any]], TraceBatch]:
+            batch_rows = _dataset_rows(train_dataset, indices)
+            with self._autocast():
+                trace_batch = self._generate_rows_trace_batch(
+                    batch_rows,
+                    model=model,
+                    tokenizer=rollout_tokenizer,
+                    generator=generator,
+                )
+            return batch_rows, trace_batch
+
+        worker = AsyncRolloutWorker(
+            policy_model=self.model,
+            generate_fn=generate,
+            seed=self.cfg.seed + self.dist.rank,
+            device=self.device,
+            policy_version=policy_version,
+        )
+        if generator_state is not None:
+            worker.generator.set_state(generator_state)
+        worker.start()
+        return worker
+
     def train(self, raw_train_dataset: Dataset, raw_eval_dataset: Dataset) -> dict[str, Any]:
-        train_dataset = prepare_mrvf_dataset(raw_train_dataset, max_reference_samples=self.cfg.num_reference_samples)
-        eval_dataset = prepare_mrvf_dataset(raw_eval_dataset, max_reference_samples=self.cfg.num_reference_samples)
-        train_rows = [dict(item) for item in train_dataset]
-        if not train_rows:
+        cache_dir = Path(self.cfg.dataset_cache_dir)
+        if not self.dist.is_main_process:
+            barrier(self.dist)
+        train_dataset = prepare_mrvf_dataset(
+            raw_train_dataset,
+            max_reference_samples=self.cfg.num_reference_samples,
+            cache_dir=cache_dir,
+        )
+        eval_dataset = prepare_mrvf_dataset(
+            raw_eval_dataset,
+            max_reference_samples=self.cfg.num_reference_samples,
+            cache_dir=cache_dir,
+        )
+        if self.cfg.pretokenize_dataset:
+            train_dataset = self._tokenize_dataset(train_dataset)
+            eval_dataset = self._tokenize_dataset(eval_dataset)
+        if self.dist.is_main_process:
+            barrier(self.dist)
+        if len(train_dataset) == 0:
             msg = "Prepared training dataset is empty."
             raise RuntimeError(msg)
-        eval_rows = [dict(item) for item in eval_dataset]
+        if len(train_dataset) < self.dist.world_size:
+            msg = "Prepared training dataset has fewer rows than distributed ranks."
+            raise RuntimeError(msg)
+        eval_indices = list(range(len(eval_dataset)))
         eval_rng = random.Random(self.cfg.seed)
-        eval_rng.shuffle(eval_rows)
+        eval_rng.shuffle(eval_indices)
         if self.cfg.eval_sample_size > 0:
-            eval_rows = eval_rows[: self.cfg.eval_sample_size]
+            eval_rows = _dataset_rows(eval_dataset, eval_indices[: self.cfg.eval_sample_size])
         else:
             eval_rows = []
 
@@ -653,55 +1319,153 @@ class MRVFTrainer:
         accum = max(1, self.cfg.gradient_accumulation_steps)
         self.optimizer.zero_grad(set_to_none=True)
         global_step = 0
+        self._rollout_step = 0
+        self._data_stream = DataStreamState()
+        resume_dir = resolve_resume_checkpoint(self.cfg.output_dir, self.cfg.resume_from_checkpoint)
+        if resume_dir is not None:
+            global_step = self._load_checkpoint(resume_dir)
         accum_count = 0
         history: list[dict[str, float]] = []
-        self._current_step = 0
+        self._current_step = global_step
         pending_sample: BatchDebugSample | None = None
         pending_metrics: dict[str, float] | None = None
         step_started_at = time.perf_counter()
+        step_phase_stats = self._zero_phase_stats(STEP_PHASES)
+        profiler = StepProfiler(
+            start_step=self.cfg.profile_start_step,
+            end_step=self.cfg.profile_end_step,
+            metrics_log_path=self.cfg.metrics_log_path,
+            device=self.device,
+            enabled=self.dist.is_main_process,
+        )
 
-        while global_step < self.cfg.max_steps:
-            self.random.shuffle(train_rows)
-            for start in range(0, len(train_rows), batch_size):
-                batch = train_rows[start : start + batch_size]
-                if not batch:
-                    continue
-                loss, metrics, sample = self._compute_losses_for_batch(batch)
-                (loss / accum).backward()
+        stream = self._data_stream
+        gradient_reducer = GradientReducer(self.model.parameters(), self.dist)
+        replay_queue = stream.replay_queue
+        rollout_versions: list[int] = []
+        rollout_worker: AsyncRolloutWorker | None = None
+        if self.cfg.async_rollout:
+            rollout_worker = self._start_rollout_worker(train_dataset, global_step, stream.rollout_generator)
+            for _ in range(self.cfg.rollout_queue_size):
+                stream.in_flight.append(self._next_batch_indices(len(train_dataset), batch_size))
+                rollout_worker.submit(stream.in_flight[-1])
+        evaluator: AsyncEvaluator | None = None
+        if self.cfg.async_eval and self.cfg.eval_every_steps > 0 and eval_rows and self.dist.is_main_process:
+            evaluator = self._start_evaluator(eval_rows)
+        if self._vllm_engine is not None:
+            self._vllm_engine.sync_adapter(self.model, global_step)
+        try:
+            while self._rollout_step < self.cfg.max_steps or replay_queue:
+                profiler.start(global_step + 1)
+                trace_batch: TraceBatch | None = None
+                replay = replay_queue.popleft() if replay_queue else None
+                policy_lag = 0
+                rollout_wait_seconds = 0.0
+                if replay is not None:
+                    batch = replay.batch_rows
+                    policy_lag = global_step - replay.policy_version
+                elif rollout_worker is None:
+                    batch = _dataset_rows(train_dataset, self._next_batch_indices(len(train_dataset), batch_size))
+                else:
+                    wait_started_at = time.perf_counter()
+                    rollout = rollout_worker.get()
+                    rollout_wait_seconds = time.perf_counter() - wait_started_at
+                    stream.in_flight.popleft()
+                    stream.rollout_generator = rollout.generator_state
+                    stream.in_flight.append(self._next_batch_indices(len(train_dataset), batch_size))
+                    rollout_worker.submit(stream.in_flight[-1])
+                    batch = rollout.batch_rows
+                    policy_lag = global_step - rollout.policy_version
+                    if policy_lag <= self.cfg.max_policy_lag:
+                        trace_batch = rollout.trace_batch
+                    else:
+                        policy_lag = 0
+                if replay is None and self._vllm_engine is not None and self._vllm_engine.synced_step is not None:
+                    policy_lag = global_step - self._vllm_engine.synced_step
+                if replay is None:
+                    rollout_versions.append(global_step - policy_lag)
+                with self._autocast():
+                    loss, metrics, sample = self._compute_losses_for_batch(batch, trace_batch, replay)
+                metrics["policy_lag"] = float(policy_lag)
+                metrics["rollout_wait_seconds"] = rollout_wait_seconds
+                gradient_reducer.require_sync = accum_count + 1 == accum
+                if loss.requires_grad:
+                    with self._timed_phase("backward", step_phase_stats):
+                        (loss / accum).backward()
                 history.append(metrics)
                 pending_sample = sample
                 pending_metrics = metrics
                 accum_count += 1
                 if accum_count == accum:
-                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.cfg.max_grad_norm)
-                    self.optimizer.step()
-                    self.scheduler.step()
-                    self.optimizer.zero_grad(set_to_none=True)
+                    with self._timed_phase("optimizer_step", step_phase_stats):
+                        gradient_reducer.finish()
+                        torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.cfg.max_grad_norm)
+                        self.optimizer.step()
+                        self.scheduler.step()
+                        self.optimizer.zero_grad(set_to_none=True)
                     accum_count = 0
                     global_step += 1
                     self._current_step = global_step
-                    self._save_checkpoint(global_step)
+                    if replay is None:
+                        self._rollout_step += 1
+                    if rollout_worker is not None and global_step % self.cfg.rollout_sync_every_steps == 0:
+                        rollout_worker.publish_weights(self.model, global_step)
+                    if self._vllm_engine is not None and global_step % self.cfg.vllm_sync_every_steps == 0:
+                        self._vllm_engine.sync_adapter(self.model, global_step)
+                    for epoch in range(2, self.cfg.ppo_epochs + 1):
+                        replay_queue.extend(
+                            replace(item, epoch=epoch, policy_version=version)
+                            for item, version in zip(self._replay_buffer, rollout_versions, strict=True)
+                        )
+                    self._replay_buffer.clear()
+                    rollout_versions.clear()
+                    with self._timed_phase("checkpoint_save", step_phase_stats):
+                        self._save_checkpoint(global_step)
                     if pending_metrics is not None:
                         now = time.perf_counter()
                         self._append_metrics_log(
                             step=global_step,
-                            metrics=pending_metrics,
+                            metrics=all_reduce_metrics(
+                                {**pending_metrics, **step_phase_stats},
+                                self.dist,
+                                self.device,
+                            ),
                             step_seconds=now - step_started_at,
                         )
                         step_started_at = now
+                    step_phase_stats = self._zero_phase_stats(STEP_PHASES)
                     self._append_sample_log(step=global_step, sample=pending_sample)
-                    if self.cfg.eval_every_steps > 0 and global_step % self.cfg.eval_every_steps == 0:
-                        self._evaluate_fixed_rows(rows=eval_rows, step=global_step)
-                    if global_step >= self.cfg.max_steps:
-                        break
-
-        self.model.save_pretrained(self.cfg.output_dir)
-        self.tokenizer.save_pretrained(self.cfg.output_dir)
+                    if (
+                        self.cfg.eval_every_steps > 0
+                        and global_step % self.cfg.eval_every_steps == 0
+                        and self.dist.is_main_process
+                    ):
+                        if evaluator is None:
+                            self._evaluate_fixed_rows(rows=eval_rows, step=global_step)
+                        else:
+                            evaluator.submit(self.model, global_step)
+                    profiler.stop()
+        finally:
+            gradient_reducer.close()
+            profiler.stop()
+            if rollout_worker is not None:
+                rollout_worker.close()
+            if evaluator is not None:
+                evaluator.close()
+            self._checkpoint_writer.close()
+
+        if self.dist.is_main_process:
+            self.model.save_pretrained(self.cfg.output_dir)
+            self.tokenizer.save_pretrained(self.cfg.output_dir)
+            if self._prompt_baseline_cache is not None:
+                self._prompt_baseline_cache.save()
+        barrier(self.dist)
         if self._wandb_run is not None:
             self._wandb_run.finish()
         return {
             "config": asdict(self.cfg),
             "steps": global_step,
+            "rollout_steps": self._rollout_step,
             "last_metrics": history[-1] if history else {},
             "mean_loss": float(sum(item["loss"] for item in history) / max(len(history), 1)),
         }
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+import threading
+import time
+from typing import Any
+
+import torch
+
+_active_peaks = threading.local()
+
+
+@contextmanager
+def timed_phase(
+    name: str,
+    phase_stats: dict[str, float] | None,
+    device: torch.device,
+    synchronize: bool = False,
+) -> Iterator[None]:
+    if phase_stats is None:
+        yield
+        return
+    synchronize = synchronize and device.type == "cuda"
+    track_memory = synchronize and threading.current_thread() is threading.main_thread()
+    peaks: list[int] = _active_peaks.__dict__.setdefault("stack", [])
+    with torch.profiler.record_function(name):
+        if synchronize:
+            torch.cuda.synchronize(device)
+        if track_memory:
+            if peaks:
+                peaks[-1] = max(peaks[-1], torch.cuda.max_memory_allocated(device))
+            torch.cuda.reset_peak_memory_stats(device)
+            peaks.append(0)
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            if synchronize:
+                torch.cuda.synchronize(device)
+            seconds_key = f"{name}_seconds"
+            phase_stats[seconds_key] = phase_stats.get(seconds_key, 0.0) + time.perf_counter() - started_at
+            if track_memory:
+                peak_bytes = max(peaks.pop(), torch.cuda.max_memory_allocated(device))
+                if peaks:
+                    peaks[-1] = max(peaks[-1], peak_bytes)
+                memory_key = f"{name}_peak_memory_gb"
+                phase_stats[memory_key] = max(phase_stats.get(memory_key, 0.0), peak_bytes / 1e9)
+
+
+def zero_phase_stats(names: tuple[str, ...], device: torch.device, track_memory: bool = False) -> dict[str, float]:
+    stats = {f"{name}_seconds": 0.0 for name in names}
+    if track_memory and device.type == "cuda":
+        stats.update({f"{name}_peak_memory_gb": 0.0 for name in names})
+    return stats
+
+
+def profiler_trace_path(metrics_log_path: str, step: int) -> Path:
+    path = Path(metrics_log_path)
+    return path.with_name(f"{path.stem}.step-{step}.trace.json")
+
+
+class StepProfiler:
+    def __init__(
+        self,
+        *,
+        start_step: int,
+        end_step: int,
+        metrics_log_path: str,
+        device: torch.device,
+        enabled: bool = True,
+    ) -> None:
+        self.start_step = start_step
+        self.end_step = end_step
+        self.metrics_log_path = metrics_log_path
+        self.device = device
+        self.enabled = enabled and start_step > 0
+        self._profiler: Any | None = None
+        self._step = 0
+
+    def start(self, step: int) -> None:
+        if not self.enabled or self._profiler is not None or not self.start_step <= step <= self.end_step:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self._profiler.start()
+        self._step = step
+
+    def stop(self) -> Path | None:
+        if self._profiler is None:
+            return None
+        profiler = self._profiler
+        self._profiler = None
+        profiler.stop()
+        path = profiler_trace_path(self.metrics_log_path, self._step)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.export_chrome_trace(str(path))
+        return path
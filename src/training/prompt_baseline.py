@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Any
+
+from src.training.config import MRVFConfig
+
+PROMPT_BASELINE_CONFIG_FIELDS = (
+    "model_name_or_path",
+    "torch_dtype",
+    "max_reference_length",
+    "reference_length_normalization",
+)
+
+
+def prompt_baseline_cache_path(cfg: MRVFConfig) -> Path:
+    payload = {field: getattr(cfg, field) for field in PROMPT_BASELINE_CONFIG_FIELDS}
+    key = hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return Path(cfg.dataset_cache_dir) / "prompt_baselines" / f"{key}.json"
+
+
+def prompt_baseline_key(prefix_ids: list[int], references: list[str], reference_ids: list[list[int]] | None) -> str:
+    payload: dict[str, Any] = {"prefix_ids": list(prefix_ids), "references": list(references)}
+    if reference_ids is not None:
+        payload["reference_ids"] = [list(ids) for ids in reference_ids]
+    return hashlib.sha256(json.dumps(payload).encode("utf-8")).hexdigest()
+
+
+class PromptBaselineCache:
+    def __init__(self, path: Path | None = None) -> None:
+        self.path = path
+        self.entries: dict[str, tuple[float, float]] = {}
+        self._dirty = False
+        if path is not None and path.exists():
+            raw = json.loads(path.read_text(encoding="utf-8"))
+            self.entries = {key: (float(value[0]), float(value[1])) for key, value in raw.items()}
+
+    def get(self, key: str) -> tuple[float, float] | None:
+        return self.entries.get(key)
+
+    def put(self, key: str, log_mass_normalized: float, log_mass_raw: float) -> None:
+        self.entries[key] = (log_mass_normalized, log_mass_raw)
+        self._dirty = True
+
+    def save(self) -> None:
+        if self.path is None or not self._dirty:
+            return
+        entries = dict(self.entries)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        staging_path = self.path.with_name(f"{self.path.name}.tmp")
+        staging_path.write_text(json.dumps(entries), encoding="utf-8")
+        staging_path.replace(self.path)
+        self._dirty = False
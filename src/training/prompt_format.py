@@ -1,6 +1,10 @@
 from __future__ import annotations
 
 import re
+from typing import Any
+
+from src.templates import environment
+from src.training.config import MRVFConfig
 
 
 _THINK_RE = re.compile(r"<think>.*?</think>", re.DOTALL | re.IGNORECASE)
@@ -9,3 +13,21 @@ _THINK_RE = re.compile(r"<think>.*?</think>", re.DOTALL | re.IGNORECASE)
 def strip_thinking(text: str) -> str:
     cleaned = _THINK_RE.sub("", text)
     return cleaned.strip()
+
+
+def build_trace_prompt_text(tokenizer: Any, cfg: MRVFConfig, prompt: str) -> str:
+    trace_prompt = environment.get_template(cfg.trace_prompt_template).render(prompt=prompt).strip()
+    if cfg.trace_format == "qwen_chat_thinking":
+        messages = [{"role": "user", "content": trace_prompt}]
+        try:
+            return tokenizer.apply_chat_template(
+                messages,
+                tokenize=False,
+                add_generation_prompt=True,
+                enable_thinking=True,
+            )
+        except TypeError:
+            return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    if not cfg.use_thinking:
+        return trace_prompt
+    return f"{trace_prompt}\nThink inside <think>...</think> before the final joke."
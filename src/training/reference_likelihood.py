@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+from collections import deque
+from collections.abc import Callable
 from dataclasses import dataclass
 from typing import TYPE_CHECKING
 
+from src.training.logprobs import forward_scoring_states, masked_sequence_logprobs_by_mask, sum_selected_logprobs
+
 if TYPE_CHECKING:
     import torch
     from transformers import PreTrainedTokenizerBase
@@ -15,6 +19,21 @@ class ReferenceLikelihoodOutput:
     ref_lengths: "torch.Tensor"
     log_mass_raw: "torch.Tensor"
     log_mass_normalized: "torch.Tensor"
+    forward_passes: int = 1
+    max_tokens_per_forward: int = 0
+    trace_logps: "torch.Tensor | None" = None
+
+    def detach(self) -> ReferenceLikelihoodOutput:
+        return ReferenceLikelihoodOutput(
+            ref_logps_raw=self.ref_logps_raw.detach(),
+            ref_logps_normalized=self.ref_logps_normalized.detach(),
+            ref_lengths=self.ref_lengths.detach(),
+            log_mass_raw=self.log_mass_raw.detach(),
+            log_mass_normalized=self.log_mass_normalized.detach(),
+            forward_passes=self.forward_passes,
+            max_tokens_per_forward=self.max_tokens_per_forward,
+            trace_logps=self.trace_logps.detach() if self.trace_logps is not None else None,
+        )
 
 
 def _require_torch() -> "torch":
@@ -36,6 +55,293 @@ def _normalize_sequence_logps(logps: "torch.Tensor", lengths: "torch.Tensor", mo
     return logps
 
 
+def _tokenize_references(
+    tokenizer: "PreTrainedTokenizerBase",
+    references: list[list[str]],
+    max_reference_length: int,
+) -> list[list[list[int]]]:
+    ref_ids_per_sample: list[list[list[int]]] = []
+    for prompt_refs in references:
+        prompt_ref_ids: list[list[int]] = []
+        for reference in prompt_refs:
+            ref_ids = tokenizer(
+                reference,
+                add_special_tokens=False,
+                truncation=True,
+                max_length=max_reference_length,
+            )["input_ids"]
+            if ref_ids:
+                prompt_ref_ids.append(ref_ids)
+        ref_ids_per_sample.append(prompt_ref_ids)
+    return ref_ids_per_sample
+
+
+def padded_width(length: int, pad_to_multiple_of: int) -> int:
+    if pad_to_multiple_of <= 1:
+        return length
+    return -(-length // pad_to_multiple_of) * pad_to_multiple_of
+
+
+def _right_pad(
+    rows: list[list[int]],
+    pad_token_id: int,
+    pad_to_multiple_of: int = 0,
+) -> tuple[list[list[int]], list[list[int]]]:
+    max_len = padded_width(max(len(row) for row in rows), pad_to_multiple_of)
+    padded = [row + [pad_token_id] * (max_len - len(row)) for row in rows]
+    attention = [[1] * len(row) + [0] * (max_len - len(row)) for row in rows]
+    return padded, attention
+
+
+def _flat_reference_logps(
+    *,
+    model: "torch.nn.Module",
+    pad_token_id: int,
+    prefix_ids_per_sample: list[list[int]],
+    ref_ids_per_sample: list[list[list[int]]],
+    target_only: bool,
+    chunk_size: int,
+    trace_spans: list[tuple[int, int] | None] | None = None,
+    sequence_logprobs_fn: Callable[..., list["torch.Tensor"]] = masked_sequence_logprobs_by_mask,
+    pad_to_multiple_of: int = 0,
+) -> tuple["torch.Tensor", "torch.Tensor", "torch.Tensor | None"]:
+    torch = _require_torch()
+    flat_sequences: list[list[int]] = []
+    flat_masks: list[list[int]] = []
+    span_masks: list[list[int]] = []
+    ref_rows: list[int] = []
+    trace_rows: list[tuple[int, int]] = []
+    for sample_index, (prefix_ids, prompt_ref_ids) in enumerate(
+        zip(prefix_ids_per_sample, ref_ids_per_sample, strict=True)
+    ):
+        span = trace_spans[sample_index] if trace_spans is not None else None
+        continuations = prompt_ref_ids if prompt_ref_ids or span is None else [[]]
+        for ref_position, ref_ids in enumerate(continuations):
+            span_mask = [0] * (len(prefix_ids) + len(ref_ids))
+            if span is not None and ref_position == 0:
+                span_mask[span[0] : span[1]] = [1] * (span[1] - span[0])
+                trace_rows.append((sample_index, len(flat_sequences)))
+            if ref_ids:
+                ref_rows.append(len(flat_sequences))
+            flat_sequences.append(prefix_ids + ref_ids)
+            flat_masks.append([0] * len(prefix_ids) + [1] * len(ref_ids))
+            span_masks.append(span_mask)
+
+    padded_ids, attention = _right_pad(flat_sequences, pad_token_id, pad_to_multiple_of)
+    padded_mask, _ = _right_pad(flat_masks, 0, pad_to_multiple_of)
+    device = next(model.parameters()).device
+    input_ids = torch.tensor(padded_ids, dtype=torch.long, device=device)
+    ref_mask = torch.tensor(padded_mask, dtype=torch.long, device=device)
+    attention_mask = torch.tensor(attention, dtype=torch.long, device=device)
+    target_masks = [ref_mask]
+    if trace_spans is not None:
+        padded_span_mask, _ = _right_pad(span_masks, 0, pad_to_multiple_of)
+        target_masks.append(torch.tensor(padded_span_mask, dtype=torch.long, device=device))
+
+    logps = sequence_logprobs_fn(
+        model=model,
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        target_masks=target_masks,
+        target_only=target_only,
+        chunk_size=chunk_size,
+    )
+    ref_index = torch.tensor(ref_rows, dtype=torch.long, device=device)
+    seq_logps = logps[0].index_select(0, ref_index)
+    seq_lengths = (ref_mask[:, 1:] * attention_mask[:, 1:]).sum(dim=-1).index_select(0, ref_index)
+    seq_lengths = seq_lengths.to(seq_logps.dtype).clamp_min(1)
+    trace_logps = None
+    if trace_spans is not None:
+        trace_logps = _scatter_trace_logps(logps[1], trace_rows, len(prefix_ids_per_sample))
+    return seq_logps, seq_lengths, trace_logps
+
+
+def _scatter_trace_logps(
+    row_logps: "torch.Tensor",
+    trace_rows: list[tuple[int, int]],
+    num_samples: int,
+) -> "torch.Tensor":
+    torch = _require_torch()
+    trace_logps = torch.zeros(num_samples, dtype=row_logps.dtype, device=row_logps.device)
+    if not trace_rows:
+        return trace_logps
+    sample_index = torch.tensor([sample for sample, _ in trace_rows], dtype=torch.long, device=row_logps.device)
+    row_index = torch.tensor([row for _, row in trace_rows], dtype=torch.long, device=row_logps.device)
+    return trace_logps.index_copy(0, sample_index, row_logps.index_select(0, row_index))
+
+
+def _shared_prefix_reference_logps(
+    *,
+    model: "torch.nn.Module",
+    pad_token_id: int,
+    prefix_ids_per_sample: list[list[int]],
+    ref_ids_per_sample: list[list[list[int]]],
+    target_only: bool,
+    chunk_size: int,
+    trace_spans: list[tuple[int, int] | None] | None = None,
+    sequence_logprobs_fn: Callable[..., list["torch.Tensor"]] = masked_sequence_logprobs_by_mask,
+    pad_to_multiple_of: int = 0,
+) -> tuple["torch.Tensor", "torch.Tensor", "torch.Tensor | None"]:
+    del sequence_logprobs_fn
+    torch = _require_torch()
+    device = next(model.parameters()).device
+    active = [
+        index
+        for index, prompt_ref_ids in enumerate(ref_ids_per_sample)
+        if prompt_ref_ids or (trace_spans is not None and trace_spans[index] is not None)
+    ]
+    prefix_rows, prefix_attention_rows = _right_pad(
+        [prefix_ids_per_sample[index] for index in active],
+        pad_token_id,
+        pad_to_multiple_of,
+    )
+    prefix_ids = torch.tensor(prefix_rows, dtype=torch.long, device=device)
+    prefix_attention = torch.tensor(prefix_attention_rows, dtype=torch.long, device=device)
+    prefix_lengths = prefix_attention.sum(dim=-1)
+
+    prefix_states = forward_scoring_states(
+        model,
+        target_only=target_only,
+        input_ids=prefix_ids,
+        attention_mask=prefix_attention,
+        use_cache=True,
+    )
+    trace_logps = None
+    if trace_spans is not None:
+        span_mask = torch.zeros_like(prefix_ids)
+        trace_rows: list[tuple[int, int]] = []
+        for row, index in enumerate(active):
+            span = trace_spans[index]
+            if span is not None:
+                span_mask[row, span[0] : span[1]] = 1
+                trace_rows.append((index, row))
+        span_logps = sum_selected_logprobs(
+            prefix_states.values[:, :-1, :],
+            prefix_ids[:, 1:],
+            span_mask[:, 1:],
+            prefix_states.head,
+            chunk_size,
+        )
+        trace_logps = _scatter_trace_logps(span_logps, trace_rows, len(prefix_ids_per_sample))
+
+    flat_refs = [ref_ids for index in active for ref_ids in ref_ids_per_sample[index]]
+    if not flat_refs:
+        empty = prefix_states.values.new_zeros(0)
+        return empty, empty, trace_logps
+    cache = prefix_states.past_key_values
+    if cache is None:
+        msg = "Shared-prefix reference scoring requires a model that returns `past_key_values`."
+        raise RuntimeError(msg)
+
+    counts = torch.tensor([len(ref_ids_per_sample[index]) for index in active], device=device)
+    row_to_prefix = torch.repeat_interleave(torch.arange(len(active), device=device), counts)
+    cache.batch_select_indices(row_to_prefix)
+
+    ref_rows, ref_attention_rows = _right_pad(flat_refs, pad_token_id, pad_to_multiple_of)
+    ref_ids = torch.tensor(ref_rows, dtype=torch.long, device=device)
+    ref_attention = torch.tensor(ref_attention_rows, dtype=torch.long, device=device)
+    expanded_lengths = prefix_lengths[row_to_prefix]
+    position_ids = expanded_lengths.unsqueeze(1) + torch.arange(ref_ids.shape[1], device=device).unsqueeze(0)
+    attention_mask = torch.cat([prefix_attention[row_to_prefix], ref_attention], dim=1)
+
+    continuation_states = forward_scoring_states(
+        model,
+        target_only=target_only,
+        input_ids=ref_ids,
+        attention_mask=attention_mask,
+        position_ids=position_ids,
+        past_key_values=cache,
+        use_cache=True,
+    )
+    last_prefix_values = prefix_states.values[torch.arange(len(active), device=device), prefix_lengths - 1]
+    values = torch.cat(
+        [last_prefix_values[row_to_prefix].unsqueeze(1), continuation_states.values[:, :-1, :]],
+        dim=1,
+    )
+    seq_logps = sum_selected_logprobs(values, ref_ids, ref_attention, continuation_states.head, chunk_size)
+    return seq_logps, ref_attention.sum(dim=-1).to(seq_logps.dtype).clamp_min(1), trace_logps
+
+
+def _plan_buckets(indices: list[int], lengths: list[int], weights: list[int], max_tokens: int) -> list[list[int]]:
+    ordered = sorted(indices, key=lambda index: lengths[index], reverse=True)
+    buckets: list[list[int]] = []
+    current: list[int] = []
+    current_weight = 0
+    current_width = 0
+    for index in ordered:
+        weight = current_weight + weights[index]
+        width = max(current_width, lengths[index])
+        if current and weight * width > max_tokens:
+            buckets.append(current)
+            current = []
+            weight = weights[index]
+            width = lengths[index]
+        current.append(index)
+        current_weight = weight
+        current_width = width
+    if current:
+        buckets.append(current)
+    return buckets
+
+
+def _bucketed_reference_logps(
+    *,
+    score_fn: Callable[..., tuple["torch.Tensor", "torch.Tensor", "torch.Tensor | None"]],
+    items: list[tuple[list[int], list[list[int]], tuple[int, int] | None]],
+    max_tokens: int,
+    **score_kwargs: object,
+) -> tuple["torch.Tensor", "torch.Tensor", "torch.Tensor | None", int, int]:
+    torch = _require_torch()
+    lengths = [
+        len(prefix_ids) + max((len(ref_ids) for ref_ids in item_refs), default=0) for prefix_ids, item_refs, _ in items
+    ]
+    weights = [max(len(item_refs), 1) for _, item_refs, _ in items]
+    has_spans = any(span is not None for _, _, span in items)
+    pending = deque(_plan_buckets(list(range(len(items))), lengths, weights, max_tokens))
+    item_logps: dict[int, torch.Tensor] = {}
+    item_lengths: dict[int, torch.Tensor] = {}
+    item_trace_logps: dict[int, torch.Tensor] = {}
+    forward_passes = 0
+    while pending:
+        bucket = pending.popleft()
+        try:
+            logps, seq_lengths, trace_logps = score_fn(
+                prefix_ids_per_sample=[items[index][0] for index in bucket],
+                ref_ids_per_sample=[items[index][1] for index in bucket],
+                trace_spans=[items[index][2] for index in bucket] if has_spans else None,
+                **score_kwargs,
+            )
+        except torch.cuda.OutOfMemoryError:
+            # Buckets run widest first and keep their graphs until backward, so an OOM after one has
+            # completed is caused by retained activations that a smaller budget cannot free.
+            if len(bucket) == 1 or max_tokens <= 1 or (item_logps and torch.is_grad_enabled()):
+                raise
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            max_tokens //= 2
+            remaining = bucket + [index for pending_bucket in pending for index in pending_bucket]
+            pending = deque(_plan_buckets(remaining, lengths, weights, max_tokens))
+            if len(pending[0]) == len(bucket) and set(pending[0]) == set(bucket):
+                first = pending.popleft()
+                pending.extendleft([first[len(first) // 2 :], first[: len(first) // 2]])
+            continue
+        forward_passes += 1
+        offset = 0
+        for position, index in enumerate(bucket):
+            count = len(items[index][1])
+            item_logps[index] = logps[offset : offset + count]
+            item_lengths[index] = seq_lengths[offset : offset + count]
+            if trace_logps is not None:
+                item_trace_logps[index] = trace_logps[position : position + 1]
+            offset += count
+    seq_logps = torch.cat([item_logps[index] for index in range(len(items))], dim=0)
+    seq_lengths = torch.cat([item_lengths[index] for index in range(len(items))], dim=0)
+    trace_logps = None
+    if has_spans:
+        trace_logps = torch.cat([item_trace_logps[index] for index in range(len(items))], dim=0)
+    return seq_logps, seq_lengths, trace_logps, forward_passes, max_tokens
+
+
 def teacher_forced_reference_logps_from_ids(
     *,
     model: "torch.nn.Module",
@@ -44,37 +350,38 @@ def teacher_forced_reference_logps_from_ids(
     references: list[list[str]],
     max_reference_length: int,
     length_normalization: str,
+    reference_ids: list[list[list[int]]] | None = None,
+    share_prefix: bool = False,
+    target_only_logits: bool = False,
+    logprob_chunk_size: int = 1024,
+    max_tokens_per_forward: int = 0,
+    trace_spans: list[tuple[int, int]] | None = None,
+    sequence_logprobs_fn: Callable[..., list["torch.Tensor"]] | None = None,
+    pad_to_multiple_of: int = 0,
 ) -> ReferenceLikelihoodOutput:
     torch = _require_torch()
     if len(prefix_ids_per_sample) != len(references):
         msg = "`prefix_ids_per_sample` and `references` must have the same length."
         raise ValueError(msg)
+    if trace_spans is not None and len(trace_spans) != len(prefix_ids_per_sample):
+        msg = "`prefix_ids_per_sample` and `trace_spans` must have the same length."
+        raise ValueError(msg)
     if tokenizer.pad_token_id is None:
         tokenizer.pad_token = tokenizer.eos_token
 
-    flat_sequences: list[list[int]] = []
-    flat_masks: list[list[int]] = []
-    counts: list[int] = []
-    for prefix_ids, prompt_refs in zip(prefix_ids_per_sample, references, strict=True):
-        per_prompt_count = 0
-        for reference in prompt_refs:
-            ref_ids = tokenizer(
-                reference,
-                add_special_tokens=False,
-                truncation=True,
-                max_length=max_reference_length,
-            )["input_ids"]
-            if not ref_ids:
-                continue
-            input_ids = prefix_ids + ref_ids
-            ref_mask = [0] * len(prefix_ids) + [1] * len(ref_ids)
-            flat_sequences.append(input_ids)
-            flat_masks.append(ref_mask)
-            per_prompt_count += 1
-        counts.append(per_prompt_count)
-
-    if not flat_sequences:
-        zeros = torch.zeros(len(prefix_ids_per_sample), device=next(model.parameters()).device)
+    if reference_ids is None:
+        ref_ids_per_sample = _tokenize_references(tokenizer, references, max_reference_length)
+    else:
+        if len(reference_ids) != len(prefix_ids_per_sample):
+            msg = "`prefix_ids_per_sample` and `reference_ids` must have the same length."
+            raise ValueError(msg)
+        ref_ids_per_sample = [
+            [list(ids[:max_reference_length]) for ids in prompt_ref_ids if ids] for prompt_ref_ids in reference_ids
+        ]
+    counts = [len(prompt_ref_ids) for prompt_ref_ids in ref_ids_per_sample]
+    device = next(model.parameters()).device
+    if not any(counts) and trace_spans is None:
+        zeros = torch.zeros(len(prefix_ids_per_sample), device=device)
         return ReferenceLikelihoodOutput(
             ref_logps_raw=zeros.unsqueeze(-1),
             ref_logps_normalized=zeros.unsqueeze(-1),
@@ -83,41 +390,67 @@ def teacher_forced_reference_logps_from_ids(
             log_mass_normalized=zeros,
         )
 
-    max_len = max(len(item) for item in flat_sequences)
-    padded_ids = []
-    padded_mask = []
-    attention = []
-    for ids, mask in zip(flat_sequences, flat_masks, strict=True):
-        pad_size = max_len - len(ids)
-        padded_ids.append(ids + [tokenizer.pad_token_id] * pad_size)
-        padded_mask.append(mask + [0] * pad_size)
-        attention.append([1] * len(ids) + [0] * pad_size)
-
-    device = next(model.parameters()).device
-    input_ids = torch.tensor(padded_ids, dtype=torch.long, device=device)
-    ref_mask = torch.tensor(padded_mask, dtype=torch.long, device=device)
-    attention_mask = torch.tensor(attention, dtype=torch.long, device=device)
-
-    outputs = model(input_ids=input_ids, attention_mask=attention_mask)
-    logits = outputs.logits[:, :-1, :]
-    labels = input_ids[:, 1:]
-    shifted_ref_mask = ref_mask[:, 1:].to(logits.dtype)
-    shifted_attn_mask = attention_mask[:, 1:].to(logits.dtype)
-    target_mask = shifted_ref_mask * shifted_attn_mask
-
-    selected = target_mask.bool()
-    seq_logps_raw = torch.zeros(logits.shape[0], dtype=logits.dtype, device=device)
-    if selected.any():
-        selected_logits = logits[selected]
-        selected_labels = labels[selected]
-        selected_logprobs = -torch.nn.functional.cross_entropy(
-            selected_logits.float(),
-            selected_labels,
-            reduction="none",
-        ).to(logits.dtype)
-        row_ids = torch.arange(logits.shape[0], device=device).unsqueeze(1).expand_as(selected)[selected]
-        seq_logps_raw.scatter_add_(0, row_ids, selected_logprobs)
-    seq_lengths = target_mask.sum(dim=-1).clamp_min(1)
+    use_shared_prefix = (
+        share_prefix
+        and any(counts)
+        and all(
+            prefix_ids
+            for prefix_ids, count in zip(prefix_ids_per_sample, counts, strict=True)
+            if count or trace_spans is not None
+        )
+    )
+    score_fn = _shared_prefix_reference_logps if use_shared_prefix else _flat_reference_logps
+    score_kwargs = {
+        "model": model,
+        "pad_token_id": tokenizer.pad_token_id,
+        "target_only": target_only_logits,
+        "chunk_size": logprob_chunk_size,
+        "sequence_logprobs_fn": sequence_logprobs_fn or masked_sequence_logprobs_by_mask,
+        "pad_to_multiple_of": pad_to_multiple_of,
+    }
+    forward_passes = 1
+    if max_tokens_per_forward > 0:
+        spans: list[tuple[int, int] | None] = (
+            list(trace_spans) if trace_spans is not None else [None] * len(prefix_ids_per_sample)
+        )
+        items: list[tuple[list[int], list[list[int]], tuple[int, int] | None]] = []
+        item_samples: list[int] = []
+        for sample_index, (prefix_ids, prompt_ref_ids, span) in enumerate(
+            zip(prefix_ids_per_sample, ref_ids_per_sample, spans, strict=True)
+        ):
+            if use_shared_prefix:
+                sample_items = [(prefix_ids, prompt_ref_ids, span)] if prompt_ref_ids or span is not None else []
+            elif prompt_ref_ids:
+                sample_items = [
+                    (prefix_ids, [ref_ids], span if ref_position == 0 else None)
+                    for ref_position, ref_ids in enumerate(prompt_ref_ids)
+                ]
+            else:
+                sample_items = [(prefix_ids, [], span)] if span is not None else []
+            items.extend(sample_items)
+            item_samples.extend([sample_index] * len(sample_items))
+        seq_logps_raw, seq_lengths, item_trace_logps, forward_passes, max_tokens_per_forward = (
+            _bucketed_reference_logps(
+                score_fn=score_fn,
+                items=items,
+                max_tokens=max_tokens_per_forward,
+                **score_kwargs,
+            )
+        )
+        trace_logps = None
+        if item_trace_logps is not None:
+            trace_logps = torch.zeros(
+                len(prefix_ids_per_sample),
+                dtype=item_trace_logps.dtype,
+                device=item_trace_logps.device,
+            ).index_add(0, torch.tensor(item_samples, dtype=torch.long, device=device), item_trace_logps)
+    else:
+        seq_logps_raw, seq_lengths, trace_logps = score_fn(
+            prefix_ids_per_sample=prefix_ids_per_sample,
+            ref_ids_per_sample=ref_ids_per_sample,
+            trace_spans=trace_spans,
+            **score_kwargs,
+        )
     seq_logps_norm = _normalize_sequence_logps(seq_logps_raw, seq_lengths, length_normalization)
 
     per_prompt_raw: list[torch.Tensor] = []
@@ -156,6 +489,9 @@ def teacher_forced_reference_logps_from_ids(
         ref_lengths=ref_lengths,
         log_mass_raw=log_mass_raw,
         log_mass_normalized=log_mass_normalized,
+        forward_passes=forward_passes,
+        max_tokens_per_forward=max_tokens_per_forward,
+        trace_logps=trace_logps,
     )
 
 
@@ -169,6 +505,7 @@ def teacher_forced_reference_logps(
     max_reference_length: int,
     answer_prefix: str,
     length_normalization: str,
+    share_prefix: bool = False,
 ) -> ReferenceLikelihoodOutput:
     prefixes = []
     for prompt, trace in zip(prompt_texts, trace_texts, strict=True):
@@ -182,4 +519,5 @@ def teacher_forced_reference_logps(
         references=references,
         max_reference_length=max_reference_length,
         length_normalization=length_normalization,
+        share_prefix=share_prefix,
     )
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import copy
+from collections.abc import Callable
+from dataclasses import dataclass
+import queue
+import threading
+from typing import Any
+
+import torch
+
+
+@dataclass
+class Rollout:
+    batch_rows: list[dict[str, Any]]
+    trace_batch: Any
+    policy_version: int
+    generator_state: torch.Tensor | None = None
+
+
+_STOP = object()
+
+
+def _trainable_state(model: torch.nn.Module) -> dict[str, torch.Tensor]:
+    return {name: param.detach().clone() for name, param in model.named_parameters() if param.requires_grad}
+
+
+def clone_inference_policy(policy_model: torch.nn.Module) -> tuple[torch.nn.Module, list[str]]:
+    frozen = {id(param): param for param in policy_model.parameters() if not param.requires_grad}
+    model = copy.deepcopy(policy_model, memo=frozen)
+    model.eval()
+    trainable_names = [name for name, param in model.named_parameters() if param.requires_grad]
+    model.requires_grad_(False)
+    return model, trainable_names
+
+
+def load_trainable_state(model: torch.nn.Module, trainable_names: list[str], state: dict[str, torch.Tensor]) -> None:
+    params = dict(model.named_parameters())
+    with torch.no_grad():
+        for name in trainable_names:
+            params[name].copy_(state[name])
+
+
+class AsyncRolloutWorker:
+    def __init__(
+        self,
+        *,
+        policy_model: torch.nn.Module,
+        generate_fn: Callable[[torch.nn.Module, Any, torch.Generator], tuple[list[dict[str, Any]], Any]],
+        seed: int,
+        device: torch.device,
+        policy_version: int = 0,
+    ) -> None:
+        self.model, self._trainable_names = clone_inference_policy(policy_model)
+        self._generate_fn = generate_fn
+        self._requests: queue.Queue[Any] = queue.Queue()
+        self._results: queue.Queue[Any] = queue.Queue()
+        self._pending_weights: tuple[int, dict[str, torch.Tensor], Any] | None = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mrvf-rollout", daemon=True)
+        self._stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(seed)
+        self.policy_version = policy_version
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def publish_weights(self, model: torch.nn.Module, version: int) -> None:
+        state = _trainable_state(model)
+        ready = None
+        if self._stream is not None:
+            ready = torch.cuda.Event()
+            ready.record()
+        self._pending_weights = (version, state, ready)
+
+    def submit(self, batch: Any) -> None:
+        weights = self._pending_weights
+        self._pending_weights = None
+        self._requests.put((batch, weights))
+
+    def get(self) -> Rollout:
+        item = self._results.get()
+        if isinstance(item, BaseException):
+            msg = "Rollout worker failed."
+            raise RuntimeError(msg) from item
+        return item
+
+    def close(self) -> None:
+        self._stop.set()
+        self._requests.put(_STOP)
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _apply_weights(self, weights: tuple[int, dict[str, torch.Tensor], Any]) -> None:
+        version, state, ready = weights
+        if self._stream is not None:
+            self._stream.wait_event(ready)
+            for tensor in state.values():
+                tensor.record_stream(self._stream)
+        load_trainable_state(self.model, self._trainable_names, state)
+        self.policy_version = version
+
+    def _run(self) -> None:
+        # Generation runs on its own CUDA stream so it can overlap the learner's backward on the default stream.
+        with torch.cuda.stream(self._stream):
+            while True:
+                request = self._requests.get()
+                if request is _STOP or self._stop.is_set():
+                    return
+                batch, weights = request
+                try:
+                    if weights is not None:
+                        self._apply_weights(weights)
+                    batch_rows, trace_batch = self._generate_fn(self.model, batch, self.generator)
+                except BaseException as error:
+                    self._results.put(error)
+                    return
+                self._results.put(
+                    Rollout(
+                        batch_rows=batch_rows,
+                        trace_batch=trace_batch,
+                        policy_version=self.policy_version,
+                        generator_state=self.generator.get_state(),
+                    )
+                )
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+from pathlib import Path
+import shutil
+from typing import Any
+
+from src.training.config import MRVFConfig
+
+
+def _require_vllm() -> tuple[Any, Any, Any]:
+    try:
+        from vllm import LLM, SamplingParams
+        from vllm.lora.request import LoRARequest
+    except ImportError as error:  # pragma: no cover
+        msg = "`rollout_backend=vllm` requires the `vllm` package."
+        raise RuntimeError(msg) from error
+    return LLM, SamplingParams, LoRARequest
+
+
+class VLLMRolloutEngine:
+    def __init__(
+        self,
+        *,
+        cfg: MRVFConfig,
+        llm: Any,
+        sampling_params_cls: Any,
+        lora_request_cls: Any,
+    ) -> None:
+        self.cfg = cfg
+        self.llm = llm
+        self._sampling_params_cls = sampling_params_cls
+        self._lora_request_cls = lora_request_cls
+        self._adapter_root = (
+            Path(cfg.output_dir) / "vllm_adapter" if cfg.vllm_adapter_dir is None else Path(cfg.vllm_adapter_dir)
+        )
+        self._adapter_dir: Path | None = None
+        self.lora_request: Any | None = None
+        self.synced_step: int | None = None
+
+    @classmethod
+    def from_config(cls, cfg: MRVFConfig) -> VLLMRolloutEngine:
+        llm_cls, sampling_params_cls, lora_request_cls = _require_vllm()
+        kwargs: dict[str, Any] = {
+            "model": cfg.model_name_or_path,
+            "tokenizer": cfg.model_name_or_path,
+            "dtype": cfg.torch_dtype,
+            "enable_lora": True,
+            "max_lora_rank": cfg.lora_r,
+            "max_loras": 1,
+            "gpu_memory_utilization": cfg.vllm_gpu_memory_utilization,
+            "seed": cfg.seed,
+        }
+        if cfg.vllm_max_model_len is not None:
+            kwargs["max_model_len"] = cfg.vllm_max_model_len
+        return cls(
+            cfg=cfg,
+            llm=llm_cls(**kwargs),
+            sampling_params_cls=sampling_params_cls,
+            lora_request_cls=lora_request_cls,
+        )
+
+    def sync_adapter(self, model: Any, step: int) -> None:
+        adapter_dir = self._adapter_root / f"step-{step}"
+        model.save_pretrained(adapter_dir)
+        lora_int_id = 1 if self.lora_request is None else self.lora_request.lora_int_id + 1
+        self.lora_request = self._lora_request_cls(f"mrvf_policy_{lora_int_id}", lora_int_id, str(adapter_dir))
+        if self._adapter_dir is not None and self._adapter_dir != adapter_dir:
+            shutil.rmtree(self._adapter_dir, ignore_errors=True)
+        self._adapter_dir = adapter_dir
+        self.synced_step = step
+
+    def generate(
+        self,
+        prompt_ids: list[list[int]],
+        *,
+        stop_token_ids: list[int],
+        stop: list[str] | None = None,
+    ) -> list[list[int]]:
+        if self.lora_request is None:
+            msg = "vLLM adapter weights were not synced before generation."
+            raise RuntimeError(msg)
+        sampling_params = self._sampling_params_cls(
+            n=self.cfg.num_generations,
+            temperature=self.cfg.temperature,
+            top_p=self.cfg.top_p,
+            top_k=self.cfg.top_k if self.cfg.top_k is not None else -1,
+            repetition_penalty=self.cfg.repetition_penalty,
+            max_tokens=self.cfg.max_trace_length,
+            stop_token_ids=stop_token_ids,
+            stop=stop or [],
+            include_stop_str_in_output=bool(stop),
+        )
+        outputs = self.llm.generate(
+            [{"prompt_token_ids": ids} for ids in prompt_ids],
+            sampling_params=sampling_params,
+            lora_request=self.lora_request,
+            use_tqdm=False,
+        )
+        completions: list[list[int]] = []
+        for output in outputs:
+            for completion in output.outputs:
+                token_ids = list(completion.token_ids)
+                if completion.stop_reason in stop_token_ids and token_ids[-1:] != [completion.stop_reason]:
+                    token_ids.append(completion.stop_reason)
+                completions.append(token_ids)
+        return completions
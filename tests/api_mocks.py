@@ -0,0 +1,66 @@
+import asyncio
+
+
+class MockEmbeddingItem:
+    def __init__(self, embedding: list[float]) -> None:
+        self.embedding = embedding
+
+
+class MockEmbeddingResponse:
+    def __init__(self, embeddings: list[list[float]]) -> None:
+        self.data = [MockEmbeddingItem(embedding) for embedding in embeddings]
+
+
+class MockEmbeddingsAPI:
+    def __init__(self) -> None:
+        self.inputs: list[list[str]] = []
+        self.sent_at: list[float] = []
+
+    async def create(self, model: str, input: list[str], dimensions: int) -> MockEmbeddingResponse:
+        del model
+        self.inputs.append(list(input))
+        self.sent_at.append(asyncio.get_running_loop().time())
+        return MockEmbeddingResponse([[float(len(text))] * dimensions for text in input])
+
+
+class MockMessage:
+    def __init__(self, content: str) -> None:
+        self.content = content
+
+
+class MockChoice:
+    def __init__(self, content: str) -> None:
+        self.message = MockMessage(content=content)
+
+
+class MockCompletion:
+    def __init__(self, content: str) -> None:
+        self.choices = [MockChoice(content=content)]
+
+
+class MockChatCompletions:
+    def __init__(self, fail_after: int | None = None) -> None:
+        self.calls = 0
+        self.fail_after = fail_after
+
+    async def create(self, **kwargs: object) -> MockCompletion:
+        self.calls += 1
+        if self.fail_after is not None and self.calls > self.fail_after:
+            msg = "generation unavailable"
+            raise RuntimeError(msg)
+        return MockCompletion(content=f"joke {self.calls}")
+
+
+class MockChat:
+    def __init__(self, completions: MockChatCompletions | None = None) -> None:
+        self.completions = completions or MockChatCompletions()
+
+
+class MockClient:
+    def __init__(
+        self,
+        embeddings: MockEmbeddingsAPI | None = None,
+        completions: MockChatCompletions | None = None,
+    ) -> None:
+        self.embeddings = embeddings or MockEmbeddingsAPI()
+        self.chat = MockChat(completions)
@@ -0,0 +1,77 @@
+import asyncio
+from pathlib import Path
+
+from api_mocks import MockClient
+from datasets import Dataset
+from src.config import CandidatesConfig, EmbeddingsConfig
+from src.pipelines.cache import ApiCache, api_cache_key
+from src.pipelines.candidates import CandidatesPipeline
+from src.pipelines.embeddings import EmbeddingsPipeline
+
+
+def test_api_cache_batch_get_put_and_eviction(tmp_path: Path) -> None:
+    cache = ApiCache(tmp_path / "api.sqlite", max_size_bytes=10)
+    cache.put_many({"a": b"1234", "b": b"5678"})
+    assert cache.get_many(["b", "c"]) == {"b": b"5678"}
+    assert cache.get("a") == b"1234"
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    cache.put("c", b"90ab")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1234"
+    assert cache.evictions == 1
+    assert cache.size_bytes() <= 10
+
+    reopened = ApiCache(tmp_path / "api.sqlite")
+    assert reopened.get_many(["a", "c"]) == {"a": b"1234", "c": b"90ab"}
+
+
+def test_api_cache_key_depends_on_request_fields() -> None:
+    key = api_cache_key("embeddings", model="m", dimensions=4, input="text")
+    assert key == api_cache_key("embeddings", input="text", dimensions=4, model="m")
+    assert key != api_cache_key("embeddings", model="m", dimensions=8, input="text")
+    assert key != api_cache_key("chat.completions", model="m", dimensions=4, input="text")
+
+
+def test_embeddings_pipeline_requests_only_cache_misses(tmp_path: Path) -> None:
+    cache = ApiCache(tmp_path / "api.sqlite")
+    pipeline_config = EmbeddingsConfig(
+        model="mock-model",
+        dimensions=2,
+        batch_size=3,
+        shard_size=10,
+        max_parallel_requests=1,
+        timeout=10,
+        max_retries=1,
+    )
+    first_client = MockClient()
+    first = EmbeddingsPipeline(pipeline_config, output_dir=tmp_path / "first", client=first_client, cache=cache)
+    asyncio.run(first.run(Dataset.from_dict({"id": [0, 1], "text": ["a", "bb"]})))
+    assert not (tmp_path / "api.sqlite-wal").exists()
+
+    second_client = MockClient()
+    second = EmbeddingsPipeline(pipeline_config, output_dir=tmp_path / "second", client=second_client, cache=cache)
+    asyncio.run(second.run(Dataset.from_dict({"id": [0, 1, 2], "text": ["a", "bb", "ccc"]})))
+
+    assert first_client.embeddings.inputs == [["a", "bb"]]
+    assert second_client.embeddings.inputs == [["ccc"]]
+    assert cache.stats() == {"cache_hits": 2, "cache_misses": 3, "cache_evictions": 0}
+
+
+def test_candidates_pipeline_caches_only_reproducible_sampling(tmp_path: Path) -> None:
+    cache = ApiCache(tmp_path / "api.sqlite")
+    references = Dataset.from_dict({"id": [1], "keywords": [["cats"]]})
+
+    def generate(pipeline_config: CandidatesConfig) -> MockClient:
+        client = MockClient()
+        pipeline = CandidatesPipeline(pipeline_config, output_dir=tmp_path / "candidates", client=client, cache=cache)
+        asyncio.run(pipeline.run(references, model="base-v1"))
+        return client
+
+    sampled = CandidatesConfig(model="mock-model", max_retries=1, temperature=1.0)
+    assert generate(sampled).chat.completions.calls == 1
+    assert generate(sampled).chat.completions.calls == 1
+
+    seeded = CandidatesConfig(model="mock-model", max_retries=1, temperature=1.0, seed=7)
+    assert generate(seeded).chat.completions.calls == 1
+    assert generate(seeded).chat.completions.calls == 0
@@ -0,0 +1,134 @@
+import asyncio
+from pathlib import Path
+
+from api_mocks import MockClient, MockEmbeddingResponse, MockEmbeddingsAPI
+from datasets import Dataset
+from src.config import EmbeddingsConfig
+from src.pipelines.base import ConcurrencyController
+from src.pipelines.embeddings import EmbeddingsPipeline
+
+
+class _MockResponse:
+    def __init__(self, headers: dict[str, str]) -> None:
+        self.headers = headers
+
+
+class _MockRateLimitError(Exception):
+    def __init__(self, retry_after: str) -> None:
+        super().__init__("rate limited")
+        self.status_code = 429
+        self.response = _MockResponse({"retry-after": retry_after})
+
+
+class _MockCapacityEmbeddingsAPI(MockEmbeddingsAPI):
+    def __init__(self, capacity: int, latency: float) -> None:
+        super().__init__()
+        self.capacity = capacity
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.rejected = 0
+
+    async def create(self, model: str, input: list[str], dimensions: int) -> MockEmbeddingResponse:
+        if self.in_flight >= self.capacity:
+            self.rejected += 1
+            raise _MockRateLimitError(retry_after="0.01")
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        return await super().create(model=model, input=input, dimensions=dimensions)
+
+
+def test_controller_increases_additively_and_decreases_on_overload() -> None:
+    controller = ConcurrencyController(initial_limit=4, max_limit=16)
+    for _ in range(4):
+        controller.record_success(0.1)
+    assert controller.limit == 4
+    for _ in range(8):
+        controller.record_success(0.1)
+    assert controller.limit == 6
+
+    controller.record_success(1.0)
+    assert controller.limit == 6
+
+    controller.record_failure(ValueError("bad response"))
+    assert controller.limit == 6
+
+    controller.record_failure(_MockRateLimitError(retry_after="0"))
+    assert controller.limit == 3
+    assert controller.stats()["error_count"] == 2
+
+
+def test_controller_backoff_honours_retry_after() -> None:
+    controller = ConcurrencyController(initial_limit=1, max_backoff=5.0)
+
+    async def measure() -> float:
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        await controller.backoff(attempt=10, error=_MockRateLimitError(retry_after="0.05"))
+        return loop.time() - started_at
+
+    elapsed = asyncio.run(measure())
+    assert 0.04 <= elapsed < 1.0
+
+
+def test_controller_releases_slot_during_backoff_and_honours_new_retry_after() -> None:
+    controller = ConcurrencyController(initial_limit=1, max_backoff=5.0)
+
+    async def scenario() -> tuple[int, float]:
+        loop = asyncio.get_running_loop()
+        release = asyncio.Event()
+
+        async def fail() -> None:
+            await release.wait()
+            raise _MockRateLimitError(retry_after="0.1")
+
+        async def succeed() -> float:
+            return loop.time()
+
+        failing = asyncio.create_task(controller.request(fail))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(controller.request(succeed))
+        await asyncio.sleep(0)
+        started_at = loop.time()
+        release.set()
+        try:
+            await failing
+        except _MockRateLimitError as error:
+            backoff = asyncio.create_task(controller.backoff(attempt=1, error=error))
+            await asyncio.sleep(0)
+            in_flight_during_backoff = controller.in_flight
+            await backoff
+        return in_flight_during_backoff, await waiting - started_at
+
+    in_flight_during_backoff, waited = asyncio.run(scenario())
+    assert in_flight_during_backoff == 0
+    assert waited >= 0.09
+
+
+def test_embeddings_pipeline_concurrency_converges_to_server_capacity(tmp_path: Path) -> None:
+    client = MockClient(embeddings=_MockCapacityEmbeddingsAPI(capacity=8, latency=0.02))
+    pipeline = EmbeddingsPipeline(
+        pipeline_config=EmbeddingsConfig(
+            model="mock-model",
+            dimensions=2,
+            batch_size=1,
+            shard_size=1000,
+            max_parallel_requests=2,
+            timeout=10,
+            max_retries=20,
+        ),
+        output_dir=tmp_path / "embeddings",
+        client=client,
+    )
+
+    jokes = Dataset.from_dict({"id": list(range(400)), "text": [f"joke {index}" for index in range(400)]})
+    asyncio.run(pipeline.run(jokes, resume=False))
+
+    assert client.embeddings.max_in_flight == 8
+    assert client.embeddings.rejected > 0
+    assert 4 <= pipeline.concurrency.limit <= 16
+    assert pipeline.concurrency.stats()["request_count"] == 400
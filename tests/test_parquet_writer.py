@@ -0,0 +1,90 @@
+import asyncio
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from api_mocks import MockChatCompletions, MockClient
+from datasets import Dataset
+from src.config import CandidatesConfig, EmbeddingsConfig
+from src.pipelines.candidates import CandidatesPipeline
+from src.pipelines.embeddings import EmbeddingsPipeline
+from src.pipelines.writer import ArrowWriteBuffer, ParquetShardWriter, write_parquet_atomic
+
+
+def test_arrow_write_buffer_preserves_order_across_appends() -> None:
+    schema = pa.schema([("id", pa.int64()), ("text", pa.string())])
+    write_buffer = ArrowWriteBuffer(schema)
+    write_buffer.append_row({"id": 0, "text": "a"})
+    write_buffer.append_columns({"id": [1, 2], "text": ["b", "c"]})
+    write_buffer.append_batch(pa.record_batch({"id": [3], "text": ["d"]}, schema=schema))
+    write_buffer.append_row({"id": 4, "text": "e"})
+
+    assert len(write_buffer) == 5
+    table = write_buffer.to_table()
+    assert table.schema == schema
+    assert table.to_pydict() == {"id": [0, 1, 2, 3, 4], "text": ["a", "b", "c", "d", "e"]}
+
+    write_buffer.clear()
+    assert len(write_buffer) == 0
+    assert write_buffer.to_table().num_rows == 0
+
+
+def test_shard_writer_commits_parts_atomically(tmp_path: Path) -> None:
+    writer = ParquetShardWriter()
+    for index in range(3):
+        writer.submit(pa.table({"id": [index]}), tmp_path / f"part-{index:04d}.parquet")
+    writer.close()
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "part-0000.parquet",
+        "part-0001.parquet",
+        "part-0002.parquet",
+    ]
+    assert pq.read_table(tmp_path / "part-0002.parquet").column("id").to_pylist() == [2]
+
+
+def test_shard_writer_raises_write_errors_on_close(tmp_path: Path) -> None:
+    writer = ParquetShardWriter()
+    writer.submit(pa.table({"id": [0]}), tmp_path / "missing" / "part-0000.parquet")
+    with pytest.raises(OSError):
+        writer.close()
+
+    write_parquet_atomic(pa.table({"id": [1]}), tmp_path / "part-0000.parquet")
+    assert [path.name for path in tmp_path.iterdir() if path.is_file()] == ["part-0000.parquet"]
+
+
+def test_embeddings_pipeline_writes_fixed_size_float32_vectors(tmp_path: Path) -> None:
+    pipeline_config = EmbeddingsConfig(
+        model="mock-model",
+        dimensions=3,
+        batch_size=2,
+        shard_size=2,
+        max_parallel_requests=2,
+        timeout=10,
+        max_retries=1,
+    )
+    pipeline = EmbeddingsPipeline(pipeline_config, output_dir=tmp_path, client=MockClient())
+    asyncio.run(pipeline.run(Dataset.from_dict({"id": [0, 1, 2], "text": ["a", "bb", "ccc"]})))
+
+    table = pq.read_table(sorted(tmp_path.glob("part-*.parquet")))
+    assert table.schema.field("embedding").type == pa.list_(pa.float32(), 3)
+    rows = dict(zip(table.column("id").to_pylist(), table.column("embedding").to_pylist(), strict=True))
+    np.testing.assert_allclose(rows[2], [3.0, 3.0, 3.0])
+    assert sorted(rows) == [0, 1, 2]
+
+
+def test_candidates_pipeline_closes_writer_when_run_fails(tmp_path: Path) -> None:
+    pipeline = CandidatesPipeline(
+        CandidatesConfig(model="mock-model", shard_size=1, max_parallel_requests=1, max_retries=1),
+        output_dir=tmp_path,
+        client=MockClient(completions=MockChatCompletions(fail_after=1)),
+    )
+    references = Dataset.from_dict({"id": [1, 2], "keywords": [["cats"], ["dogs"]]})
+
+    with pytest.raises(RuntimeError, match="generation unavailable"):
+        asyncio.run(pipeline.run(references, model="base-v1"))
+
+    assert pipeline.writer._thread is None
+    assert pq.read_table(tmp_path / "part-0000.parquet").column("id").to_pylist() == [1]
@@ -0,0 +1,92 @@
+import asyncio
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from api_mocks import MockClient
+from datasets import Dataset
+from src.config import EmbeddingsConfig
+from src.pipelines.embeddings import EmbeddingsPipeline
+from src.pipelines.manifest import MANIFEST_NAME, PartManifest, decode_id_bitmap, encode_id_bitmap
+
+
+def test_id_bitmap_round_trip() -> None:
+    ids = np.array([1_000_007, 1_000_000, 1_000_003, 1_000_000], dtype=np.int64)
+    entry = encode_id_bitmap(ids)
+    assert (entry["num_rows"], entry["min_id"], entry["max_id"]) == (4, 1_000_000, 1_000_007)
+    assert decode_id_bitmap(entry).tolist() == [1_000_000, 1_000_003, 1_000_007]
+    assert decode_id_bitmap(encode_id_bitmap(np.empty(0, dtype=np.int64))).tolist() == []
+
+
+def test_manifest_is_rebuilt_from_existing_parts(tmp_path: Path) -> None:
+    pq.write_table(pa.table({"id": [5, 3]}), tmp_path / "part-0000.parquet")
+    pq.write_table(pa.table({"id": [9]}), tmp_path / "part-0003.parquet")
+
+    manifest = PartManifest(tmp_path)
+    manifest.load()
+    assert manifest.next_part_index() == 4
+    assert manifest.seen_ids().to_pylist() == [3, 5, 9]
+    assert (tmp_path / MANIFEST_NAME).exists()
+
+    pq.write_table(pa.table({"id": [11]}), tmp_path / "part-0004.parquet")
+    manifest.record(tmp_path / "part-0004.parquet", pa.table({"id": [11]}))
+    (tmp_path / "part-0003.parquet").unlink()
+    reloaded = PartManifest(tmp_path)
+    reloaded.load()
+    assert reloaded.next_part_index() == 5
+    assert reloaded.seen_ids().to_pylist() == [3, 5, 11]
+
+
+def test_embeddings_pipeline_resume_skips_ids_from_manifest(tmp_path: Path) -> None:
+    pipeline_config = EmbeddingsConfig(
+        model="mock-model",
+        dimensions=2,
+        batch_size=2,
+        shard_size=2,
+        max_parallel_requests=1,
+        timeout=10,
+        max_retries=1,
+    )
+    first = EmbeddingsPipeline(pipeline_config, output_dir=tmp_path, client=MockClient())
+    asyncio.run(first.run(Dataset.from_dict({"id": [0, 1, 2], "text": ["a", "bb", "ccc"]})))
+
+    client = MockClient()
+    second = EmbeddingsPipeline(pipeline_config, output_dir=tmp_path, client=client)
+    jokes = Dataset.from_dict({"id": [3, 2, 1, 4, 0], "text": ["dddd", "ccc", "bb", "eeeee", "a"]})
+    asyncio.run(second.run(jokes, resume=True))
+
+    assert client.embeddings.inputs == [["dddd", "eeeee"]]
+    manifest = PartManifest(tmp_path)
+    manifest.load()
+    assert manifest.seen_ids().to_pylist() == [0, 1, 2, 3, 4]
+    assert manifest.next_part_index() == len(list(tmp_path.glob("part-*.parquet")))
+
+
+def test_resume_records_parts_missing_from_manifest(tmp_path: Path) -> None:
+    pipeline_config = EmbeddingsConfig(
+        model="mock-model",
+        dimensions=2,
+        batch_size=2,
+        shard_size=2,
+        max_parallel_requests=1,
+        timeout=10,
+        max_retries=1,
+    )
+    first = EmbeddingsPipeline(pipeline_config, output_dir=tmp_path, client=MockClient())
+    asyncio.run(first.run(Dataset.from_dict({"id": [0, 1], "text": ["a", "bb"]})))
+    unlisted = pa.table({"id": [2], "embedding": [[3.0, 3.0]]}, schema=first.schema)
+    pq.write_table(unlisted, tmp_path / "part-0001.parquet")
+
+    client = MockClient()
+    second = EmbeddingsPipeline(pipeline_config, output_dir=tmp_path, client=client)
+    jokes = Dataset.from_dict({"id": [0, 1, 2, 3], "text": ["a", "bb", "ccc", "dddd"]})
+    asyncio.run(second.run(jokes, resume=True))
+
+    assert client.embeddings.inputs == [["dddd"]]
+    assert pq.read_table(tmp_path / "part-0001.parquet").column("id").to_pylist() == [2]
+    table = pq.read_table(sorted(tmp_path.glob("part-*.parquet")))
+    assert sorted(table.column("id").to_pylist()) == [0, 1, 2, 3]
+    manifest = PartManifest(tmp_path)
+    manifest.load()
+    assert sorted(manifest.parts) == ["part-0000.parquet", "part-0001.parquet", "part-0002.parquet"]
@@ -0,0 +1,96 @@
+import asyncio
+from pathlib import Path
+
+from api_mocks import MockClient
+from datasets import Dataset
+from src.config import EmbeddingsConfig
+from src.pipelines.base import RateLimiter, estimate_tokens, get_rate_limiter
+from src.pipelines.embeddings import EmbeddingsPipeline
+
+
+def test_estimate_tokens_uses_text_length() -> None:
+    assert estimate_tokens(["abcd", "abcde", ""]) == 4
+
+
+def test_rate_limiter_waits_for_token_budget() -> None:
+    limiter = RateLimiter(tokens_per_minute=600)
+
+    async def measure() -> float:
+        await limiter.acquire(600)
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        await limiter.acquire(5)
+        return loop.time() - started_at
+
+    assert 0.4 <= asyncio.run(measure()) < 1.5
+
+
+def test_rate_limiter_waits_for_request_budget() -> None:
+    limiter = RateLimiter(requests_per_minute=120)
+
+    async def measure() -> float:
+        for _ in range(120):
+            await limiter.acquire(1)
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        await limiter.acquire(1)
+        return loop.time() - started_at
+
+    assert 0.4 <= asyncio.run(measure()) < 1.5
+
+
+def test_rate_limiter_is_shared_per_model_and_throttles_pipeline(tmp_path: Path) -> None:
+    embeddings = EmbeddingsPipeline(
+        pipeline_config=EmbeddingsConfig(
+            model="shared-rate-model",
+            dimensions=2,
+            batch_size=1,
+            shard_size=10,
+            max_parallel_requests=4,
+            timeout=10,
+            max_retries=1,
+            requests_per_minute=600,
+        ),
+        output_dir=tmp_path / "embeddings",
+        client=MockClient(),
+    )
+    limiter = get_rate_limiter("shared-rate-model", requests_per_minute=300, tokens_per_minute=None)
+    assert get_rate_limiter("shared-rate-model", requests_per_minute=600, tokens_per_minute=None) is limiter
+    assert limiter.requests_per_minute == 300
+
+    limiter._request_budget = 0.0
+    jokes = Dataset.from_dict({"id": [0, 1], "text": ["joke one", "joke two"]})
+    asyncio.run(embeddings.run(jokes, resume=False))
+
+    sent_at = embeddings.client.embeddings.sent_at
+    assert len(sent_at) == 2
+    assert max(sent_at) - min(sent_at) >= 0.15
+
+
+def test_rate_limited_requests_do_not_hold_concurrency_slots(tmp_path: Path) -> None:
+    pipeline = EmbeddingsPipeline(
+        pipeline_config=EmbeddingsConfig(
+            model="slot-rate-model",
+            dimensions=2,
+            batch_size=1,
+            shard_size=10,
+            max_parallel_requests=1,
+            timeout=10,
+            max_retries=1,
+            requests_per_minute=600,
+        ),
+        output_dir=tmp_path / "embeddings",
+        client=MockClient(),
+    )
+    get_rate_limiter("slot-rate-model", requests_per_minute=600, tokens_per_minute=None)._request_budget = 0.0
+
+    async def scenario() -> tuple[int, int]:
+        async def create() -> int:
+            return pipeline.concurrency.in_flight
+
+        task = asyncio.create_task(pipeline._request("slot-rate-model", 1, create))
+        await asyncio.sleep(0.02)
+        in_flight_while_limited = pipeline.concurrency.in_flight
+        return in_flight_while_limited, await task
+
+    assert asyncio.run(scenario()) == (0, 1)
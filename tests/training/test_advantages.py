@@ -1,6 +1,12 @@
 import pytest
 
-from src.training.advantages import grpo_zscore_advantages, loo_advantages
+from src.training.advantages import (
+    active_group_mask,
+    grpo_zscore_advantages,
+    loo_advantages,
+    ppo_clip_mask,
+    ppo_clipped_loss,
+)
 
 torch = pytest.importorskip("torch")
 
@@ -16,3 +22,47 @@ def test_grpo_advantages_finite() -> None:
     rewards = torch.tensor([1.0, 2.0, 3.0, 4.0])
     result = grpo_zscore_advantages(rewards, num_generations=2)
     assert torch.isfinite(result).all()
+
+
+@pytest.mark.parametrize("advantage_fn", [loo_advantages, grpo_zscore_advantages])
+def test_active_group_mask_flags_constant_reward_groups(advantage_fn) -> None:
+    rewards = torch.tensor([-3.2, -3.2, 1.0, 2.0, 0.5, 0.5])
+    advantages = advantage_fn(rewards, num_generations=2)
+    mask = active_group_mask(advantages, num_generations=2, threshold=1e-6)
+    assert mask.tolist() == [False, True, False]
+
+
+def test_ppo_clipped_loss_matches_policy_gradient_on_policy() -> None:
+    advantages = torch.tensor([1.0, -1.0, 0.5])
+    logprobs = torch.tensor([-2.0, -3.0, -1.0], requires_grad=True)
+    loss, ratio = ppo_clipped_loss(logprobs, logprobs.detach(), advantages, clip_epsilon=0.2)
+    loss.backward()
+    assert torch.allclose(ratio, torch.ones(3))
+    assert torch.allclose(logprobs.grad, -advantages / 3)
+
+
+def test_ppo_clipped_loss_stops_gradient_outside_trust_region() -> None:
+    advantages = torch.tensor([1.0, -1.0])
+    old_logprobs = torch.tensor([-2.0, -2.0])
+    logprobs = torch.tensor([-1.0, -3.0], requires_grad=True)
+    loss, ratio = ppo_clipped_loss(logprobs, old_logprobs, advantages, clip_epsilon=0.2)
+    loss.backward()
+    assert ratio[0] > 1.2 and ratio[1] < 0.8
+    assert torch.allclose(logprobs.grad, torch.zeros(2))
+
+
+def test_ppo_clipped_loss_normalizes_ratio_by_length() -> None:
+    advantages = torch.tensor([1.0, 1.0])
+    old_logprobs = torch.tensor([-200.0, -2.0])
+    logprobs = torch.tensor([-195.0, -2.0], requires_grad=True)
+    lengths = torch.tensor([500.0, 1.0])
+    loss, ratio = ppo_clipped_loss(logprobs, old_logprobs, advantages, clip_epsilon=0.2, lengths=lengths)
+    loss.backward()
+    assert torch.allclose(ratio, torch.tensor([0.01, 0.0]).exp())
+    assert torch.allclose(logprobs.grad, -(ratio * advantages) / 2)
+
+
+def test_ppo_clip_mask_counts_only_active_clipped_terms() -> None:
+    ratio = torch.tensor([1.5, 1.5, 0.5, 0.5, 1.0])
+    advantages = torch.tensor([1.0, -1.0, 1.0, -1.0, 1.0])
+    assert ppo_clip_mask(ratio, advantages, clip_epsilon=0.2).tolist() == [True, False, False, True, False]
@@ -0,0 +1,87 @@
+from pathlib import Path
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+from src.training.checkpointing import (
+    TRAINER_STATE_NAME,
+    CheckpointWriter,
+    cpu_snapshot,
+    list_checkpoints,
+    prune_checkpoints,
+    resolve_resume_checkpoint,
+)
+
+
+def _make_checkpoint(root: Path, step: int, *, complete: bool = True) -> Path:
+    path = root / f"step-{step}"
+    path.mkdir(parents=True)
+    if complete:
+        torch.save({"step": step}, path / TRAINER_STATE_NAME)
+    return path
+
+
+def test_list_checkpoints_orders_by_step_and_skips_incomplete(tmp_path: Path) -> None:
+    _make_checkpoint(tmp_path, 10)
+    _make_checkpoint(tmp_path, 2)
+    _make_checkpoint(tmp_path, 30, complete=False)
+    (tmp_path / "step-40.tmp").mkdir()
+
+    assert [path.name for path in list_checkpoints(tmp_path)] == ["step-2", "step-10"]
+    assert list_checkpoints(tmp_path / "missing") == []
+
+
+def test_resolve_resume_checkpoint(tmp_path: Path) -> None:
+    assert resolve_resume_checkpoint(tmp_path, None) is None
+    assert resolve_resume_checkpoint(tmp_path, "latest") is None
+    latest = _make_checkpoint(tmp_path, 5)
+    _make_checkpoint(tmp_path, 3)
+
+    assert resolve_resume_checkpoint(tmp_path, "latest") == latest
+    assert resolve_resume_checkpoint(tmp_path, str(latest)) == latest
+    with pytest.raises(RuntimeError, match=TRAINER_STATE_NAME):
+        resolve_resume_checkpoint(tmp_path, str(tmp_path / "step-9"))
+
+
+def test_prune_checkpoints_keeps_last_k(tmp_path: Path) -> None:
+    for step in (1, 2, 3, 4):
+        _make_checkpoint(tmp_path, step)
+
+    prune_checkpoints(tmp_path, 0)
+    assert len(list_checkpoints(tmp_path)) == 4
+    prune_checkpoints(tmp_path, 2)
+    assert [path.name for path in list_checkpoints(tmp_path)] == ["step-3", "step-4"]
+
+
+def test_cpu_snapshot_copies_nested_tensors() -> None:
+    value = torch.ones(2)
+    snapshot = cpu_snapshot({"state": {0: {"exp_avg": value, "step": 3}}, "groups": [(value, "lr")]})
+    value.add_(1)
+
+    assert torch.equal(snapshot["state"][0]["exp_avg"], torch.ones(2))
+    assert snapshot["state"][0]["step"] == 3
+    assert torch.equal(snapshot["groups"][0][0], torch.ones(2))
+
+
+def test_checkpoint_writer_runs_in_background_and_reraises() -> None:
+    writer = CheckpointWriter(background=True)
+    release = threading.Event()
+    written: list[str] = []
+
+    def slow_write() -> None:
+        release.wait(timeout=5)
+        written.append(threading.current_thread().name)
+
+    writer.submit(slow_write)
+    assert written == []
+    release.set()
+    writer.wait()
+    assert written and written[0].startswith("mrvf-checkpoint")
+
+    def failing_write() -> None:
+        raise OSError("disk full")
+
+    writer.submit(failing_write)
+    with pytest.raises(OSError, match="disk full"):
+        writer.close()
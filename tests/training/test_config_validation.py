@@ -121,3 +121,39 @@ def test_qwen3_4b_budgeted_config_is_valid() -> None:
     assert cfg.force_close_thinking is True
     assert cfg.lora_r == 16
     assert cfg.gradient_accumulation_steps == 2
+
+
+def test_share_reference_prefix_requires_no_gradient_checkpointing() -> None:
+    cfg = MRVFConfig(share_reference_prefix=True, gradient_checkpointing=True)
+    with pytest.raises(ValueError, match="share_reference_prefix"):
+        cfg.validate()
+
+
+def test_fused_trace_logprobs_rejects_zero_advantage_skipping() -> None:
+    cfg = MRVFConfig(fuse_trace_logprobs=True, skip_zero_advantage_groups=True)
+    with pytest.raises(ValueError, match="fuse_trace_logprobs"):
+        cfg.validate()
+
+
+def test_vllm_rollout_backend_requires_peft() -> None:
+    cfg = MRVFConfig(rollout_backend="vllm")
+    with pytest.raises(ValueError, match="use_peft"):
+        cfg.validate()
+
+
+def test_ppo_replay_rejects_async_rollout() -> None:
+    cfg = MRVFConfig(ppo_epochs=2, async_rollout=True)
+    with pytest.raises(ValueError, match="async_rollout"):
+        cfg.validate()
+
+
+def test_profile_window_must_be_ordered() -> None:
+    cfg = MRVFConfig(profile_start_step=5, profile_end_step=3)
+    with pytest.raises(ValueError, match="profile_end_step"):
+        cfg.validate()
+
+
+def test_frozen_base_prompt_baseline_requires_peft() -> None:
+    cfg = MRVFConfig(reward_baseline_mode="prompt_relative", prompt_baseline_source="frozen_base")
+    with pytest.raises(ValueError, match="frozen_base"):
+        cfg.validate()
@@ -1,3 +1,7 @@
+from dataclasses import asdict
+from pathlib import Path
+import random
+
 import pytest
 
 datasets = pytest.importorskip("datasets")
@@ -29,3 +33,43 @@ def test_prepare_mrvf_dataset_filters_and_deduplicates() -> None:
     assert row["references"] == ["j1", "j2"]
     assert row["scores"] == [0.9, 0.5]
     assert row["prompt"] == "Write a joke using the following keywords: cat, dog"
+
+
+def test_prepare_mrvf_dataset_matches_normalize_row() -> None:
+    from src.training.data import normalize_row
+
+    rng = random.Random(0)
+    rows = []
+    for index in range(200):
+        references = [rng.choice(["j1", " j1", "j2", "", "  ", "j3 j4"]) for _ in range(rng.randint(0, 5))]
+        rows.append(
+            {
+                "id": index,
+                "keywords": [rng.choice(["cat", " dog ", "", " "]) for _ in range(rng.randint(0, 3))],
+                "references": references,
+                "scores": [rng.random() for _ in range(rng.randint(0, len(references)))],
+            }
+        )
+    for max_reference_samples in (0, 1, 3):
+        expected = [
+            asdict(normalized)
+            for normalized in (normalize_row(row, max_reference_samples=max_reference_samples) for row in rows)
+            if normalized is not None
+        ]
+        prepared = prepare_mrvf_dataset(Dataset.from_list(rows), max_reference_samples=max_reference_samples)
+        assert prepared.to_list() == expected
+
+
+def test_prepare_mrvf_dataset_reuses_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    import src.training.data as data
+
+    dataset = Dataset.from_list([{"id": 1, "keywords": ["cat"], "references": ["j1"], "scores": [0.9]}])
+    first = prepare_mrvf_dataset(dataset, max_reference_samples=2, cache_dir=tmp_path)
+
+    def fail(*args: object, **kwargs: object) -> None:
+        raise AssertionError("cached dataset should be reused")
+
+    monkeypatch.setattr(data, "_prepare_mrvf_frame", fail)
+    second = prepare_mrvf_dataset(dataset, max_reference_samples=2, cache_dir=tmp_path)
+    assert second.to_list() == first.to_list()
+    assert not list((tmp_path / "prepared").glob("*.tmp"))
@@ -0,0 +1,146 @@
+import json
+import os
+from pathlib import Path
+import socket
+
+import pytest
+
+torch = pytest.importorskip("torch")
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from src.training.distributed import (
+    DistributedContext,
+    GradientReducer,
+    all_gather_objects,
+    all_reduce_gradients,
+    all_reduce_metrics,
+    init_distributed,
+    shard_rows,
+)
+
+WORLD_SIZE = 2
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as handle:
+        handle.bind(("127.0.0.1", 0))
+        return handle.getsockname()[1]
+
+
+def _init_rank(rank: int, port: int) -> DistributedContext:
+    os.environ.update(
+        {
+            "MASTER_ADDR": "127.0.0.1",
+            "MASTER_PORT": str(port),
+            "RANK": str(rank),
+            "LOCAL_RANK": str(rank),
+            "WORLD_SIZE": str(WORLD_SIZE),
+        }
+    )
+    return init_distributed("gloo")
+
+
+def _reduce_worker(rank: int, port: int) -> None:
+    context = _init_rank(rank, port)
+    try:
+        model = torch.nn.Linear(2, 1)
+        frozen = torch.nn.Parameter(torch.ones(1), requires_grad=False)
+        for param in model.parameters():
+            param.grad = torch.full_like(param, float(rank + 1))
+        all_reduce_gradients([*model.parameters(), frozen], context)
+        assert all(torch.allclose(param.grad, torch.full_like(param, 1.5)) for param in model.parameters())
+        assert frozen.grad is None
+
+        bucketed = torch.nn.Linear(3, 2).to(torch.bfloat16)
+        bucketed.weight.grad = torch.full_like(bucketed.weight, float(rank + 1))
+        all_reduce_gradients(bucketed.parameters(), context, bucket_size_bytes=4)
+        assert bucketed.weight.grad.dtype == torch.bfloat16
+        assert torch.allclose(bucketed.weight.grad.float(), torch.full((2, 3), 1.5))
+        assert torch.equal(bucketed.bias.grad, torch.zeros_like(bucketed.bias))
+
+        torch.manual_seed(0)
+        overlapped = torch.nn.Sequential(torch.nn.Linear(2, 2), torch.nn.Linear(2, 1))
+        unused = torch.nn.Parameter(torch.ones(3))
+        reducer = GradientReducer([unused, *overlapped.parameters()], context, bucket_size_bytes=4)
+        inputs = torch.full((1, 2), float(rank + 1))
+        reducer.require_sync = False
+        overlapped(inputs).sum().backward()
+        assert not reducer._launched
+        reducer.require_sync = True
+        overlapped(inputs).sum().backward()
+        assert len(reducer._launched) == len(reducer.buckets) - 1
+        reducer.finish()
+        reducer.close()
+        head = overlapped[1].weight.detach()
+        assert torch.allclose(overlapped[0].bias.grad, 2 * head.reshape(-1))
+        assert torch.allclose(overlapped[0].weight.grad, 2 * 1.5 * head.T.expand(2, 2))
+        assert torch.equal(unused.grad, torch.zeros(3))
+
+        metrics = all_reduce_metrics({"loss": float(rank), "reward_mean": 2.0}, context, torch.device("cpu"))
+        assert metrics == {"loss": 0.5, "reward_mean": 2.0}
+        assert all_gather_objects({"cursor": rank}, context) == [{"cursor": 0}, {"cursor": 1}]
+    finally:
+        dist.destroy_process_group()
+
+
+def _train_worker(rank: int, port: int, tmp_dir: str) -> None:
+    from test_mrvf_trainer import _build_trainer
+    from datasets import Dataset
+
+    context = _init_rank(rank, port)
+    try:
+        torch.manual_seed(0)
+        trainer = _build_trainer(Path(tmp_dir) / f"rank-{rank}", num_generations=2)
+        trainer.dist = context
+        trainer.cfg.max_steps = 2
+        trainer.cfg.save_steps = 1
+        trainer.cfg.eval_sample_size = 0
+        trainer.cfg.per_device_train_batch_size = 1
+        trainer.cfg.output_dir = str(Path(tmp_dir) / f"ckpt-{rank}")
+        trainer.cfg.metrics_log_path = str(Path(tmp_dir) / f"metrics-{rank}.jsonl")
+        trainer.tokenizer.save_pretrained = lambda save_directory: None
+        rows = [
+            {"id": index, "keywords": [keyword], "references": [f"joke about {keyword}", "pun"], "scores": [1.0, 0.5]}
+            for index, keyword in enumerate(["cats", "dogs", "owls", "bees"])
+        ]
+        seen_prompts: list[str] = []
+        original_compute = trainer._compute_losses_for_batch
+
+        def compute(batch_rows, trace_batch=None, replay=None):
+            seen_prompts.extend(row["prompt"] for row in batch_rows)
+            return original_compute(batch_rows, trace_batch, replay)
+
+        trainer._compute_losses_for_batch = compute
+        trainer.train(Dataset.from_list(rows), Dataset.from_list(rows))
+
+        flat = torch.cat([param.detach().reshape(-1) for param in trainer.model.parameters()])
+        gathered = [torch.zeros_like(flat) for _ in range(WORLD_SIZE)]
+        dist.all_gather(gathered, flat)
+        assert torch.equal(gathered[0], gathered[1])
+
+        prompts = [None] * WORLD_SIZE
+        dist.all_gather_object(prompts, seen_prompts)
+        assert not set(prompts[0]) & set(prompts[1])
+    finally:
+        dist.destroy_process_group()
+
+
+def test_shard_rows_partitions_by_rank() -> None:
+    rows = list(range(7))
+    shards = [shard_rows(rows, DistributedContext(rank=rank, world_size=3)) for rank in range(3)]
+    assert shards == [[0, 3, 6], [1, 4], [2, 5]]
+
+
+def test_gradients_and_metrics_are_averaged_across_ranks() -> None:
+    mp.spawn(_reduce_worker, args=(_free_port(),), nprocs=WORLD_SIZE, join=True)
+
+
+def test_data_parallel_training_keeps_ranks_in_sync(tmp_path: Path) -> None:
+    mp.spawn(_train_worker, args=(_free_port(), str(tmp_path)), nprocs=WORLD_SIZE, join=True)
+
+    logged = [json.loads(line) for line in (tmp_path / "metrics-0.jsonl").read_text().splitlines()]
+    assert [payload["step"] for payload in logged] == [1, 2]
+    assert not (tmp_path / "metrics-1.jsonl").exists()
+    assert (tmp_path / "ckpt-0" / "step-1").exists()
+    assert not (tmp_path / "ckpt-1").exists()
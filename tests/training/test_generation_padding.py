@@ -1,3 +1,5 @@
+import pytest
+
 from src.training.generation_utils import extract_completion_ids
 
 
@@ -13,3 +15,16 @@ def test_extract_completion_ids_drops_padding_tokens() -> None:
     row = [0, 21, 22, 23, 77, 0, 0]
     completion = extract_completion_ids(row, input_width=4, pad_token_id=0)
     assert completion == [77]
+
+
+def test_extract_completion_ids_batch_matches_per_row_extraction() -> None:
+    torch = pytest.importorskip("torch")
+    from src.training.generation_utils import extract_completion_ids_batch
+
+    rows = [[0, 11, 12, 91, 92, 0], [21, 22, 23, 0, 0, 0], [0, 0, 31, 77, 78, 79]]
+    generated = torch.tensor(rows, dtype=torch.long)
+
+    completions = extract_completion_ids_batch(generated, input_width=3, pad_token_id=0)
+
+    assert completions == [extract_completion_ids(row, input_width=3, pad_token_id=0) for row in rows]
+    assert completions == [[91, 92], [], [77, 78, 79]]
@@ -0,0 +1,113 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+from src.training.logprobs import masked_sequence_logprobs
+
+
+def _tiny_gpt2(vocab_size: int = 48) -> "torch.nn.Module":
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=vocab_size, n_positions=64, n_embd=16, n_layer=2, n_head=2)
+    model = transformers.GPT2LMHeadModel(config)
+    model.eval()
+    return model
+
+
+@pytest.mark.parametrize("chunk_size", [2, 1024])
+def test_target_only_logprobs_match_full_logits(chunk_size: int) -> None:
+    model = _tiny_gpt2()
+    input_ids = torch.tensor([[5, 6, 7, 8, 9, 10], [11, 12, 13, 0, 0, 0]])
+    attention_mask = torch.tensor([[1, 1, 1, 1, 1, 1], [1, 1, 1, 0, 0, 0]])
+    target_mask = torch.tensor([[0, 0, 1, 1, 1, 1], [0, 1, 1, 0, 0, 0]])
+
+    full = masked_sequence_logprobs(
+        model=model,
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        target_mask=target_mask,
+    )
+    full.sum().backward()
+    full_grads = [param.grad.clone() for param in model.parameters()]
+    model.zero_grad(set_to_none=True)
+
+    target_only = masked_sequence_logprobs(
+        model=model,
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        target_mask=target_mask,
+        target_only=True,
+        chunk_size=chunk_size,
+    )
+    target_only.sum().backward()
+    target_only_grads = [param.grad for param in model.parameters()]
+
+    assert torch.allclose(full, target_only, atol=1e-5)
+    for expected, actual in zip(full_grads, target_only_grads, strict=True):
+        assert torch.allclose(expected, actual, atol=1e-5)
+
+
+def test_target_only_falls_back_to_logits_without_backbone() -> None:
+    class LogitsOnly(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.embed = torch.nn.Embedding(8, 8)
+
+        def forward(self, input_ids, attention_mask=None):
+            del attention_mask
+            return transformers.modeling_outputs.CausalLMOutput(logits=self.embed(input_ids))
+
+    model = LogitsOnly()
+    input_ids = torch.tensor([[1, 2, 3]])
+    mask = torch.ones_like(input_ids)
+    result = masked_sequence_logprobs(
+        model=model,
+        input_ids=input_ids,
+        attention_mask=mask,
+        target_mask=mask,
+        target_only=True,
+    )
+    assert result.shape == (1,)
+    assert torch.isfinite(result).all()
+
+
+@pytest.mark.parametrize("target_only", [False, True])
+def test_bf16_autocast_accumulates_logprobs_in_float32(target_only: bool) -> None:
+    model = _tiny_gpt2()
+    input_ids = torch.tensor([[5, 6, 7, 8, 9, 10], [11, 12, 13, 14, 0, 0]])
+    attention_mask = torch.tensor([[1, 1, 1, 1, 1, 1], [1, 1, 1, 1, 0, 0]])
+    target_mask = torch.tensor([[0, 0, 1, 1, 1, 1], [0, 1, 1, 1, 0, 0]])
+    kwargs = {"input_ids": input_ids, "attention_mask": attention_mask, "target_mask": target_mask}
+
+    expected = masked_sequence_logprobs(model=model, **kwargs)
+    with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+        actual = masked_sequence_logprobs(model=model, target_only=target_only, chunk_size=2, **kwargs)
+
+    assert actual.dtype == torch.float32
+    assert torch.allclose(actual, expected, atol=0.1)
+
+
+def test_target_only_falls_back_to_full_forward_for_scaled_logits() -> None:
+    from src.training.logprobs import _resolve_backbone_and_head
+
+    torch.manual_seed(0)
+    config = transformers.GraniteConfig(
+        vocab_size=48,
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        num_key_value_heads=2,
+        logits_scaling=4.0,
+    )
+    model = transformers.GraniteForCausalLM(config)
+    model.eval()
+    input_ids = torch.tensor([[5, 6, 7, 8]])
+    mask = torch.ones_like(input_ids)
+    kwargs = {"input_ids": input_ids, "attention_mask": mask, "target_mask": mask}
+
+    assert _resolve_backbone_and_head(model) is None
+    assert _resolve_backbone_and_head(_tiny_gpt2()) is not None
+    assert torch.allclose(
+        masked_sequence_logprobs(model=model, target_only=True, **kwargs),
+        masked_sequence_logprobs(model=model, **kwargs),
+    )
@@ -1,13 +1,18 @@
+import json
 import types
+from dataclasses import replace
 from pathlib import Path
 from typing import Any
 
 import pytest
 
+from src.training.checkpointing import CheckpointWriter, list_checkpoints
 from src.training.config import MRVFConfig
+from src.training.distributed import DistributedContext
+from src.training.logprobs import masked_sequence_logprobs_by_mask
 
 torch = pytest.importorskip("torch")
-from src.training.mrvf_trainer import MRVFTrainer
+from src.training.mrvf_trainer import DataStreamState, MRVFTrainer, _SubsequenceStoppingCriteria
 
 
 class DummyTokenizer:
@@ -28,6 +33,8 @@ class DummyTokenizer:
         del add_special_tokens
         if isinstance(text, list):
             rows = [self._encode(item, truncation=truncation, max_length=max_length) for item in text]
+            if not padding:
+                return {"input_ids": rows}
             max_len = max(len(row) for row in rows)
             padded: list[list[int]] = []
             masks: list[list[int]] = []
@@ -72,6 +79,7 @@ class DummyModel(torch.nn.Module):
         self.embed = torch.nn.Embedding(vocab_size, 16)
         self.head = torch.nn.Linear(16, vocab_size)
         self.last_generate_input_width: int | None = None
+        self.last_generate_kwargs: dict[str, Any] = {}
         self.append_tokens: list[int] = [7, 8]
 
     def forward(self, input_ids, attention_mask=None):
@@ -81,8 +89,9 @@ class DummyModel(torch.nn.Module):
         return types.SimpleNamespace(logits=logits)
 
     def generate(self, *, input_ids, attention_mask=None, **kwargs):
-        del attention_mask, kwargs
+        del attention_mask
         self.last_generate_input_width = input_ids.shape[1]
+        self.last_generate_kwargs = kwargs
         append = torch.tensor(
             [self.append_tokens for _ in range(input_ids.shape[0])],
             dtype=input_ids.dtype,
@@ -90,22 +99,36 @@ class DummyModel(torch.nn.Module):
         )
         return torch.cat([input_ids, append], dim=1)
 
-    def save_pretrained(self, save_directory):
+    def save_pretrained(self, save_directory, state_dict=None):
+        from safetensors.torch import save_file
+
         Path(save_directory).mkdir(parents=True, exist_ok=True)
+        state = state_dict if state_dict is not None else self.state_dict()
+        save_file(state, str(Path(save_directory) / "model.safetensors"))
 
 
 class DummyScheduler:
+    def __init__(self) -> None:
+        self.steps = 0
+
     def step(self) -> None:
-        return None
+        self.steps += 1
 
     def get_last_lr(self) -> list[float]:
         return [1e-3]
 
+    def state_dict(self) -> dict[str, int]:
+        return {"steps": self.steps}
+
+    def load_state_dict(self, state_dict: dict[str, int]) -> None:
+        self.steps = state_dict["steps"]
+
 
 def _build_trainer(tmp_path: Path, *, num_generations: int = 2) -> MRVFTrainer:
     cfg = MRVFConfig(
         model_name_or_path="dummy",
         output_dir=str(tmp_path / "ckpt"),
+        dataset_cache_dir=str(tmp_path / "cache"),
         use_kl=False,
         beta=0.0,
         num_generations=num_generations,
@@ -131,6 +154,16 @@ def _build_trainer(tmp_path: Path, *, num_generations: int = 2) -> MRVFTrainer:
     trainer.random = __import__("random").Random(0)
     trainer._current_step = 0
     trainer._wandb_run = None
+    trainer._static_text_ids = {}
+    trainer._reference_token_budget = cfg.reference_max_tokens_per_forward
+    trainer._vllm_engine = None
+    trainer._replay_buffer = []
+    trainer._data_stream = DataStreamState()
+    trainer._checkpoint_writer = CheckpointWriter(background=False)
+    trainer._log_lock = __import__("threading").Lock()
+    trainer._prompt_baseline_cache = None
+    trainer._sequence_logprobs_fn = masked_sequence_logprobs_by_mask
+    trainer.dist = DistributedContext()
     return trainer
 
 
@@ -169,6 +202,8 @@ def test_compute_losses_for_batch_backward_has_gradients(tmp_path: Path) -> None
     assert metrics["forced_think_close_fraction"] == 0.0
     assert "effective_reference_prefix_length_mean" in metrics
     assert "effective_reference_prefix_length_max" in metrics
+    assert metrics["trace_decode_steps"] == 2.0
+    assert metrics["trace_decode_tokens_saved"] == 2 * (trainer.cfg.max_trace_length - 2)
     assert sample is not None
     assert sample.prompt == batch_rows[0]["prompt"]
     assert len(sample.references) == 2
@@ -189,6 +224,28 @@ def test_compute_losses_for_batch_backward_has_gradients(tmp_path: Path) -> None
     assert nonzero, "Expected at least one nonzero gradient."
 
 
+def test_compute_losses_for_batch_transfers_metrics_once(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    trainer = _build_trainer(tmp_path, num_generations=2)
+    trainer.cfg.reward_baseline_mode = "prompt_relative"
+    trainer.cfg.ppo_epochs = 2
+    batch_rows = [{"prompt": "Write a joke about cats", "references": ["joke one", "joke two"]}]
+    _, expected_metrics, _ = trainer._compute_losses_for_batch(batch_rows)
+    trainer._replay_buffer.clear()
+
+    def fail_item(self: torch.Tensor) -> float:
+        raise AssertionError("unexpected host sync via .item()")
+
+    monkeypatch.setattr(torch.Tensor, "item", fail_item)
+    loss, metrics, sample = trainer._compute_losses_for_batch(batch_rows)
+
+    assert list(metrics) == list(expected_metrics)
+    assert metrics["loss"] == pytest.approx(float(loss.detach()))
+    assert metrics["relative_reward_mean"] == metrics["reward_mean"]
+    assert metrics["ppo_ratio_mean"] == pytest.approx(1.0)
+    assert sample is not None
+    assert sum(trace.reward for trace in sample.traces) / 2 == pytest.approx(metrics["reward_mean"], abs=1e-5)
+
+
 def test_prompt_relative_reward_changes_advantages_but_not_reference_loss(tmp_path: Path) -> None:
     trainer = _build_trainer(tmp_path, num_generations=2)
     batch_rows = [
@@ -291,3 +348,726 @@ def test_forced_think_close_not_added_after_sampled_close(tmp_path: Path) -> Non
         suffix_ids != prefix[-(len(suffix_ids) + len(trainer.tokenizer(trainer.cfg.answer_prefix, add_special_tokens=False)["input_ids"])) : -len(trainer.tokenizer(trainer.cfg.answer_prefix, add_special_tokens=False)["input_ids"])]
         for prefix in trace_batch.reference_prefix_ids
     )
+
+
+@pytest.mark.parametrize(
+    ("objective_mode", "reward_transform", "length_normalization"),
+    [
+        ("log_mass_surrogate", "log_mass", "token_mean"),
+        ("exact_scaled", "centered_prob_mass", "none"),
+        ("mrvf_lite", "log_mass", "sqrt"),
+    ],
+)
+def test_single_pass_reference_scoring_matches_two_pass(
+    tmp_path: Path,
+    objective_mode: str,
+    reward_transform: str,
+    length_normalization: str,
+) -> None:
+    trainer = _build_trainer(tmp_path, num_generations=2)
+    trainer.cfg.objective_mode = objective_mode
+    trainer.cfg.reward_transform = reward_transform
+    trainer.cfg.reference_length_normalization = length_normalization
+    batch_rows = [
+        {
+            "prompt": "Write a joke about cats",
+            "references": ["joke one", "joke two"],
+        }
+    ]
+
+    two_pass_loss, two_pass_metrics, _ = trainer._compute_losses_for_batch(batch_rows)
+    trainer.optimizer.zero_grad(set_to_none=True)
+    two_pass_loss.backward()
+    two_pass_grads = [param.grad.clone() for param in trainer.model.parameters()]
+
+    trainer.cfg.single_pass_reference_scoring = True
+    single_pass_loss, single_pass_metrics, _ = trainer._compute_losses_for_batch(batch_rows)
+    trainer.optimizer.zero_grad(set_to_none=True)
+    single_pass_loss.backward()
+    single_pass_grads = [param.grad for param in trainer.model.parameters()]
+
+    assert two_pass_metrics["reward_pass_seconds"] > 0.0
+    assert single_pass_metrics["reward_pass_seconds"] == 0.0
+    assert single_pass_metrics["reference_pass_seconds"] > 0.0
+    for key in ("loss", "trace_loss", "reference_loss", "reward_mean", "advantage_abs_mean"):
+        assert single_pass_metrics[key] == pytest.approx(two_pass_metrics[key], abs=1e-6)
+    for expected, actual in zip(two_pass_grads, single_pass_grads, strict=True):
+        assert torch.allclose(expected, actual, atol=1e-6)
+
+
+def test_think_close_stopping_criteria_is_per_row() -> None:
+    criteria = _SubsequenceStoppingCriteria([4, 5], input_width=3)
+    input_ids = torch.tensor(
+        [
+            [1, 4, 5, 9, 4, 5],
+            [1, 2, 3, 4, 5, 6],
+            [1, 2, 3, 9, 9, 9],
+        ]
+    )
+    assert criteria(input_ids, None).tolist() == [True, False, False]
+    assert criteria(input_ids[:, :4], None).tolist() == [False, False, False]
+
+
+def test_generation_stops_rows_at_think_close() -> None:
+    transformers = pytest.importorskip("transformers")
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=32, n_positions=64, n_embd=16, n_layer=2, n_head=2)
+    model = transformers.GPT2LMHeadModel(config).eval()
+    input_ids = torch.tensor([[3, 4, 5], [6, 7, 8]])
+    kwargs = {"input_ids": input_ids, "do_sample": False, "max_new_tokens": 12, "pad_token_id": 0}
+
+    full = model.generate(**kwargs)
+    pattern = full[0, 3:5].tolist()
+    stopped = model.generate(
+        **kwargs,
+        stopping_criteria=transformers.StoppingCriteriaList([_SubsequenceStoppingCriteria(pattern, input_width=3)]),
+    )
+
+    assert stopped[0, 3:5].tolist() == pattern
+    assert all(token == 0 for token in stopped[0, 5:].tolist())
+    assert stopped[1].tolist() == full[1, : stopped.shape[1]].tolist()
+
+
+def test_generate_trace_batch_passes_think_close_stopping(tmp_path: Path) -> None:
+    trainer = _build_trainer(tmp_path, num_generations=2)
+    trace_batch = trainer._generate_trace_batch(["short"], [["r1"]])
+    criteria = trainer.model.last_generate_kwargs["stopping_criteria"]
+    assert isinstance(criteria[0], _SubsequenceStoppingCriteria)
+    assert criteria[0].pattern.tolist() == trainer.tokenizer("</think>", add_special_tokens=False)["input_ids"]
+    assert trace_batch.decode_steps == 2
+
+    trainer.cfg.stop_at_think_close = False
+    trainer._generate_trace_batch(["short"], [["r1"]])
+    assert "stopping_criteria" not in trainer.model.last_generate_kwargs
+
+
+def test_prefill_prompts_once_matches_duplicated_prompts(tmp_path: Path) -> None:
+    transformers = pytest.importorskip("transformers")
+    trainer = _build_trainer(tmp_path, num_generations=3)
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(
+        vocab_size=32,
+        n_positions=512,
+        n_embd=16,
+        n_layer=2,
+        n_head=2,
+        bos_token_id=0,
+        eos_token_id=None,
+        initializer_range=0.5,
+    )
+    trainer.model = transformers.GPT2LMHeadModel(config)
+    prompts = ["short", "this prompt is longer"]
+    references = [["r1"], ["r2"]]
+
+    torch.manual_seed(1)
+    duplicated = trainer._generate_trace_batch(prompts, references)
+    trainer.cfg.prefill_prompts_once = True
+    torch.manual_seed(1)
+    prefilled = trainer._generate_trace_batch(prompts, references)
+
+    assert prefilled.prompt_ids == duplicated.prompt_ids
+    assert prefilled.trace_ids == duplicated.trace_ids
+    assert prefilled.references == duplicated.references
+    assert prefilled.prompt_ids[0] == prefilled.prompt_ids[2]
+    assert prefilled.prompt_ids[3] == prefilled.prompt_ids[5]
+
+
+def test_pretokenized_rows_match_string_rows(tmp_path: Path) -> None:
+    from datasets import Dataset
+
+    from src.training.data import tokenize_mrvf_dataset
+
+    trainer = _build_trainer(tmp_path, num_generations=2)
+    trainer.tokenizer.name_or_path = "dummy"
+    rows = [{"id": 1, "prompt": "Write a joke about cats", "references": ["joke one", "joke two"]}]
+    cache_dir = tmp_path / "cache"
+    kwargs = {"tokenizer": trainer.tokenizer, "cfg": trainer.cfg, "cache_dir": cache_dir}
+    tokenized = tokenize_mrvf_dataset(Dataset.from_list(rows), **kwargs)
+    cached = tokenize_mrvf_dataset(Dataset.from_list(rows), **kwargs)
+
+    assert len(list(cache_dir.iterdir())) == 1
+    assert cached[0] == tokenized[0]
+    assert tokenized[0]["trace_prompt"] == trainer._build_trace_prompt_text(rows[0]["prompt"])
+    assert tokenized[0]["reference_ids"] == [trainer.tokenizer(ref)["input_ids"] for ref in rows[0]["references"]]
+
+    _, string_metrics, _ = trainer._compute_losses_for_batch(rows)
+    _, pretokenized_metrics, _ = trainer._compute_losses_for_batch([dict(tokenized[0])])
+    for key in ("loss", "reward_mean", "effective_reference_prefix_length_mean"):
+        assert pretokenized_metrics[key] == pytest.approx(string_metrics[key])
+
+
+def test_zero_advantage_groups_are_skipped_from_trace_pass(tmp_path: Path) -> None:
+    trainer = _build_trainer(tmp_path, num_generations=2)
+    trainer.cfg.reference_loss_coef = 0.5
+    original_generate = trainer.model.generate
+
+    def generate(*, input_ids, attention_mask=None, **kwargs):
+        generated = original_generate(input_ids=input_ids, attention_mask=attention_mask, **kwargs)
+        generated[3, -1] = 9
+        return generated
+
+    def forward(input_ids, attention_mask=None):
+        del attention_mask
+        hidden = trainer.model.embed(input_ids).cumsum(dim=1)
+        return types.SimpleNamespace(logits=trainer.model.head(hidden))
+
+    trainer.model.generate = generate
+    trainer.model.forward = forward
+    batch_rows = [
+        {"prompt": "Write a joke about cats", "references": ["joke one", "joke two"]},
+        {"prompt": "Write a joke about dogs", "references": ["joke three", "joke four"]},
+    ]
+    scored_rows: list[list[int] | None] = []
+    original_trace_logprobs = trainer._trace_logprobs
+
+    def trace_logprobs(trace_batch, model, rows=None):
+        scored_rows.append(rows)
+        return original_trace_logprobs(trace_batch, model, rows)
+
+    trainer._trace_logprobs = trace_logprobs
+
+    torch.manual_seed(0)
+    full_loss, full_metrics, _ = trainer._compute_losses_for_batch(batch_rows)
+    trainer.optimizer.zero_grad(set_to_none=True)
+    full_loss.backward()
+    full_grads = [param.grad.clone() for param in trainer.model.parameters()]
+
+    trainer.cfg.skip_zero_advantage_groups = True
+    torch.manual_seed(0)
+    skipped_loss, skipped_metrics, _ = trainer._compute_losses_for_batch(batch_rows)
+    trainer.optimizer.zero_grad(set_to_none=True)
+    skipped_loss.backward()
+    skipped_grads = [param.grad for param in trainer.model.parameters()]
+
+    assert scored_rows == [[0, 1, 2, 3], [2, 3]]
+    assert full_metrics["skipped_group_fraction"] == 0.0
+    assert skipped_metrics["skipped_group_fraction"] == 0.5
+    for key in ("loss", "trace_loss", "reference_loss"):
+        assert skipped_metrics[key] == pytest.approx(full_metrics[key], abs=1e-6)
+    for expected, actual in zip(full_grads, skipped_grads, strict=True):
+        assert torch.allclose(expected, actual, atol=1e-6)
+
+
+def test_all_zero_advantage_groups_keep_reference_loss(tmp_path: Path) -> None:
+    trainer = _build_trainer(tmp_path, num_generations=2)
+    trainer.cfg.skip_zero_advantage_groups = True
+    batch_rows = [{"prompt": "Write a joke about cats", "references": ["joke one", "joke two"]}]
+
+    loss, metrics, _ = trainer._compute_losses_for_batch(batch_rows)
+
+    assert metrics["skipped_group_fraction"] == 1.0
+    assert metrics["trace_loss"] == 0.0
+    assert metrics["reference_loss"] != 0.0
+    assert loss.requires_grad
+
+
+@pytest.mark.parametrize("single_pass", [False, True])
+@pytest.mark.parametrize("force_close_thinking", [False, True])
+def test_fused_trace_logprobs_match_separate_trace_pass(
+    tmp_path: Path,
+    single_pass: bool,
+    force_close_thinking: bool,
+) -> None:
+    trainer = _build_trainer(tmp_path, num_generations=2)
+    trainer.cfg.single_pass_reference_scoring = single_pass
+    trainer.cfg.force_close_thinking = force_close_thinking
+
+    def forward(input_ids, attention_mask=None):
+        del attention_mask
+        hidden = trainer.model.embed(input_ids).cumsum(dim=1)
+        return types.SimpleNamespace(logits=trainer.model.head(hidden))
+
+    original_generate = trainer.model.generate
+
+    def generate(*, input_ids, attention_mask=None, **kwargs):
+        generated = original_generate(input_ids=input_ids, attention_mask=attention_mask, **kwargs)
+        generated[1, -1] = 9
+        return generated
+
+    trainer.model.forward = forward
+    trainer.model.generate = generate
+    batch_rows = [{"prompt": "Write a joke about cats", "references": ["joke one", "joke two"]}]
+    trace_batch = trainer._generate_trace_batch(
+        [row["prompt"] for row in batch_rows],
+        [row["references"] for row in batch_rows],
+    )
+    expected = trainer._trace_logprobs(trace_batch, trainer.model)
+    fused = trainer._score_trace_references(trace_batch, include_trace=True).trace_logps
+    assert fused is not None
+    assert torch.allclose(fused, expected, atol=1e-5)
+
+    separate_loss, separate_metrics, _ = trainer._compute_losses_for_batch(batch_rows)
+    trainer.optimizer.zero_grad(set_to_none=True)
+    separate_loss.backward()
+    separate_grads = [param.grad.clone() for param in trainer.model.parameters()]
+
+    trainer.cfg.fuse_trace_logprobs = True
+    fused_loss, fused_metrics, _ = trainer._compute_losses_for_batch(batch_rows)
+    trainer.optimizer.zero_grad(set_to_none=True)
+    fused_loss.backward()
+    fused_grads = [param.grad for param in trainer.model.parameters()]
+
+    assert separate_metrics["trace_loss"] != 0.0
+    for key in ("loss", "trace_loss", "reference_loss", "trace_logprob_mean", "effective_reference_prefix_length_mean"):
+        assert fused_metrics[key] == pytest.approx(separate_metrics[key], abs=1e-5)
+    for expected_grad, actual_grad in zip(separate_grads, fused_grads, strict=True):
+        assert torch.allclose(expected_grad, actual_grad, atol=1e-5)
+
+
+@pytest.mark.parametrize(("async_rollout", "ppo_epochs"), [(False, 1), (True, 1), (False, 2)])
+def test_train_consumes_rollouts_with_bounded_policy_lag(tmp_path: Path, async_rollout: bool, ppo_epochs: int) -> None:
+    from datasets import Dataset
+
+    trainer = _build_trainer(tmp_path, num_generations=2)
+    trainer.cfg.max_steps = 3
+    trainer.cfg.per_device_train_batch_size = 1
+    trainer.cfg.eval_sample_size = 0
+    trainer.cfg.metrics_log_path = str(tmp_path / "metrics.jsonl")
+    trainer.cfg.async_rollout = async_rollout
+    trainer.cfg.max_policy_lag = 1
+    trainer.cfg.ppo_epochs = ppo_epochs
+    trainer.tokenizer.save_pretrained = lambda save_directory: None
+    rows = [
+        {"id": index, "keywords": [keyword], "references": [f"joke about {keyword}", "another"], "scores": [1.0, 0.5]}
+        for index, keyword in enumerate(["cats", "dogs", "owls"])
+    ]
+
+    result = trainer.train(Dataset.from_list(rows), Dataset.from_list(rows))
+
+    logged = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines()]
+    assert result["rollout_steps"] == 3
+    assert result["steps"] == 3 * ppo_epochs
+    assert [payload["step"] for payload in logged] == list(range(1, 3 * ppo_epochs + 1))
+    assert all(0 <= payload["policy_lag"] <= trainer.cfg.max_policy_lag for payload in logged)
+    assert all("rollout_wait_seconds" in payload for payload in logged)
+    assert [payload["replay_epoch"] for payload in logged] == [1.0, 2.0] * 3 if ppo_epochs == 2 else [1.0] * 3
+    if ppo_epochs == 2:
+        assert [payload["policy_lag"] for payload in logged] == [0.0, 1.0] * 3
+
+
+def test_async_rollouts_train_on_the_same_batches_as_sync(tmp_path: Path) -> None:
+    from datasets import Dataset
+
+    rows = [
+        {"id": index, "keywords": [keyword], "references": [f"joke about {keyword}", "another"], "scores": [1.0, 0.5]}
+        for index, keyword in enumerate(["cats", "dogs", "owls", "bees", "fish"])
+    ]
+
+    def run(async_rollout: bool) -> tuple[list[str], list[torch.Generator | None]]:
+        trainer = _build_trainer(tmp_path / str(async_rollout), num_generations=2)
+        trainer.cfg.max_steps = 4
+        trainer.cfg.eval_sample_size = 0
+        trainer.cfg.metrics_log_path = str(tmp_path / f"metrics-{async_rollout}.jsonl")
+        trainer.cfg.async_rollout = async_rollout
+        trainer.tokenizer.save_pretrained = lambda save_directory: None
+        seen: list[str] = []
+        generators: list[torch.Generator | None] = []
+        original_compute = trainer._compute_losses_for_batch
+        original_sample = trainer._sample_completions
+
+        def compute(batch_rows, trace_batch=None, replay=None):
+            seen.extend(row["prompt"] for row in batch_rows)
+            return original_compute(batch_rows, trace_batch, replay)
+
+        def sample(model, tokenizer, prompt_ids, grouped_prompt_ids, generator=None):
+            generators.append(generator)
+            return original_sample(model, tokenizer, prompt_ids, grouped_prompt_ids, generator=generator)
+
+        trainer._compute_losses_for_batch = compute
+        trainer._sample_completions = sample
+        trainer.train(Dataset.from_list(rows), Dataset.from_list(rows))
+        return seen, generators
+
+    sync_seen, sync_generators = run(async_rollout=False)
+    async_seen, async_generators = run(async_rollout=True)
+
+    assert async_seen == sync_seen
+    assert sync_generators == [None] * 4
+    assert all(isinstance(generator, torch.Generator) for generator in async_generators)
+
+
+def test_seeded_sampling_processors_respect_top_k(tmp_path: Path) -> None:
+    trainer = _build_trainer(tmp_path)
+    trainer.cfg.top_k = 1
+    generator = torch.Generator().manual_seed(0)
+    processors = trainer._seeded_sampling_processors(generator)
+    scores = torch.randn(4, 16)
+
+    sampled = processors(torch.zeros(4, 1, dtype=torch.long), scores).argmax(dim=-1)
+
+    assert torch.equal(sampled, scores.argmax(dim=-1))
+
+
+def test_seeded_generation_uses_gumbel_sampling(tmp_path: Path) -> None:
+    from src.training.mrvf_trainer import _GumbelSamplingProcessor
+
+    trainer = _build_trainer(tmp_path)
+    trainer._generate_trace_batch(["Write a joke"], [["joke one"]], generator=torch.Generator().manual_seed(0))
+
+    kwargs = trainer.model.last_generate_kwargs
+    assert kwargs["do_sample"] is False
+    assert isinstance(kwargs["logits_processor"][-1], _GumbelSamplingProcessor)
+
+
+def test_generate_trace_batch_renders_prompts_with_given_tokenizer(tmp_path: Path) -> None:
+    import copy
+
+    trainer = _build_trainer(tmp_path, num_generations=2)
+    trainer.cfg.trace_format = "qwen_chat_thinking"
+    rollout_tokenizer = copy.deepcopy(trainer.tokenizer)
+    expected = trainer._build_trace_prompt_text("Write a joke")
+
+    def fail(*args, **kwargs):
+        msg = "main-thread tokenizer used"
+        raise AssertionError(msg)
+
+    trainer.tokenizer.apply_chat_template = fail
+    trace_batch = trainer._generate_trace_batch(["Write a joke"], [["joke one"]], tokenizer=rollout_tokenizer)
+
+    assert trace_batch.prompt_texts == [expected, expected]
+
+
+def test_vllm_backend_rejects_distributed_training(tmp_path: Path) -> None:
+    trainer = _build_trainer(tmp_path)
+    trainer.cfg.rollout_backend = "vllm"
+    trainer.dist = DistributedContext(rank=0, world_size=2)
+    with pytest.raises(ValueError, match="distributed"):
+        trainer._validate_distributed()
+
+
+def test_vllm_backend_builds_trace_batch_from_engine_token_ids(tmp_path: Path) -> None:
+    from src.training.vllm_rollout import VLLMRolloutEngine
+
+    trainer = _build_trainer(tmp_path, num_generations=2)
+    think_close_ids = trainer.tokenizer("</think>", add_special_tokens=False)["input_ids"]
+    prompt_ids = trainer.tokenizer(trainer._build_trace_prompt_text("Write a joke"), add_special_tokens=False)[
+        "input_ids"
+    ]
+
+    sampling_calls: list[dict[str, Any]] = []
+
+    class EngineLLM:
+        def generate(self, prompts, *, sampling_params, lora_request, use_tqdm):
+            del lora_request, use_tqdm
+            sampling_calls.append(sampling_params)
+            assert [prompt["prompt_token_ids"] for prompt in prompts] == [prompt_ids]
+            return [
+                types.SimpleNamespace(
+                    outputs=[
+                        types.SimpleNamespace(token_ids=[7, 8, *think_close_ids, 9], stop_reason=None),
+                        types.SimpleNamespace(token_ids=[10], stop_reason=None),
+                    ]
+                )
+            ]
+
+    trainer.cfg.vllm_adapter_dir = str(tmp_path / "adapter")
+    trainer._vllm_engine = VLLMRolloutEngine(
+        cfg=trainer.cfg,
+        llm=EngineLLM(),
+        sampling_params_cls=lambda **kwargs: kwargs,
+        lora_request_cls=lambda name, lora_int_id, path: types.SimpleNamespace(lora_int_id=lora_int_id),
+    )
+    trainer._vllm_engine.sync_adapter(trainer.model, step=0)
+
+    trace_batch = trainer._generate_trace_batch(["Write a joke"], [["joke one"]])
+
+    answer_prefix_ids = trainer.tokenizer(trainer.cfg.answer_prefix, add_special_tokens=False)["input_ids"]
+    assert trainer.model.last_generate_input_width is None
+    assert trace_batch.prompt_ids == [prompt_ids, prompt_ids]
+    assert trace_batch.trace_ids == [[7, 8, *think_close_ids], [10]]
+    assert trace_batch.reference_prefix_ids[0] == prompt_ids + [7, 8, *think_close_ids] + answer_prefix_ids
+    assert trace_batch.decode_steps == len(think_close_ids) + 3
+    assert len(think_close_ids) > 1
+    assert sampling_calls[0]["stop_token_ids"] == []
+    assert sampling_calls[0]["stop"] == ["</think>"]
+    assert sampling_calls[0]["include_stop_str_in_output"] is True
+
+
+def test_ppo_replay_reuses_rollout_with_importance_ratio(tmp_path: Path) -> None:
+    trainer = _build_trainer(tmp_path, num_generations=2)
+
+    def forward(input_ids, attention_mask=None):
+        del attention_mask
+        hidden = trainer.model.embed(input_ids).cumsum(dim=1)
+        return types.SimpleNamespace(logits=trainer.model.head(hidden))
+
+    original_generate = trainer.model.generate
+    generate_calls: list[int] = []
+
+    def generate(*, input_ids, attention_mask=None, **kwargs):
+        generate_calls.append(input_ids.shape[0])
+        generated = original_generate(input_ids=input_ids, attention_mask=attention_mask, **kwargs)
+        generated[1, -1] = 9
+        return generated
+
+    trainer.model.forward = forward
+    trainer.model.generate = generate
+    batch_rows = [{"prompt": "Write a joke about cats", "references": ["joke one", "joke two"]}]
+
+    torch.manual_seed(0)
+    plain_loss, _, _ = trainer._compute_losses_for_batch(batch_rows)
+    trainer.optimizer.zero_grad(set_to_none=True)
+    plain_loss.backward()
+    plain_grads = [param.grad.clone() for param in trainer.model.parameters()]
+
+    trainer.cfg.ppo_epochs = 2
+    torch.manual_seed(0)
+    first_loss, first_metrics, _ = trainer._compute_losses_for_batch(batch_rows)
+    trainer.optimizer.zero_grad(set_to_none=True)
+    first_loss.backward()
+    for expected, actual in zip(plain_grads, (param.grad for param in trainer.model.parameters()), strict=True):
+        assert torch.allclose(expected, actual, atol=1e-6)
+    assert first_metrics["ppo_ratio_mean"] == pytest.approx(1.0)
+    assert first_metrics["ppo_clip_fraction"] == 0.0
+    assert len(trainer._replay_buffer) == 1
+
+    trainer.optimizer.step()
+    replay = replace(trainer._replay_buffer.pop(), epoch=2)
+    _, replay_metrics, _ = trainer._compute_losses_for_batch(replay.batch_rows, replay=replay)
+
+    assert generate_calls == [2, 2]
+    assert not trainer._replay_buffer
+    assert replay_metrics["replay_epoch"] == 2.0
+    assert replay_metrics["reward_mean"] == pytest.approx(first_metrics["reward_mean"])
+    assert replay_metrics["ppo_ratio_mean"] != pytest.approx(1.0)
+    assert 0.0 <= replay_metrics["ppo_clip_fraction"] <= 1.0
+
+
+def test_train_logs_phase_timings_and_exports_profiler_window(tmp_path: Path) -> None:
+    from datasets import Dataset
+
+    trainer = _build_trainer(tmp_path, num_generations=2)
+    trainer.cfg.max_steps = 3
+    trainer.cfg.per_device_train_batch_size = 1
+    trainer.cfg.eval_sample_size = 0
+    trainer.cfg.metrics_log_path = str(tmp_path / "metrics.jsonl")
+    trainer.cfg.profile_start_step = 2
+    trainer.cfg.profile_end_step = 2
+    trainer.tokenizer.save_pretrained = lambda save_directory: None
+    rows = [
+        {"id": index, "keywords": [keyword], "references": [f"joke about {keyword}", "another"], "scores": [1.0, 0.5]}
+        for index, keyword in enumerate(["cats", "dogs"])
+    ]
+
+    trainer.train(Dataset.from_list(rows), Dataset.from_list(rows))
+
+    logged = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines()]
+    phases = ("prompt_build", "tokenize", "generate", "trace_logprob", "reward_pass", "reference_pass", "backward")
+    for payload in logged:
+        for phase in (*phases, "optimizer_step", "checkpoint_save"):
+            assert f"{phase}_seconds" in payload
+        for phase in phases:
+            assert payload[f"{phase}_seconds"] > 0.0 or phase == "reward_pass"
+    assert sorted(path.name for path in tmp_path.glob("*.trace.json")) == ["metrics.step-2.trace.json"]
+
+
+def test_train_resumes_from_latest_checkpoint_with_retention(tmp_path: Path) -> None:
+    from datasets import Dataset
+
+    rows = [
+        {"id": index, "keywords": [keyword], "references": [f"joke about {keyword}", "another"], "scores": [1.0, 0.5]}
+        for index, keyword in enumerate(["cats", "dogs", "owls"])
+    ]
+
+    def build(max_steps: int) -> MRVFTrainer:
+        trainer = _build_trainer(tmp_path, num_generations=2)
+        trainer.cfg.max_steps = max_steps
+        trainer.cfg.per_device_train_batch_size = 1
+        trainer.cfg.eval_sample_size = 0
+        trainer.cfg.metrics_log_path = str(tmp_path / "metrics.jsonl")
+        trainer.cfg.save_steps = 1
+        trainer.cfg.save_total_limit = 2
+        trainer.cfg.resume_from_checkpoint = "latest"
+        trainer._checkpoint_writer = CheckpointWriter(background=True)
+        trainer.tokenizer.save_pretrained = lambda save_directory: None
+        return trainer
+
+    first = build(max_steps=3)
+    first.train(Dataset.from_list(rows), Dataset.from_list(rows))
+    saved_weights = {name: param.detach().clone() for name, param in first.model.named_parameters()}
+
+    checkpoints = list_checkpoints(first.cfg.output_dir)
+    assert [path.name for path in checkpoints] == ["step-2", "step-3"]
+    assert not list(Path(first.cfg.output_dir).glob("*.tmp"))
+
+    second = build(max_steps=4)
+    step = second._load_checkpoint(checkpoints[-1])
+    assert step == 3
+    assert second.scheduler.steps == 3
+    assert second.random.getstate() == first.random.getstate()
+    assert second.optimizer.state_dict()["state"][0]["step"] == first.optimizer.state_dict()["state"][0]["step"]
+    for name, param in second.model.named_parameters():
+        assert torch.equal(param, saved_weights[name])
+
+    result = build(max_steps=4).train(Dataset.from_list(rows), Dataset.from_list(rows))
+
+    logged = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines()]
+    assert result["steps"] == 4
+    assert [payload["step"] for payload in logged] == [1, 2, 3, 4]
+    assert [path.name for path in list_checkpoints(first.cfg.output_dir)] == ["step-3", "step-4"]
+
+
+@pytest.mark.parametrize(("async_rollout", "ppo_epochs"), [(False, 1), (True, 1), (False, 2)])
+def test_resumed_training_continues_the_data_stream(tmp_path: Path, async_rollout: bool, ppo_epochs: int) -> None:
+    from datasets import Dataset
+
+    rows = [
+        {"id": index, "keywords": [keyword], "references": [f"joke about {keyword}", "another"], "scores": [1.0, 0.5]}
+        for index, keyword in enumerate(["cats", "dogs", "owls", "bees", "fish"])
+    ]
+
+    def run(name: str, resume_from_checkpoint: str | None = None) -> list[tuple[str, int]]:
+        trainer = _build_trainer(tmp_path / name, num_generations=2)
+        trainer.cfg.max_steps = 5
+        trainer.cfg.eval_sample_size = 0
+        trainer.cfg.metrics_log_path = str(tmp_path / f"metrics-{name}.jsonl")
+        trainer.cfg.save_steps = 1
+        trainer.cfg.async_rollout = async_rollout
+        trainer.cfg.ppo_epochs = ppo_epochs
+        trainer.cfg.resume_from_checkpoint = resume_from_checkpoint
+        trainer.tokenizer.save_pretrained = lambda save_directory: None
+        seen: list[tuple[str, int]] = []
+        original_compute = trainer._compute_losses_for_batch
+
+        def compute(batch_rows, trace_batch=None, replay=None):
+            seen.extend((row["prompt"], 1 if replay is None else replay.epoch) for row in batch_rows)
+            return original_compute(batch_rows, trace_batch, replay)
+
+        trainer._compute_losses_for_batch = compute
+        trainer.train(Dataset.from_list(rows), Dataset.from_list(rows))
+        return seen
+
+    straight = run("straight")
+    resumed = run("resumed", resume_from_checkpoint=str(tmp_path / "straight" / "ckpt" / "step-3"))
+
+    assert len(straight) == 5 * ppo_epochs
+    assert resumed == straight[3:]
+
+
+def test_train_keeps_reduced_reference_token_budget_across_steps(tmp_path: Path) -> None:
+    from datasets import Dataset
+
+    trainer = _build_trainer(tmp_path, num_generations=2)
+    trainer.cfg.max_steps = 2
+    trainer.cfg.per_device_train_batch_size = 1
+    trainer.cfg.eval_sample_size = 0
+    trainer.cfg.metrics_log_path = str(tmp_path / "metrics.jsonl")
+    trainer.cfg.reference_max_tokens_per_forward = 256
+    trainer._reference_token_budget = 32
+    trainer.tokenizer.save_pretrained = lambda save_directory: None
+    rows = [
+        {"id": index, "keywords": [keyword], "references": [f"joke about {keyword}", "another"], "scores": [1.0, 0.5]}
+        for index, keyword in enumerate(["cats", "dogs"])
+    ]
+
+    trainer.train(Dataset.from_list(rows), Dataset.from_list(rows))
+
+    logged = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines()]
+    assert [payload["reference_max_tokens_per_forward"] for payload in logged] == [32.0, 32.0]
+    assert trainer._reference_token_budget == 32
+
+
+@pytest.mark.parametrize("async_eval", [False, True])
+def test_eval_is_logged_against_snapshot_step(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    async_eval: bool,
+) -> None:
+    from datasets import Dataset
+
+    trainer = _build_trainer(tmp_path, num_generations=2)
+    trainer.cfg.max_steps = 2
+    trainer.cfg.per_device_train_batch_size = 1
+    trainer.cfg.eval_every_steps = 1
+    trainer.cfg.eval_sample_size = 2
+    trainer.cfg.async_eval = async_eval
+    trainer.cfg.metrics_log_path = str(tmp_path / "metrics.jsonl")
+    trainer.tokenizer.save_pretrained = lambda save_directory: None
+    eval_models: list[torch.nn.Module] = []
+    evaluate_fixed_rows = MRVFTrainer._evaluate_fixed_rows
+
+    def record_eval(self: MRVFTrainer, *, rows: list[dict[str, Any]], step: int) -> dict[str, float]:
+        eval_models.append(self.model)
+        return evaluate_fixed_rows(self, rows=rows, step=step)
+
+    monkeypatch.setattr(MRVFTrainer, "_evaluate_fixed_rows", record_eval)
+    rows = [
+        {"id": index, "keywords": [keyword], "references": [f"joke about {keyword}", "another"], "scores": [1.0, 0.5]}
+        for index, keyword in enumerate(["cats", "dogs"])
+    ]
+
+    trainer.train(Dataset.from_list(rows), Dataset.from_list(rows))
+
+    logged = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines()]
+    eval_steps = [payload["step"] for payload in logged if "eval/loss" in payload]
+    assert eval_steps == [1, 2]
+    assert len(eval_models) == 2
+    assert all((model is trainer.model) != async_eval for model in eval_models)
+
+
+def test_frozen_base_prompt_baseline_is_cached_on_disk(tmp_path: Path) -> None:
+    from contextlib import contextmanager
+
+    from src.training.prompt_baseline import PromptBaselineCache, prompt_baseline_cache_path
+
+    batch_rows = [{"prompt": "Write a joke about cats", "references": ["joke one", "joke two"]}]
+    policy_trainer = _build_trainer(tmp_path, num_generations=2)
+    policy_trainer.cfg.reward_baseline_mode = "prompt_relative"
+    _, policy_metrics, _ = policy_trainer._compute_losses_for_batch(batch_rows)
+
+    def build_frozen_trainer() -> MRVFTrainer:
+        trainer = _build_trainer(tmp_path, num_generations=2)
+        trainer.model.load_state_dict(policy_trainer.model.state_dict())
+        trainer.cfg.reward_baseline_mode = "prompt_relative"
+        trainer.cfg.prompt_baseline_source = "frozen_base"
+        trainer.cfg.use_peft = True
+        trainer.cfg.dataset_cache_dir = str(tmp_path / "cache")
+        trainer._prompt_baseline_cache = PromptBaselineCache(prompt_baseline_cache_path(trainer.cfg))
+        disabled: list[bool] = []
+
+        @contextmanager
+        def disable_adapter():
+            disabled.append(True)
+            yield
+
+        trainer.model.disable_adapter = disable_adapter
+        trainer.disabled_calls = disabled
+        return trainer
+
+    trainer = build_frozen_trainer()
+    _, first_metrics, _ = trainer._compute_losses_for_batch(batch_rows)
+    _, second_metrics, _ = trainer._compute_losses_for_batch(batch_rows)
+
+    assert trainer.disabled_calls == [True]
+    assert first_metrics["prompt_baseline_cache_hit_rate"] == 0.0
+    assert second_metrics["prompt_baseline_cache_hit_rate"] == 1.0
+    assert second_metrics["prompt_baseline_pass_seconds"] == 0.0
+    assert second_metrics["prompt_baseline_frozen"] == 1.0
+    assert first_metrics["prompt_baseline_reward_mean"] == pytest.approx(
+        policy_metrics["prompt_baseline_reward_mean"],
+        abs=1e-5,
+    )
+
+    trainer._prompt_baseline_cache.save()
+    reloaded = build_frozen_trainer()
+    _, reloaded_metrics, _ = reloaded._compute_losses_for_batch(batch_rows)
+    assert reloaded.disabled_calls == []
+    assert reloaded_metrics["prompt_baseline_cache_hit_rate"] == 1.0
+
+
+def test_next_batch_indices_reshuffles_each_epoch_per_rank(tmp_path: Path) -> None:
+    import random
+
+    trainer = _build_trainer(tmp_path)
+    trainer.random = random.Random(3)
+    trainer.dist = DistributedContext(rank=1, world_size=2)
+    streamed = [trainer._next_batch_indices(7, batch_size=2) for _ in range(4)]
+
+    expected_indices = list(range(7))
+    expected_random = random.Random(3)
+    expected: list[list[int]] = []
+    while len(expected) < 4:
+        expected_random.shuffle(expected_indices)
+        rank_indices = expected_indices[1::2]
+        expected.extend(rank_indices[start : start + 2] for start in range(0, len(rank_indices), 2))
+    assert streamed == expected[:4]
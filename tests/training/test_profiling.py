@@ -0,0 +1,95 @@
+import json
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+from src.training.profiling import StepProfiler, profiler_trace_path, timed_phase, zero_phase_stats
+
+
+def test_timed_phase_accumulates_seconds_per_phase() -> None:
+    stats = zero_phase_stats(("generate", "backward"), torch.device("cpu"))
+
+    for _ in range(2):
+        with timed_phase("generate", stats, torch.device("cpu")):
+            torch.ones(8).sum()
+
+    assert stats["generate_seconds"] > 0.0
+    assert stats["backward_seconds"] == 0.0
+    assert "generate_peak_memory_gb" not in stats
+
+
+def test_timed_phase_without_stats_is_noop() -> None:
+    with timed_phase("generate", None, torch.device("cpu")):
+        value = torch.ones(2).sum()
+    assert float(value) == 2.0
+
+
+def test_timed_phase_synchronizes_cuda_only_when_requested(monkeypatch: pytest.MonkeyPatch) -> None:
+    import threading
+
+    calls: list[tuple[str, str]] = []
+
+    def record(kind: str) -> None:
+        calls.append((kind, threading.current_thread().name))
+
+    monkeypatch.setattr(torch.cuda, "synchronize", lambda device: record("sync"))
+    monkeypatch.setattr(torch.cuda, "reset_peak_memory_stats", lambda device: record("reset"))
+    monkeypatch.setattr(torch.cuda, "max_memory_allocated", lambda device: 2_000_000_000)
+    device = torch.device("cuda")
+
+    stats = zero_phase_stats(("generate",), device)
+    with timed_phase("generate", stats, device):
+        pass
+    assert calls == []
+    assert "generate_peak_memory_gb" not in stats
+
+    stats = zero_phase_stats(("generate",), device, track_memory=True)
+    with timed_phase("generate", stats, device, synchronize=True):
+        pass
+    assert [kind for kind, _ in calls] == ["sync", "reset", "sync"]
+    assert stats["generate_peak_memory_gb"] == 2.0
+
+    calls.clear()
+    background_stats = zero_phase_stats(("eval",), device, track_memory=True)
+
+    def run_eval() -> None:
+        with timed_phase("eval", background_stats, device, synchronize=True):
+            pass
+
+    thread = threading.Thread(target=run_eval, name="eval")
+    thread.start()
+    thread.join()
+    assert calls == [("sync", "eval"), ("sync", "eval")]
+    assert background_stats["eval_peak_memory_gb"] == 0.0
+
+
+def test_step_profiler_exports_chrome_trace_inside_window(tmp_path: Path) -> None:
+    metrics_log_path = str(tmp_path / "logs" / "metrics.jsonl")
+    profiler = StepProfiler(start_step=2, end_step=3, metrics_log_path=metrics_log_path, device=torch.device("cpu"))
+
+    exported = []
+    for step in range(1, 5):
+        profiler.start(step)
+        with timed_phase("generate", {}, torch.device("cpu")):
+            torch.ones(16).cumsum(dim=0)
+        exported.append(profiler.stop())
+
+    assert exported == [None, profiler_trace_path(metrics_log_path, 2), profiler_trace_path(metrics_log_path, 3), None]
+    trace = json.loads(exported[1].read_text())
+    assert any(event.get("name") == "generate" for event in trace["traceEvents"])
+    assert exported[1].parent == tmp_path / "logs"
+
+
+def test_step_profiler_disabled_by_default(tmp_path: Path) -> None:
+    profiler = StepProfiler(
+        start_step=0,
+        end_step=0,
+        metrics_log_path=str(tmp_path / "metrics.jsonl"),
+        device=torch.device("cpu"),
+    )
+
+    profiler.start(1)
+
+    assert profiler.stop() is None
+    assert list(tmp_path.iterdir()) == []
@@ -77,3 +77,218 @@ def test_reference_likelihood_shapes_and_finite() -> None:
     assert output.log_mass_normalized.shape == (2,)
     assert torch.isfinite(output.log_mass_raw).all()
     assert torch.isfinite(output.log_mass_normalized).all()
+
+
+def _tiny_gpt2(vocab_size: int = 32) -> "torch.nn.Module":
+    transformers = pytest.importorskip("transformers")
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=vocab_size, n_positions=128, n_embd=16, n_layer=2, n_head=2)
+    model = transformers.GPT2LMHeadModel(config)
+    model.eval()
+    return model
+
+
+@pytest.mark.parametrize("target_only_logits", [False, True])
+def test_shared_prefix_matches_flat_reference_scoring(target_only_logits: bool) -> None:
+    from src.training.reference_likelihood import teacher_forced_reference_logps_from_ids
+
+    model = _tiny_gpt2()
+    tokenizer = DummyTokenizer()
+    kwargs = {
+        "tokenizer": tokenizer,
+        "prefix_ids_per_sample": [[3, 4, 5, 6, 7], [8, 9], [2, 3, 4]],
+        "references": [["short", "a longer reference"], ["mid ref", "x", "third"], []],
+        "max_reference_length": 8,
+        "length_normalization": "token_mean",
+    }
+
+    flat = teacher_forced_reference_logps_from_ids(model=model, **kwargs)
+    flat.log_mass_normalized[:2].sum().backward()
+    flat_grads = [param.grad.clone() for param in model.parameters()]
+    model.zero_grad(set_to_none=True)
+
+    shared = teacher_forced_reference_logps_from_ids(
+        model=model,
+        share_prefix=True,
+        target_only_logits=target_only_logits,
+        logprob_chunk_size=3,
+        **kwargs,
+    )
+    shared.log_mass_normalized[:2].sum().backward()
+    shared_grads = [param.grad for param in model.parameters()]
+
+    assert torch.allclose(shared.ref_logps_raw, flat.ref_logps_raw, atol=1e-5)
+    assert torch.allclose(shared.ref_lengths, flat.ref_lengths)
+    assert torch.allclose(shared.log_mass_normalized[:2], flat.log_mass_normalized[:2], atol=1e-5)
+    assert shared.log_mass_raw[2] == float("-inf")
+    for expected, actual in zip(flat_grads, shared_grads, strict=True):
+        assert torch.allclose(expected, actual, atol=1e-5)
+
+
+@pytest.mark.parametrize("share_prefix", [False, True])
+def test_token_budget_buckets_match_single_forward(share_prefix: bool) -> None:
+    from src.training.reference_likelihood import teacher_forced_reference_logps_from_ids
+
+    model = _tiny_gpt2()
+    kwargs = {
+        "tokenizer": DummyTokenizer(),
+        "prefix_ids_per_sample": [[3, 4, 5, 6, 7], [8, 9], [2, 3, 4]],
+        "references": [["short", "a longer reference"], ["mid ref", "x", "third"], ["r"]],
+        "max_reference_length": 8,
+        "length_normalization": "none",
+        "share_prefix": share_prefix,
+    }
+    single = teacher_forced_reference_logps_from_ids(model=model, **kwargs)
+    bucketed = teacher_forced_reference_logps_from_ids(model=model, max_tokens_per_forward=24, **kwargs)
+
+    assert single.forward_passes == 1
+    assert bucketed.forward_passes > 1
+    assert torch.allclose(bucketed.ref_logps_raw, single.ref_logps_raw, atol=1e-5)
+    assert torch.allclose(bucketed.ref_lengths, single.ref_lengths)
+
+
+def test_token_budget_halves_after_out_of_memory() -> None:
+    from src.training.reference_likelihood import teacher_forced_reference_logps_from_ids
+
+    class OutOfMemoryLM(DummyLM):
+        def forward(self, input_ids, attention_mask=None):
+            if input_ids.numel() > 12:
+                raise torch.cuda.OutOfMemoryError("simulated")
+            return super().forward(input_ids, attention_mask=attention_mask)
+
+    torch.manual_seed(0)
+    reference_model = DummyLM()
+    model = OutOfMemoryLM()
+    model.load_state_dict(reference_model.state_dict())
+    kwargs = {
+        "tokenizer": DummyTokenizer(),
+        "prefix_ids_per_sample": [[3, 4, 5], [6, 7]],
+        "references": [["abc", "de"], ["fgh"]],
+        "max_reference_length": 8,
+        "length_normalization": "token_mean",
+    }
+    expected = teacher_forced_reference_logps_from_ids(model=reference_model, **kwargs)
+    output = teacher_forced_reference_logps_from_ids(model=model, max_tokens_per_forward=64, **kwargs)
+
+    assert output.max_tokens_per_forward < 64
+    assert output.forward_passes >= 2
+    assert torch.allclose(output.ref_logps_raw, expected.ref_logps_raw, atol=1e-6)
+
+
+@pytest.mark.parametrize("grad_enabled", [False, True])
+def test_token_budget_does_not_retry_out_of_memory_with_retained_graphs(grad_enabled: bool) -> None:
+    from src.training.reference_likelihood import teacher_forced_reference_logps_from_ids
+
+    class SecondForwardOutOfMemoryLM(DummyLM):
+        calls = 0
+
+        def forward(self, input_ids, attention_mask=None):
+            type(self).calls += 1
+            if type(self).calls == 2:
+                raise torch.cuda.OutOfMemoryError("simulated")
+            return super().forward(input_ids, attention_mask=attention_mask)
+
+    kwargs = {
+        "model": SecondForwardOutOfMemoryLM(),
+        "tokenizer": DummyTokenizer(),
+        "prefix_ids_per_sample": [[3, 4, 5], [6, 7]],
+        "references": [["abcdef", "de"], ["fgh"]],
+        "max_reference_length": 8,
+        "length_normalization": "token_mean",
+        "max_tokens_per_forward": 12,
+    }
+    with torch.set_grad_enabled(grad_enabled):
+        if grad_enabled:
+            with pytest.raises(torch.cuda.OutOfMemoryError):
+                teacher_forced_reference_logps_from_ids(**kwargs)
+        else:
+            output = teacher_forced_reference_logps_from_ids(**kwargs)
+            assert output.max_tokens_per_forward == 6
+            assert torch.isfinite(output.log_mass_raw).all()
+
+
+@pytest.mark.parametrize(("share_prefix", "max_tokens_per_forward"), [(False, 0), (True, 0), (False, 24), (True, 24)])
+def test_fused_trace_logps_match_separate_trace_pass(share_prefix: bool, max_tokens_per_forward: int) -> None:
+    from src.training.logprobs import masked_sequence_logprobs
+    from src.training.reference_likelihood import teacher_forced_reference_logps_from_ids
+
+    model = _tiny_gpt2()
+    prompts = [[3, 4, 5], [8, 9], [2, 3, 4, 5]]
+    traces = [[6, 7], [], [9, 10, 11]]
+    suffixes = [[12], [], [13, 14]]
+    prefixes = [prompt + trace + suffix for prompt, trace, suffix in zip(prompts, traces, suffixes, strict=True)]
+    spans = [(len(prompt), len(prompt) + len(trace)) for prompt, trace in zip(prompts, traces, strict=True)]
+    kwargs = {
+        "tokenizer": DummyTokenizer(),
+        "prefix_ids_per_sample": prefixes,
+        "references": [["short", "a longer reference"], [], ["mid ref", "x"]],
+        "max_reference_length": 8,
+        "length_normalization": "token_mean",
+        "share_prefix": share_prefix,
+        "max_tokens_per_forward": max_tokens_per_forward,
+    }
+
+    plain = teacher_forced_reference_logps_from_ids(model=model, **kwargs)
+    fused = teacher_forced_reference_logps_from_ids(model=model, trace_spans=spans, **kwargs)
+
+    width = max(len(prompt) + len(trace) for prompt, trace in zip(prompts, traces, strict=True))
+    rows = [prompt + trace for prompt, trace in zip(prompts, traces, strict=True)]
+    input_ids = torch.tensor([row + [0] * (width - len(row)) for row in rows])
+    attention_mask = torch.tensor([[1] * len(row) + [0] * (width - len(row)) for row in rows])
+    target_mask = torch.tensor(
+        [
+            [0] * len(prompt) + [1] * len(trace) + [0] * (width - len(prompt) - len(trace))
+            for prompt, trace in zip(prompts, traces, strict=True)
+        ]
+    )
+    expected = masked_sequence_logprobs(
+        model=model,
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        target_mask=target_mask,
+    )
+
+    assert plain.trace_logps is None
+    assert fused.trace_logps is not None
+    assert torch.allclose(fused.trace_logps, expected, atol=1e-5)
+    assert fused.trace_logps[1].item() == 0.0
+    assert torch.allclose(fused.ref_logps_raw, plain.ref_logps_raw, atol=1e-5)
+
+
+@pytest.mark.parametrize("share_prefix", [False, True])
+def test_pad_to_multiple_of_matches_unpadded_scoring(share_prefix: bool) -> None:
+    from src.training.reference_likelihood import padded_width, teacher_forced_reference_logps_from_ids
+
+    model = _tiny_gpt2()
+    kwargs = {
+        "tokenizer": DummyTokenizer(),
+        "prefix_ids_per_sample": [[3, 4, 5, 6, 7], [8, 9]],
+        "references": [["short", "a longer reference"], ["mid ref", "x"]],
+        "max_reference_length": 8,
+        "length_normalization": "token_mean",
+        "share_prefix": share_prefix,
+        "trace_spans": [(1, 4), (0, 2)],
+    }
+    seen_widths: list[int] = []
+
+    def recording_scorer(**score_kwargs):
+        from src.training.logprobs import masked_sequence_logprobs_by_mask
+
+        seen_widths.append(score_kwargs["input_ids"].shape[1])
+        return masked_sequence_logprobs_by_mask(**score_kwargs)
+
+    unpadded = teacher_forced_reference_logps_from_ids(model=model, **kwargs)
+    padded = teacher_forced_reference_logps_from_ids(
+        model=model,
+        pad_to_multiple_of=16,
+        sequence_logprobs_fn=recording_scorer,
+        **kwargs,
+    )
+
+    assert padded_width(17, 16) == 32
+    assert padded_width(17, 0) == 17
+    assert all(width % 16 == 0 for width in seen_widths)
+    assert bool(seen_widths) != share_prefix
+    assert torch.allclose(padded.ref_logps_raw, unpadded.ref_logps_raw, atol=1e-5)
+    assert torch.allclose(padded.ref_lengths, unpadded.ref_lengths)
+    assert torch.allclose(padded.trace_logps, unpadded.trace_logps, atol=1e-5)
@@ -0,0 +1,95 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+from src.training.rollout import AsyncRolloutWorker
+
+
+class LoraLikeModel(torch.nn.Module):
+    def __init__(self) -> None:
+        super().__init__()
+        self.base = torch.nn.Linear(2, 2)
+        self.base.requires_grad_(False)
+        self.adapter = torch.nn.Parameter(torch.zeros(2))
+
+
+def _adapter_value(
+    model: torch.nn.Module,
+    batch: list[int],
+    generator: torch.Generator,
+) -> tuple[list[dict], tuple[float, float]]:
+    draw = float(torch.rand((), generator=generator))
+    return [{"id": index} for index in batch], (float(model.adapter[0].item()), draw)
+
+
+def _worker(policy: torch.nn.Module, generate_fn=_adapter_value, seed: int = 0) -> AsyncRolloutWorker:
+    return AsyncRolloutWorker(
+        policy_model=policy,
+        generate_fn=generate_fn,
+        seed=seed,
+        device=torch.device("cpu"),
+    )
+
+
+def test_rollout_worker_shares_frozen_weights_and_copies_trainable() -> None:
+    policy = LoraLikeModel()
+    worker = _worker(policy)
+
+    assert worker.model.base.weight is policy.base.weight
+    assert worker.model.adapter is not policy.adapter
+    assert not worker.model.adapter.requires_grad
+
+
+def test_rollout_worker_applies_weights_published_before_each_request() -> None:
+    policy = LoraLikeModel()
+    worker = _worker(policy)
+    worker.submit([0])
+    worker.submit([1])
+    with torch.no_grad():
+        policy.adapter.fill_(3.0)
+    worker.publish_weights(policy, version=1)
+    worker.start()
+    try:
+        first = worker.get()
+        second = worker.get()
+        worker.submit([2])
+        third = worker.get()
+    finally:
+        worker.close()
+
+    assert [first.batch_rows, second.batch_rows, third.batch_rows] == [[{"id": 0}], [{"id": 1}], [{"id": 2}]]
+    assert [first.policy_version, second.policy_version, third.policy_version] == [0, 0, 1]
+    assert [first.trace_batch[0], second.trace_batch[0], third.trace_batch[0]] == [0.0, 0.0, 3.0]
+
+
+def test_rollout_worker_samples_from_its_own_generator() -> None:
+    policies = [LoraLikeModel(), LoraLikeModel()]
+    global_state = torch.get_rng_state()
+    draws = []
+    for policy in policies:
+        worker = _worker(policy, seed=7)
+        worker.start()
+        try:
+            worker.submit([0])
+            worker.submit([1])
+            draws.append([worker.get().trace_batch[1], worker.get().trace_batch[1]])
+        finally:
+            worker.close()
+
+    assert draws[0] == draws[1]
+    assert draws[0][0] != draws[0][1]
+    assert torch.equal(torch.get_rng_state(), global_state)
+
+
+def test_rollout_worker_surfaces_generation_errors() -> None:
+    def fail(model: torch.nn.Module, batch: list[int], generator: torch.Generator) -> None:
+        del model, batch, generator
+        raise ValueError("boom")
+
+    worker = _worker(LoraLikeModel(), generate_fn=fail)
+    worker.start()
+    try:
+        worker.submit([0])
+        with pytest.raises(RuntimeError, match="Rollout worker failed"):
+            worker.get()
+    finally:
+        worker.close()
@@ -0,0 +1,123 @@
+import types
+from dataclasses import dataclass
+from pathlib import Path
+
+import pytest
+
+from src.training.config import MRVFConfig
+from src.training.vllm_rollout import VLLMRolloutEngine
+
+torch = pytest.importorskip("torch")
+
+
+@dataclass
+class FakeLoRARequest:
+    lora_name: str
+    lora_int_id: int
+    lora_path: str
+
+
+class FakeSamplingParams:
+    def __init__(self, **kwargs) -> None:
+        self.kwargs = kwargs
+
+
+class FakeLLM:
+    def __init__(self, completions_by_prompt: dict[tuple[int, ...], list[tuple[list[int], int | None]]]) -> None:
+        self.completions_by_prompt = completions_by_prompt
+        self.calls: list[dict] = []
+
+    def generate(self, prompts, *, sampling_params, lora_request, use_tqdm):
+        del use_tqdm
+        self.calls.append({"prompts": prompts, "sampling_params": sampling_params, "lora_request": lora_request})
+        return [
+            types.SimpleNamespace(
+                outputs=[
+                    types.SimpleNamespace(token_ids=tuple(token_ids), stop_reason=stop_reason)
+                    for token_ids, stop_reason in self.completions_by_prompt[tuple(prompt["prompt_token_ids"])]
+                ]
+            )
+            for prompt in prompts
+        ]
+
+
+class FakeAdapterModel:
+    def __init__(self) -> None:
+        self.saved: list[Path] = []
+
+    def save_pretrained(self, save_directory) -> None:
+        path = Path(save_directory)
+        path.mkdir(parents=True, exist_ok=True)
+        (path / "adapter_model.safetensors").write_bytes(b"")
+        self.saved.append(path)
+
+
+def _engine(tmp_path: Path, llm: FakeLLM, **overrides) -> VLLMRolloutEngine:
+    cfg = MRVFConfig(
+        use_peft=True,
+        rollout_backend="vllm",
+        num_generations=2,
+        vllm_adapter_dir=str(tmp_path / "adapter"),
+        **overrides,
+    )
+    cfg.validate()
+    return VLLMRolloutEngine(
+        cfg=cfg,
+        llm=llm,
+        sampling_params_cls=FakeSamplingParams,
+        lora_request_cls=FakeLoRARequest,
+    )
+
+
+def test_sync_adapter_registers_new_lora_request_and_drops_old_adapter(tmp_path: Path) -> None:
+    engine = _engine(tmp_path, FakeLLM({}))
+    model = FakeAdapterModel()
+
+    engine.sync_adapter(model, step=0)
+    first = engine.lora_request
+    engine.sync_adapter(model, step=3)
+
+    assert first == FakeLoRARequest("mrvf_policy_1", 1, str(tmp_path / "adapter" / "step-0"))
+    assert engine.lora_request == FakeLoRARequest("mrvf_policy_2", 2, str(tmp_path / "adapter" / "step-3"))
+    assert engine.synced_step == 3
+    assert not (tmp_path / "adapter" / "step-0").exists()
+    assert (tmp_path / "adapter" / "step-3" / "adapter_model.safetensors").exists()
+
+
+def test_adapter_dir_defaults_to_run_output_dir(tmp_path: Path) -> None:
+    cfg = MRVFConfig(use_peft=True, rollout_backend="vllm", output_dir=str(tmp_path / "run"))
+    engine = VLLMRolloutEngine(
+        cfg=cfg,
+        llm=FakeLLM({}),
+        sampling_params_cls=FakeSamplingParams,
+        lora_request_cls=FakeLoRARequest,
+    )
+
+    engine.sync_adapter(FakeAdapterModel(), step=2)
+
+    assert engine.lora_request.lora_path == str(tmp_path / "run" / "vllm_adapter" / "step-2")
+
+
+def test_generate_requires_synced_adapter(tmp_path: Path) -> None:
+    engine = _engine(tmp_path, FakeLLM({}))
+    with pytest.raises(RuntimeError, match="not synced"):
+        engine.generate([[1, 2]], stop_token_ids=[])
+
+
+def test_generate_flattens_samples_and_restores_stop_token(tmp_path: Path) -> None:
+    llm = FakeLLM({(1, 2): [([5, 6], 99), ([7, 99], 99)], (3,): [([8], None), ([9, 10], None)]})
+    engine = _engine(tmp_path, llm, top_k=20)
+    engine.sync_adapter(FakeAdapterModel(), step=0)
+
+    completions = engine.generate([[1, 2], [3]], stop_token_ids=[99])
+
+    assert completions == [[5, 6, 99], [7, 99], [8], [9, 10]]
+    call = llm.calls[0]
+    assert call["prompts"] == [{"prompt_token_ids": [1, 2]}, {"prompt_token_ids": [3]}]
+    assert call["lora_request"] is engine.lora_request
+    assert call["sampling_params"].kwargs["n"] == 2
+    assert call["sampling_params"].kwargs["top_k"] == 20
+    assert call["sampling_params"].kwargs["stop_token_ids"] == [99]
+    assert call["sampling_params"].kwargs["stop"] == []
+    assert call["sampling_params"].kwargs["include_stop_str_in_output"] is False
+    assert call["sampling_params"].kwargs["max_tokens"] == engine.cfg.max_trace_length